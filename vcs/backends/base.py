@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import time
+import shutil
 import datetime
 import itertools
 
 from vcs.utils import author_name, author_email
+from vcs.utils.archive_cache import get_archive_cache
 from vcs.utils.lazy import LazyProperty
 from vcs.utils.helpers import get_dict_for_attrs
+from vcs.utils.metadata import ChangesetsMetadata, get_summary
 from vcs.conf import settings
 
 from vcs.exceptions import (
@@ -164,6 +170,30 @@ class BaseRepository(object):
         """
         raise NotImplementedError
 
+    def get_changesets_metadata(self, revisions=None, messages=True):
+        """
+        Returns ``ChangesetsMetadata`` (ids, revisions, authors, timestamps
+        and summaries) of changesets with given ``revisions`` (all changesets
+        if ``None``), in the same order. Backends read it straight from
+        commits, without creating changeset objects.
+
+        :param revisions: iterable of changesets' ids
+        :param messages: if ``False``, full messages are not kept (summaries,
+          i.e. first lines of messages, are kept always)
+
+        :raises ChangesetDoesNotExistError: if any of ``revisions`` could not
+          be found
+        """
+        if revisions is None:
+            revisions = self.revisions
+        metadata = ChangesetsMetadata(messages)
+        for revision in revisions:
+            cs = self.get_changeset(revision)
+            metadata.append(cs.raw_id, cs.revision, cs.author,
+                time.mktime(cs.date.timetuple()), get_summary(cs.message),
+                cs.message)
+        return metadata
+
     def __getslice__(self, i, j):
         """
         Returns a iterator of sliced repository
@@ -221,6 +251,24 @@ class BaseRepository(object):
         """
         raise NotImplementedError
 
+    def iter_diff(self, rev1, rev2, path=None, ignore_whitespace=False,
+                  context=3, file_limit=None, total_limit=None):
+        """
+        Returns generator of tuples ``(patch, truncated)`` with patches of
+        single files of the *diff* returned by ``get_diff`` with the same
+        arguments. Patches are yielded as soon as they are produced, so whole
+        diff is never kept in memory.
+
+        :param file_limit: if given, patches of files are cut to at most that
+          many bytes
+        :param total_limit: if given, patches are cut once that many bytes
+          has been yielded in total; patches of following files consist of
+          their ``diff --git`` line only
+        :returns: patches with ``truncated`` flag set to ``True`` if they have
+          been cut
+        """
+        raise NotImplementedError
+
     # ========== #
     # COMMIT API #
     # ========== #
@@ -493,6 +541,18 @@ class BaseChangeset(object):
         """
         raise NotImplementedError
 
+    def get_last_changesets(self, path):
+        """
+        Returns dictionary of paths of all nodes within the directory at the
+        given ``path`` mapped to the changesets which last changed them. It
+        is much faster than asking each node for its ``last_changeset``, as
+        history is walked only once.
+
+        :raises ``ChangesetError``: if node at the given ``path`` is not
+          instance of ``DirNode``
+        """
+        raise NotImplementedError
+
     def get_file_history(self, path):
         """
         Returns history of file as reversed list of ``Changeset`` objects for
@@ -500,10 +560,35 @@ class BaseChangeset(object):
         """
         raise NotImplementedError
 
-    def get_nodes(self, path):
+    def iter_file_history(self, path, offset=0, limit=None, follow=False):
+        """
+        Returns iterator over ``Changeset`` objects (newest first) for which
+        file at given ``path`` has been modified. History is read lazily, so
+        it may be paginated cheaply.
+
+        :param offset: number of changesets to skip
+        :param limit: maximal number of changesets to return
+        :param follow: if ``True``, history is continued beyond renames
+        """
+        raise NotImplementedError
+
+    def get_file_annotate(self, path):
+        """
+        Returns a generator of four element tuples with lineno, sha,
+        changeset lazy loader and line, for every line of the file at given
+        ``path``. Loader of each distinct changeset retrieves it only once.
+        """
+        raise NotImplementedError
+
+    def get_nodes(self, path, offset=0, limit=None):
         """
         Returns combined ``DirNode`` and ``FileNode`` objects list representing
-        state of changeset at the given ``path``.
+        state of changeset at the given ``path``. Nodes are sorted (submodules
+        and directories first, then by name).
+
+        :param offset: number of nodes to skip
+        :param limit: if given, at most that many nodes are returned; for
+          directories with lots of entries nodes can be listed page by page
 
         :raises ``ChangesetError``: if node at the given ``path`` is not
           instance of ``DirNode``
@@ -521,7 +606,9 @@ class BaseChangeset(object):
 
     def fill_archive(self, stream=None, kind='tgz', prefix=None):
         """
-        Fills up given stream.
+        Fills up given stream. If ``ARCHIVE_CACHE_DIR`` is set, archive is
+        built once and then copied from the archive cache (``open_archive``
+        hands the cached file over without copying).
 
         :param stream: file like object.
         :param kind: one of following: ``zip``, ``tar``, ``tgz``
@@ -534,17 +621,63 @@ class BaseChangeset(object):
 
         raise NotImplementedError
 
+    def _prepare_archive(self, kind='tgz', prefix=None, **options):
+        """
+        Validates archive's options (the same as of ``fill_archive``) and
+        returns tuple of archive's key at the archive cache and callable
+        writing archive into given file object.
+        """
+        raise NotImplementedError
+
+    def _fill_archive(self, stream, key, fill):
+        """
+        Writes archive with given ``key`` into ``stream``, using ``fill``
+        callable to build it if it is not cached.
+        """
+        cache = get_archive_cache()
+        if cache is None:
+            fill(stream)
+            return
+        with cache.open(key, fill) as f:
+            shutil.copyfileobj(f, stream)
+
+    def open_archive(self, **kwargs):
+        """
+        Returns file object (opened for reading) of the archive with given
+        options (the same as of ``fill_archive``, apart from ``stream``) at
+        the archive cache, building it if it is not cached yet, or ``None``
+        if ``ARCHIVE_CACHE_DIR`` is not set. Path of the file is its ``name``
+        attribute, so it may be served straight from the disk (i.e. with
+        ``sendfile``). File remains readable after it is evicted from the
+        cache; caller should close it.
+        """
+        cache = get_archive_cache()
+        if cache is None:
+            return None
+        return cache.open(*self._prepare_archive(**kwargs))
+
     def get_chunked_archive(self, **kwargs):
         """
         Returns iterable archive. Tiny wrapper around ``fill_archive`` method.
+        If ``ARCHIVE_CACHE_DIR`` is set, chunks are read straight from the
+        cached archive (``stream`` is not used).
 
         :param chunk_size: extra parameter which controls size of returned
             chunks. Default:8k.
         """
 
         chunk_size = kwargs.pop('chunk_size', 8192)
-        stream = kwargs.get('stream')
-        self.fill_archive(**kwargs)
+        stream = kwargs.pop('stream', None)
+        f = self.open_archive(**kwargs)
+        if f is not None:
+            with f:
+                while True:
+                    data = f.read(chunk_size)
+                    if not data:
+                        break
+                    yield data
+            return
+        self.fill_archive(stream=stream, **kwargs)
         while True:
             data = stream.read(chunk_size)
             if not data:
@@ -884,9 +1017,9 @@ class BaseInMemoryChangeset(object):
             for node in self.changed:
                 try:
                     old = p.get_node(node.path)
-                    missing.remove(node)
+                    missing.discard(node)
                     if old.content != node.content:
-                        not_changed.remove(node)
+                        not_changed.discard(node)
                 except NodeDoesNotExistError:
                     pass
         if self.changed and missing:
@@ -1006,5 +1139,12 @@ class CollectionGenerator(object):
         sliced_revs = self.revs[i:j]
         return CollectionGenerator(self.repo, sliced_revs)
 
+    def get_metadata(self, messages=True):
+        """
+        Returns ``ChangesetsMetadata`` of changesets of this collection (see
+        ``BaseRepository.get_changesets_metadata``).
+        """
+        return self.repo.get_changesets_metadata(self.revs, messages)
+
     def __repr__(self):
         return 'CollectionGenerator<%s>' % (len(self))
@@ -0,0 +1,206 @@
+"""
+Persistent changed-paths index for git repositories.
+
+For every commit (at the same position as within the revision index) a Bloom
+filter of paths changed by that commit (compared to its first parent) is
+kept, together with all of their parent directories. Walks limited to paths
+use it to skip commits which certainly did not touch walked paths without
+reading their trees (much like git's commit-graph changed-path filters do).
+
+File format (all integers are stored in native byte order)::
+
+    header:   MAGIC, version, byteorder, itemsize, hashes count, counts
+    prefixes: first 4 bytes of commit id (as integer) * commits count
+    offsets:  (commits count + 1) offsets of filters within data
+    data:     filters, one after another
+    trailer:  sha1 checksum of all of above
+
+Prefixes are checked against the revision index before filter is used, so
+filters which do not match revisions (i.e. after the revision index has been
+rebuilt) are never trusted. File is written the same way as the revision
+index is.
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import struct
+from array import array
+from hashlib import sha1
+from stat import S_ISDIR
+
+from .revindex import write_index_file
+
+MAGIC = 'VCSBLOOM'
+VERSION = 1
+INDEX_FILENAME = 'vcs-changed-paths'
+
+# the same values git uses: 10 bits for every path, 7 hashes (giving false
+# positive rate of about 1%) and commits changing more than 512 paths get
+# filter with all bits set
+BITS_PER_PATH = 10
+HASHES = 7
+MAX_PATHS = 512
+FULL_FILTER = '\xff'
+
+_HEADER = struct.Struct('=8sIBBBII')
+
+
+def get_path_keys(path):
+    """
+    Returns tuple of two integers from which positions of bits for given
+    ``path`` are derived (using double hashing).
+    """
+    return struct.unpack('<II', sha1(path.strip('/')).digest()[:8])
+
+
+def get_changed_paths(tree_cache, store, old_tree, new_tree, limit=None):
+    """
+    Returns list of paths which differ between trees with ids ``old_tree``
+    and ``new_tree`` (any of them may be ``None``), including directories
+    containing changes. If more than ``limit`` paths differ, ``None`` is
+    returned.
+    """
+    paths = []
+    stack = [('', old_tree, new_tree)]
+    while stack:
+        prefix, old_id, new_id = stack.pop()
+        old = old_id and tree_cache.get_entries(old_id, store) or {}
+        new = new_id and tree_cache.get_entries(new_id, store) or {}
+        for name in set(old).union(new):
+            old_entry, new_entry = old.get(name), new.get(name)
+            if old_entry == new_entry:
+                continue
+            path = prefix + name
+            paths.append(path)
+            if limit is not None and len(paths) > limit:
+                return None
+            old_dir = old_entry and S_ISDIR(old_entry[0]) and old_entry[1]
+            new_dir = new_entry and S_ISDIR(new_entry[0]) and new_entry[1]
+            if old_dir or new_dir:
+                stack.append((path + '/', old_dir or None, new_dir or None))
+    return paths
+
+
+class GitChangedPathsIndex(object):
+    """
+    In-memory representation of the changed-paths index.
+    """
+
+    def __init__(self):
+        self._prefixes = array('I')
+        self._offsets = array('I', [0])
+        self._data = array('B')
+
+    def __len__(self):
+        return len(self._prefixes)
+
+    def append(self, revision, paths):
+        """
+        Appends filter for commit with given ``revision`` id, which has
+        changed given ``paths`` (``None`` if it has changed too many of them).
+        """
+        if paths is None:
+            data = FULL_FILTER
+        else:
+            bits = array('B', [0]) * ((len(paths) * BITS_PER_PATH + 7) // 8)
+            nbits = len(bits) * 8
+            for path in paths:
+                h1, h2 = get_path_keys(path)
+                for i in xrange(HASHES):
+                    bit = (h1 + i * h2) % nbits
+                    bits[bit // 8] |= 1 << (bit % 8)
+            data = bits.tostring()
+        self._data.fromstring(data)
+        self._offsets.append(len(self._data))
+        self._prefixes.append(int(revision[:8], 16))
+
+    def might_change(self, pos, revision, keys):
+        """
+        Returns ``False`` if commit at given ``pos`` certainly has not
+        changed any of paths with given ``keys`` (as returned by
+        ``get_path_keys``), ``True`` otherwise.
+        """
+        if pos >= len(self) or self._prefixes[pos] != int(revision[:8], 16):
+            return True
+        start, end = self._offsets[pos], self._offsets[pos + 1]
+        nbits = (end - start) * 8
+        if not nbits:
+            return False
+        data = self._data
+        for h1, h2 in keys:
+            for i in xrange(HASHES):
+                bit = (h1 + i * h2) % nbits
+                if not data[start + bit // 8] & (1 << (bit % 8)):
+                    break
+            else:
+                return True
+        return False
+
+    def matches(self, revisions):
+        """
+        Returns ``True`` if index has been built for (a prefix of) given
+        ``revisions``.
+        """
+        count = len(self)
+        return count <= len(revisions) and (not count or
+            self._prefixes[count - 1] == int(revisions[count - 1][:8], 16))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads index from the file at the given ``path``. Returns ``None`` if
+        file does not exist or cannot be used.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            return cls._parse(data)
+        except (struct.error, ValueError, EOFError, IndexError):
+            return None
+
+    @classmethod
+    def _parse(cls, data):
+        if len(data) < _HEADER.size + 20 or \
+                sha1(data[:-20]).digest() != data[-20:]:
+            raise ValueError('Index checksum mismatch')
+        (magic, version, byteorder, itemsize, hashes, count,
+         data_len) = _HEADER.unpack_from(data)
+        if (magic != MAGIC or version != VERSION
+            or byteorder != (sys.byteorder == 'little')
+            or itemsize != array('I').itemsize or hashes != HASHES):
+            raise ValueError('Index written by incompatible version')
+        index = cls()
+        offset = _HEADER.size
+        for name, length in (('_prefixes', count), ('_offsets', count + 1),
+                             ('_data', data_len)):
+            arr = array(getattr(index, name).typecode)
+            size = arr.itemsize * length
+            arr.fromstring(data[offset:offset + size])
+            offset += size
+            setattr(index, name, arr)
+        if offset != len(data) - 20:
+            raise ValueError('Index has unexpected size')
+        return index
+
+    def save(self, path):
+        """
+        Writes index into the file at the given ``path``. Returns ``False``
+        if index could not be written, ``True`` otherwise.
+        """
+        data = ''.join([_HEADER.pack(MAGIC, VERSION,
+            sys.byteorder == 'little', array('I').itemsize, HASHES,
+            len(self), len(self._data)), self._prefixes.tostring(),
+            self._offsets.tostring(), self._data.tostring()])
+        return write_index_file(path, data)
+
+
+def get_index_path(controldir):
+    """
+    Returns path of the changed-paths index file for the given git control
+    directory.
+    """
+    return os.path.join(controldir, INDEX_FILENAME)
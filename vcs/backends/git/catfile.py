@@ -0,0 +1,265 @@
+"""
+Pool of long lived ``git cat-file`` processes.
+
+Objects are read with ``dulwich`` by default, but they may be read by git
+itself as well. Rather than forking a process per object, processes started
+with ``git cat-file --batch`` (or ``--batch-check`` if only types and sizes
+of objects are needed) are kept running: such process reads ids of objects
+from its stdin and writes objects to its stdout, so it serves any number of
+requests. Requests for many objects are pipelined (written ahead of reading
+responses, never more than fit into the pipe's buffer).
+
+Pool keeps at most given number of processes per repository. A process is
+taken from the pool for every request (or batch of requests) and returned
+afterwards; processes which have died or got out of sync with the pool
+(i.e. their response could not be read entirely) are discarded and replaced
+by new ones on demand.
+"""
+from __future__ import with_statement
+
+import os
+import threading
+import subprocess
+from collections import deque
+from contextlib import contextmanager
+
+from vcs.conf import settings
+from vcs.exceptions import RepositoryError
+from vcs.utils.compat import kill
+
+# maximal number of requests written ahead of responses read; requests are
+# 41 bytes long, so all of them fit into the smallest (4KB) pipe's buffer and
+# writing them never blocks
+PIPELINE_DEPTH = 64
+
+
+class CatFileError(RepositoryError):
+    """
+    Raised if ``git cat-file`` process could not be run or it does not
+    respond properly.
+    """
+
+
+class CatFileProcess(object):
+    """
+    Single ``git cat-file`` process running at the repository at given
+    ``path``. If ``check`` is ``True`` process only returns types and sizes
+    of objects (``--batch-check``), otherwise it returns their contents too
+    (``--batch``).
+    """
+
+    def __init__(self, path, check=False):
+        self.check = check
+        self.broken = False
+        cmd = [settings.GIT_EXECUTABLE_PATH, 'cat-file',
+               check and '--batch-check' or '--batch']
+        env = dict(os.environ)
+        env.pop('GIT_DIR', None)
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                self.process = subprocess.Popen(cmd, cwd=path, env=env,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=devnull, close_fds=True)
+        except (EnvironmentError, OSError), err:
+            raise CatFileError("Couldn't run git command (%s).\n"
+                               "Original error was:%s\n" % (cmd, err))
+
+    @property
+    def alive(self):
+        """
+        Returns ``True`` if process is running and in sync with the pool.
+        """
+        return not self.broken and self.process.poll() is None
+
+    def _write(self, shas):
+        try:
+            self.process.stdin.write(''.join('%s\n' % sha for sha in shas))
+            self.process.stdin.flush()
+        except (IOError, OSError), err:
+            self.broken = True
+            raise CatFileError("Couldn't write to git cat-file: %s" % err)
+
+    def _read(self, sha):
+        stdout = self.process.stdout
+        try:
+            header = stdout.readline()
+            if header.endswith(' missing\n'):
+                return None
+            obj_sha, type_name, size = header.split()
+            size = int(size)
+            if self.check:
+                return type_name, size
+            content = stdout.read(size)
+            if len(content) != size or stdout.read(1) != '\n':
+                raise ValueError('truncated object')
+        except (IOError, OSError, ValueError), err:
+            self.broken = True
+            raise CatFileError("Couldn't read object %s from git cat-file: "
+                               "%s" % (sha, err))
+        return type_name, content
+
+    def iter_objects(self, shas):
+        """
+        Yields responses for objects with given ``shas`` (in the same order):
+        tuples ``(type name, content)`` (or ``(type name, size)`` if process
+        has been started with ``check``) or ``None`` for missing objects.
+        Process is broken if generator is not exhausted.
+        """
+        pending = deque()
+        shas = iter(shas)
+        try:
+            while True:
+                batch = []
+                if len(pending) <= PIPELINE_DEPTH // 2:
+                    for sha in shas:
+                        batch.append(sha)
+                        if len(pending) + len(batch) >= PIPELINE_DEPTH:
+                            break
+                if batch:
+                    self._write(batch)
+                    pending.extend(batch)
+                if not pending:
+                    break
+                yield self._read(pending.popleft())
+        finally:
+            if pending:
+                self.broken = True
+
+    def close(self):
+        """
+        Stops the process.
+        """
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.process.poll() is None:
+            try:
+                kill(self.process)
+            except OSError:
+                pass
+        self.process.wait()
+
+
+class CatFilePool(object):
+    """
+    Pool of at most ``size`` ``git cat-file`` processes running at the
+    repository at given ``path``. Pool is thread safe; if all processes are
+    busy, callers wait for one to be returned.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = {True: [], False: []}
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def _acquire(self, check):
+        with self._condition:
+            while True:
+                idle = self._idle[check]
+                if idle:
+                    process = idle.pop()
+                    if process.alive:
+                        return process
+                    self._discard(process)
+                elif self._count < self.size:
+                    self._count += 1
+                    break
+                elif self._idle[not check]:
+                    # replace process of the other kind
+                    self._discard(self._idle[not check].pop(0))
+                else:
+                    self._condition.wait()
+        try:
+            return CatFileProcess(self.path, check)
+        except:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+            raise
+
+    def _discard(self, process):
+        process.close()
+        self._count -= 1
+
+    def _release(self, process):
+        with self._condition:
+            if process.alive:
+                self._idle[process.check].append(process)
+            else:
+                self._discard(process)
+            self._condition.notify()
+
+    @contextmanager
+    def _process(self, check):
+        process = self._acquire(check)
+        try:
+            yield process
+        finally:
+            self._release(process)
+
+    def _iter(self, shas, check):
+        with self._process(check) as process:
+            for response in process.iter_objects(shas):
+                yield response
+
+    def _get(self, sha, check):
+        # process might have died since it has been returned to the pool, so
+        # request is retried once at a new one
+        for retry in (False, True):
+            try:
+                with self._process(check) as process:
+                    response = list(process.iter_objects([sha]))[0]
+            except CatFileError:
+                if retry:
+                    raise
+                continue
+            if response is None:
+                raise KeyError(sha)
+            return response
+
+    def get_object(self, sha):
+        """
+        Returns tuple ``(type name, content)`` of the object with given
+        ``sha``.
+
+        :raises KeyError: if there is no such object
+        :raises CatFileError: if object could not be read
+        """
+        return self._get(sha, False)
+
+    def get_info(self, sha):
+        """
+        Returns tuple ``(type name, size)`` of the object with given ``sha``
+        (content of the object is not read).
+
+        :raises KeyError: if there is no such object
+        :raises CatFileError: if object could not be read
+        """
+        return self._get(sha, True)
+
+    def iter_objects(self, shas):
+        """
+        Yields tuples ``(type name, content)`` of objects with given
+        ``shas`` (``None`` for missing ones), requested by single process.
+        """
+        return self._iter(shas, False)
+
+    def iter_info(self, shas):
+        """
+        Yields tuples ``(type name, size)`` of objects with given ``shas``
+        (``None`` for missing ones), requested by single process.
+        """
+        return self._iter(shas, True)
+
+    def close(self):
+        """
+        Stops all idle processes.
+        """
+        with self._condition:
+            for idle in self._idle.itervalues():
+                while idle:
+                    self._discard(idle.pop())
+            self._condition.notifyAll()
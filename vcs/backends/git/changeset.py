@@ -1,10 +1,13 @@
-import re
-from itertools import chain
+import heapq
+from itertools import chain, imap, islice
+from stat import S_ISDIR, S_ISLNK
 from dulwich import objects
-from subprocess import Popen, PIPE
+from dulwich.diff_tree import (
+    CHANGE_ADD, CHANGE_COPY, CHANGE_MODIFY, CHANGE_RENAME, RENAME_THRESHOLD
+)
 
 from vcs.conf import settings
-from vcs.backends.base import BaseChangeset, EmptyChangeset
+from vcs.backends.base import BaseChangeset
 from vcs.exceptions import (
     RepositoryError, ChangesetError, NodeDoesNotExistError, VCSError,
     ChangesetDoesNotExistError, ImproperArchiveTypeError
@@ -14,9 +17,15 @@ from vcs.nodes import (
     ChangedFileNodesGenerator, AddedFileNodesGenerator, RemovedFileNodesGenerator
 )
 from vcs.utils import (
-    safe_unicode, safe_str, safe_int, date_fromtimestamp
+    safe_unicode, safe_str, safe_int, date_fromtimestamp, iter_lines
 )
+from vcs.utils.archive_cache import ArchiveCache
+from vcs.utils.archivers import get_archiver
+from vcs.utils.blame import iter_annotate, split_lines
 from vcs.utils.lazy import LazyProperty
+from vcs.utils.revisions import get_next_position, get_prev_position
+
+from .walker import GitCommitWalker
 
 
 class GitChangeset(BaseChangeset):
@@ -25,7 +34,6 @@ class GitChangeset(BaseChangeset):
     """
 
     def __init__(self, repository, revision):
-        self._stat_modes = {}
         self.repository = repository
 
         try:
@@ -47,7 +55,6 @@ class GitChangeset(BaseChangeset):
         self.revision = repository.revisions.index(revision)
 
         self.nodes = {}
-        self._paths = {}
 
     @LazyProperty
     def message(self):
@@ -79,18 +86,11 @@ class GitChangeset(BaseChangeset):
 
     @LazyProperty
     def tags(self):
-        _tags = []
-        for tname, tsha in self.repository.tags.iteritems():
-            if tsha == self.raw_id:
-                _tags.append(tname)
-        return _tags
+        return list(self.repository._refs.tags_by_sha.get(self.raw_id, []))
 
     @LazyProperty
     def branch(self):
-
-        heads = self.repository._heads(reverse=False)
-
-        ref = heads.get(self.raw_id)
+        ref = self.repository._heads(reverse=False).get(self.raw_id)
         if ref:
             return safe_unicode(ref)
 
@@ -103,66 +103,46 @@ class GitChangeset(BaseChangeset):
             path = path.rstrip('/')
         return path
 
-    def _get_id_for_path(self, path):
+    def _get_tree_entry(self, path):
+        """
+        Returns tuple ``(mode, sha)`` of the object at the given ``path``
+        (``mode`` is ``None`` for the root tree). Trees are read through the
+        repository's tree cache, so only one dictionary lookup is made for
+        each path component.
+        """
+        path = path.strip('/')
+        if path == '':
+            return None, self._tree_id
+        cache = self.repository._tree_cache
+        store = self.repository._repo.object_store
+        splitted = path.split('/')
+        dirs, name = splitted[:-1], splitted[-1]
+        tree_id = self._tree_id
+        for i, dir in enumerate(dirs):
+            entry = cache.get_entries(tree_id, store).get(dir)
+            if entry is None:
+                raise ChangesetError('%s have not been found'
+                                     % '/'.join(dirs[:i + 1]))
+            if not S_ISDIR(entry[0]):
+                raise ChangesetError('%s is not a directory'
+                                     % '/'.join(dirs[:i + 1]))
+            tree_id = entry[1]
+        entry = cache.get_entries(tree_id, store).get(name)
+        if entry is None:
+            raise NodeDoesNotExistError("There is no file nor directory "
+                "at the given path '%s' at revision %s"
+                % (path, self.short_id))
+        return entry
 
-        # FIXME: Please, spare a couple of minutes and make those codes cleaner;
-        if not path in self._paths:
-            path = path.strip('/')
-            # set root tree
-            tree = self.repository._repo[self._tree_id]
-            if path == '':
-                self._paths[''] = tree.id
-                return tree.id
-            splitted = path.split('/')
-            dirs, name = splitted[:-1], splitted[-1]
-            curdir = ''
-
-            # initially extract things from root dir
-            for item, stat, id in tree.iteritems():
-                if curdir:
-                    name = '/'.join((curdir, item))
-                else:
-                    name = item
-                self._paths[name] = id
-                self._stat_modes[name] = stat
-
-            for dir in dirs:
-                if curdir:
-                    curdir = '/'.join((curdir, dir))
-                else:
-                    curdir = dir
-                dir_id = None
-                for item, stat, id in tree.iteritems():
-                    if dir == item:
-                        dir_id = id
-                if dir_id:
-                    # Update tree
-                    tree = self.repository._repo[dir_id]
-                    if not isinstance(tree, objects.Tree):
-                        raise ChangesetError('%s is not a directory' % curdir)
-                else:
-                    raise ChangesetError('%s have not been found' % curdir)
-
-                # cache all items from the given traversed tree
-                for item, stat, id in tree.iteritems():
-                    if curdir:
-                        name = '/'.join((curdir, item))
-                    else:
-                        name = item
-                    self._paths[name] = id
-                    self._stat_modes[name] = stat
-            if not path in self._paths:
-                raise NodeDoesNotExistError("There is no file nor directory "
-                    "at the given path '%s' at revision %s"
-                    % (path, self.short_id))
-        return self._paths[path]
+    def _get_id_for_path(self, path):
+        return self._get_tree_entry(path)[1]
 
     def _get_kind(self, path):
-        obj = self.repository._repo[self._get_id_for_path(path)]
-        if isinstance(obj, objects.Blob):
-            return NodeKind.FILE
-        elif isinstance(obj, objects.Tree):
+        mode = self._get_tree_entry(path)[0]
+        if mode is None or S_ISDIR(mode):
             return NodeKind.DIR
+        elif not objects.S_ISGITLINK(mode):
+            return NodeKind.FILE
 
     def _get_filectx(self, path):
         path = self._fix_path(path)
@@ -187,90 +167,73 @@ class GitChangeset(BaseChangeset):
         """
         Returns list of children changesets.
         """
-        rev_filter = settings.GIT_REV_FILTER
-        cmd = "rev-list %s --children | grep '^%s'" % (rev_filter, self.raw_id)
-        so, se = self.repository.run_git_command(cmd)
-
-        children = []
-        for l in so.splitlines():
-            childs = l.split(' ')[1:]
-            children.extend(childs)
-        return [self.repository.get_changeset(cs) for cs in children]
+        repository = self.repository
+        index = repository._revision_index
+        if repository.revisions is index.revisions:
+            return [repository.get_changeset(repository.revisions[pos])
+                    for pos in index.get_children(self.revision)]
+        # revisions have been injected; children are among commits not
+        # reachable from this one
+        walker = GitCommitWalker(self.repository,
+            self.repository._get_rev_filter_tips(), exclude=[self.raw_id],
+            reverse=True)
+        return [self.repository.get_changeset(commit.id)
+                for commit in walker.iter_commits()
+                if self.raw_id in commit.parents]
 
     def next(self, branch=None):
-
-        if branch and self.branch != branch:
-            raise VCSError('Branch option used on changeset not belonging '
-                           'to that branch')
-
-        def _next(changeset, branch):
-            try:
-                next_ = changeset.revision + 1
-                next_rev = changeset.repository.revisions[next_]
-            except IndexError:
-                raise ChangesetDoesNotExistError
-            cs = changeset.repository.get_changeset(next_rev)
-
-            if branch and branch != cs.branch:
-                return _next(cs, branch)
-
-            return cs
-
-        return _next(self, branch)
+        if branch:
+            bits = self._get_branch_bits(branch)
+            pos = get_next_position(bits, self.revision)
+        else:
+            pos = self.revision + 1
+        if pos is None or pos >= len(self.repository.revisions):
+            raise ChangesetDoesNotExistError
+        return self.repository.get_changeset(self.repository.revisions[pos])
 
     def prev(self, branch=None):
-        if branch and self.branch != branch:
+        if branch:
+            bits = self._get_branch_bits(branch)
+            pos = get_prev_position(bits, self.revision)
+        else:
+            pos = self.revision - 1
+        if pos is None or pos < 0:
+            raise ChangesetDoesNotExistError
+        return self.repository.get_changeset(self.repository.revisions[pos])
+
+    def _get_branch_bits(self, branch):
+        bits = self.repository._get_branch_bits(branch)
+        if not bits >> self.revision & 1:
             raise VCSError('Branch option used on changeset not belonging '
                            'to that branch')
-
-        def _prev(changeset, branch):
-            try:
-                prev_ = changeset.revision - 1
-                if prev_ < 0:
-                    raise IndexError
-                prev_rev = changeset.repository.revisions[prev_]
-            except IndexError:
-                raise ChangesetDoesNotExistError
-
-            cs = changeset.repository.get_changeset(prev_rev)
-
-            if branch and branch != cs.branch:
-                return _prev(cs, branch)
-
-            return cs
-
-        return _prev(self, branch)
+        return bits
 
     def diff(self, ignore_whitespace=True, context=3):
         rev1 = self.parents[0] if self.parents else self.repository.EMPTY_CHANGESET
         rev2 = self
-        return ''.join(self.repository.get_diff(rev1, rev2,
-                                    ignore_whitespace=ignore_whitespace,
-                                    context=context))
+        return self.repository.get_diff(rev1, rev2,
+                                        ignore_whitespace=ignore_whitespace,
+                                        context=context)
 
     def get_file_mode(self, path):
         """
         Returns stat mode of the file at the given ``path``.
         """
-        # ensure path is traversed
-        self._get_id_for_path(path)
-        return self._stat_modes[path]
+        return self._get_tree_entry(path)[0]
 
     def get_file_content(self, path):
         """
         Returns content of the file at given ``path``.
         """
         id = self._get_id_for_path(path)
-        blob = self.repository._repo[id]
-        return blob.as_pretty_string()
+        return self.repository._get_object_content(id)
 
     def get_file_size(self, path):
         """
         Returns size of the file at given ``path``.
         """
         id = self._get_id_for_path(path)
-        blob = self.repository._repo[id]
-        return blob.raw_length()
+        return self.repository._get_object_info(id)[1]
 
     def get_file_changeset(self, path):
         """
@@ -278,83 +241,210 @@ class GitChangeset(BaseChangeset):
         """
         return self.get_file_history(path, limit=1)[0]
 
+    def get_last_changesets(self, path):
+        """
+        Returns dictionary of paths of all nodes within the directory at the
+        given ``path`` mapped to the changesets which last changed them.
+        Results are cached by directory's tree and this changeset's id.
+        Paths are returned as ``str`` (utf-8 encoded), as paths of nodes are.
+        """
+        path = safe_str(path)
+        if self._get_kind(path) != NodeKind.DIR:
+            raise ChangesetError("Directory does not exist for revision %s at "
+                " '%s'" % (self.revision, path))
+        path = self._fix_path(path)
+        tree_id = self._get_id_for_path(path)
+        cache = self.repository._last_changes_cache
+        last_changes = cache.get((tree_id, self.raw_id))
+        if last_changes is None:
+            last_changes = self._get_last_changes(path, tree_id)
+            cache.set((tree_id, self.raw_id), last_changes)
+
+        changesets = {}
+        result = {}
+        for name, sha in last_changes.iteritems():
+            if sha not in changesets:
+                changesets[sha] = self.repository.get_changeset(sha)
+            result['/'.join((path, name)) if path else name] = changesets[sha]
+        return result
+
+    def _get_last_changes(self, path, tree_id):
+        """
+        Returns dictionary of names of entries of the tree with given
+        ``tree_id`` (which is at the given ``path``) mapped to ids of commits
+        which last changed them. History of every entry is simplified the way
+        ``git log -- <path>`` does it: a commit whose entry is the same as at
+        one of its parents is skipped and only that parent is followed, the
+        first commit whose entry differs from all its parents is the one
+        which last changed it. Commits are visited newest first, so entries
+        sharing history are resolved together.
+        """
+        tree_cache = self.repository._tree_cache
+        store = self.repository._repo.object_store
+
+        def get_commit(commit_id):
+            try:
+                return store[commit_id]
+            except KeyError:
+                # parent behind shallow clone's boundary
+                return None
+
+        def get_tree(commit):
+            dir_id = tree_cache.get_tree_id(commit.tree, path, store)
+            if dir_id is None:
+                return None, {}
+            return dir_id, tree_cache.get_entries(dir_id, store)
+
+        last_changes = {}
+        # names of entries whose history is followed through given commits
+        pending = {self.id: set(tree_cache.get_entries(tree_id, store))}
+        queue = [(-self._commit.commit_time, self.id, self._commit)]
+        while queue:
+            commit = heapq.heappop(queue)[2]
+            names = pending.pop(commit.id)
+            dir_id, entries = get_tree(commit)
+            parents = []
+            for parent_id in commit.parents:
+                parent = get_commit(parent_id)
+                if parent is not None:
+                    parents.append((parent, get_tree(parent)))
+            for name in names:
+                for parent, (parent_dir_id, parent_entries) in parents:
+                    if parent_dir_id == dir_id or \
+                            parent_entries.get(name) == entries.get(name):
+                        if parent.id not in pending:
+                            pending[parent.id] = set()
+                            heapq.heappush(queue, (-parent.commit_time,
+                                                   parent.id, parent))
+                        pending[parent.id].add(name)
+                        break
+                else:
+                    last_changes[name] = commit.id
+        return last_changes
+
     def get_file_history(self, path, limit=None):
         """
         Returns history of file as reversed list of ``Changeset`` objects for
         which file at given ``path`` has been modified.
-
-        TODO: This function now uses os underlying 'git' and 'grep' commands
-        which is generally not good. Should be replaced with algorithm
-        iterating commits.
         """
-        self._get_filectx(path)
-        cs_id = safe_str(self.id)
-        f_path = safe_str(path)
-
-        if limit:
-            cmd = 'log -n %s --pretty="format: %%H" -s -p %s -- "%s"' % (
-                      safe_int(limit, 0), cs_id, f_path
-                   )
+        return list(self.iter_file_history(path, limit=safe_int(limit, 0)
+                                           or None))
 
-        else:
-            cmd = 'log --pretty="format: %%H" -s -p %s -- "%s"' % (
-                      cs_id, f_path
-                   )
-        so, se = self.repository.run_git_command(cmd)
-        ids = re.findall(r'[0-9a-fA-F]{40}', so)
-        return [self.repository.get_changeset(id) for id in ids]
-
-    def get_file_history_2(self, path):
+    def iter_file_history(self, path, offset=0, limit=None, follow=False):
         """
-        Returns history of file as reversed list of ``Changeset`` objects for
-        which file at given ``path`` has been modified.
+        Returns iterator over ``Changeset`` objects (newest first) for which
+        file at given ``path`` has been modified. Commits are walked lazily
+        and compared by ids of file's blobs, so getting a page of history
+        does not depend on how long the whole history is.
 
+        :param offset: number of changesets to skip
+        :param limit: maximal number of changesets to return
+        :param follow: if ``True``, history is continued beyond renames
         """
         self._get_filectx(path)
-        from dulwich.walk import Walker
+        ids = self._iter_file_history(safe_str(path).strip('/'), follow)
+        if offset or limit is not None:
+            ids = islice(ids, offset,
+                         None if limit is None else offset + limit)
+        return imap(self.repository.get_changeset, ids)
+
+    def _iter_file_history(self, path, follow):
+        tree_cache = self.repository._tree_cache
+        store = self.repository._repo.object_store
         include = [self.id]
-        walker = Walker(self.repository._repo.object_store, include,
-                        paths=[path], max_entries=1)
-        return [self.repository.get_changeset(sha)
-                for sha in (x.commit.id for x in walker)]
+        while include:
+            walker = GitCommitWalker(self.repository, include, paths=[path])
+            include = None
+            for commit in walker.iter_commits():
+                yield commit.id
+                if not follow or not commit.parents:
+                    continue
+                parent = store[commit.parents[0]]
+                if tree_cache.get_entry(parent.tree, path, store) is not None:
+                    continue
+                # file has been added by this commit, check if it has been
+                # renamed
+                changes = self.repository._tree_changes_cache\
+                    .get_changes_with_renames(tree_cache, store, parent.tree,
+                                              commit.tree)
+                for change in changes:
+                    if change.type in (CHANGE_RENAME, CHANGE_COPY) \
+                            and change.new.path == path:
+                        path = change.old.path
+                        include = [parent.id]
+                        break
+                if include:
+                    break
 
     def get_file_annotate(self, path):
         """
         Returns a generator of four element tuples with
             lineno, sha, changeset lazy loader and line
 
-        TODO: This function now uses os underlying 'git' command which is
-        generally not good. Should be replaced with algorithm iterating
-        commits.
+        Output of ``git blame`` is processed as it is being produced and
+        complete annotation is cached (by file's blob id and changeset).
         """
-        cmd = 'blame -l --root -r %s -- "%s"' % (self.id, path)
-        # -l     ==> outputs long shas (and we need all 40 characters)
-        # --root ==> doesn't put '^' character for bounderies
-        # -r sha ==> blames for the given revision
-        so, se = self.repository.run_git_command(cmd)
+        path = self._get_filectx(path)
+        return iter_annotate(self, path,
+                             lambda: self._iter_blame_records(path))
+
+    def _get_annotate_key(self, path):
+        path = self._get_filectx(path)
+        return self._get_id_for_path(path), self.raw_id
 
-        for i, blame_line in enumerate(so.split('\n')[:-1]):
-            ln_no = i + 1
-            sha, line = re.split(r' ', blame_line, 1)
-            yield (ln_no, sha, lambda: self.repository.get_changeset(sha), line)
+    def _iter_blame_records(self, path):
+        """
+        Yields ``(sha, line)`` records of the file at given ``path``, read
+        from ``git blame --porcelain`` output as it is being produced.
+        """
+        lines = split_lines(self.get_file_content(path))
+        cmd = ['blame', '--porcelain', '--root', self.raw_id, '--',
+               '"%s"' % path]
+        # --porcelain ==> outputs header with full sha and final line number
+        #                 for every line
+        # --root      ==> doesn't treat root commits as boundaries
+        chunks, _ = self.repository.run_git_command(cmd, _stream=True)
+        for header in iter_lines(chunks):
+            if header.startswith('\t'):
+                continue
+            fields = header.rstrip('\n').split(' ')
+            if len(fields) in (3, 4) and len(fields[0]) == 40 \
+                    and fields[2].isdigit():
+                yield fields[0], lines[int(fields[2]) - 1]
 
     def fill_archive(self, stream=None, kind='tgz', prefix=None,
-                     subrepos=False):
+                     subrepos=False, path='', level=None):
         """
         Fills up given stream.
 
+        Archive is written straight from the object store and compressed on
+        multiple threads (see ``vcs.utils.archivers``).
+
         :param stream: file like object.
-        :param kind: one of following: ``zip``, ``tgz`` or ``tbz2``.
+        :param kind: one of following: ``zip``, ``tar``, ``tgz`` or ``tbz2``.
             Default: ``tgz``.
         :param prefix: name of root directory in archive.
             Default is repository name and changeset's raw_id joined with dash
             (``repo-tip.<KIND>``).
         :param subrepos: include subrepos in this archive.
+        :param path: directory which contents are archived. Default is the
+            root directory.
+        :param level: compression level (0-9). Default is
+            ``ARCHIVE_COMPRESSION_LEVEL`` setting.
 
         :raise ImproperArchiveTypeError: If given kind is wrong.
         :raise VcsError: If given stream is None
+        :raise ChangesetError: If there is no directory at given path
 
         """
+        if stream is None:
+            raise VCSError('You need to pass in a valid stream for filling'
+                           ' with archival data')
+        self._fill_archive(stream, *self._prepare_archive(kind, prefix,
+            subrepos, path, level))
+
+    def _prepare_archive(self, kind='tgz', prefix=None, subrepos=False,
+                         path='', level=None):
         allowed_kinds = settings.ARCHIVE_SPECS.keys()
         if kind not in allowed_kinds:
             raise ImproperArchiveTypeError('Archive kind not supported use one'
@@ -366,68 +456,109 @@ class GitChangeset(BaseChangeset):
             raise VCSError("Prefix cannot start with leading slash")
         elif prefix.strip() == '':
             raise VCSError("Prefix cannot be empty")
+        prefix = safe_str(prefix)
 
-        if kind == 'zip':
-            frmt = 'zip'
-        else:
-            frmt = 'tar'
-        _git_path = settings.GIT_EXECUTABLE_PATH
-        cmd = '%s archive --format=%s --prefix=%s/ %s' % (_git_path,
-                                                frmt, prefix, self.raw_id)
-        if kind == 'tgz':
-            cmd += ' | gzip -9'
-        elif kind == 'tbz2':
-            cmd += ' | bzip2 -9'
+        if self._get_kind(path) != NodeKind.DIR:
+            raise ChangesetError("Directory does not exist for revision %s at "
+                " '%s'" % (self.revision, path))
+        tree_id = self._get_id_for_path(self._fix_path(path))
+        if level is None:
+            level = settings.ARCHIVE_COMPRESSION_LEVEL
 
-        if stream is None:
-            raise VCSError('You need to pass in a valid stream for filling'
-                           ' with archival data')
-        popen = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True,
-            cwd=self.repository.path)
-
-        buffer_size = 1024 * 8
-        chunk = popen.stdout.read(buffer_size)
-        while chunk:
-            stream.write(chunk)
-            chunk = popen.stdout.read(buffer_size)
-        # Make sure all descriptors would be read
-        popen.communicate()
-
-    def get_nodes(self, path):
+        def fill(stream):
+            archiver = get_archiver(kind, stream, prefix, self._timestamp,
+                                    level=level, comment=self.raw_id)
+            try:
+                self._fill_archiver(archiver, tree_id)
+            except:
+                archiver.abort()
+                raise
+            archiver.close()
+
+        # archives embed commit's id and time, so the tree alone does not
+        # identify them
+        key = ArchiveCache.get_key('git', self.raw_id, tree_id, kind, prefix,
+                                   level)
+        return key, fill
+
+    def _fill_archiver(self, archiver, tree_id):
+        """
+        Adds all entries of the tree with given ``tree_id`` to the
+        ``archiver`` (recursively, in the order ``git archive`` would add
+        them).
+        """
+        store = self.repository._repo.object_store
+        tree_cache = self.repository._tree_cache
+        archiver.add_dir('')
+
+        def iter_entries(prefix, tree_id):
+            entries = tree_cache.get_entries(tree_id, store)
+            # git sorts trees as if their names ended with slash
+            for name in sorted(entries, key=lambda name:
+                               S_ISDIR(entries[name][0]) and name + '/'
+                               or name):
+                mode, sha = entries[name]
+                yield prefix + name, mode, sha
+
+        stack = [iter_entries('', tree_id)]
+        while stack:
+            for path, mode, sha in stack[-1]:
+                if S_ISDIR(mode):
+                    archiver.add_dir(path)
+                    stack.append(iter_entries(path + '/', sha))
+                    break
+                elif objects.S_ISGITLINK(mode):
+                    # submodules are archived as empty directories
+                    archiver.add_dir(path)
+                elif S_ISLNK(mode):
+                    archiver.add_symlink(path, store[sha].as_raw_string())
+                else:
+                    archiver.add_file(path, store[sha].as_raw_string(),
+                                      executable=bool(mode & 0111))
+            else:
+                stack.pop()
+
+    def get_nodes(self, path, offset=0, limit=None):
         if self._get_kind(path) != NodeKind.DIR:
             raise ChangesetError("Directory does not exist for revision %s at "
                 " '%s'" % (self.revision, path))
         path = self._fix_path(path)
         id = self._get_id_for_path(path)
-        tree = self.repository._repo[id]
-        dirnodes = []
-        filenodes = []
-        als = self.repository.alias
-        for name, stat, id in tree.iteritems():
+        entries = self.repository._tree_cache.get_entries(id,
+            self.repository._repo.object_store)
+        # kind of every entry is known from its mode, so objects are never
+        # read here and nodes are created only for the requested page
+        items = []
+        for name, (stat, id) in entries.iteritems():
             if objects.S_ISGITLINK(stat):
-                dirnodes.append(SubModuleNode(name, url=None, changeset=id,
-                                              alias=als))
-                continue
-
-            obj = self.repository._repo.get_object(id)
+                kind = NodeKind.SUBMODULE
+            elif S_ISDIR(stat):
+                kind = NodeKind.DIR
+            else:
+                kind = NodeKind.FILE
+            items.append((kind, safe_unicode(name), name, stat, id))
+        items.sort()
+        if limit is not None:
+            items = items[offset:offset + limit]
+        elif offset:
+            items = items[offset:]
+
+        nodes = []
+        als = self.repository.alias
+        for kind, _, name, stat, id in items:
             if path != '':
                 obj_path = '/'.join((path, name))
             else:
                 obj_path = name
-            if obj_path not in self._stat_modes:
-                self._stat_modes[obj_path] = stat
-            if isinstance(obj, objects.Tree):
-                dirnodes.append(DirNode(obj_path, changeset=self))
-            elif isinstance(obj, objects.Blob):
-                filenodes.append(FileNode(obj_path, changeset=self, mode=stat))
+            if kind == NodeKind.SUBMODULE:
+                node = SubModuleNode(name, url=None, changeset=id, alias=als)
+            elif kind == NodeKind.DIR:
+                node = DirNode(obj_path, changeset=self)
             else:
-                raise ChangesetError("Requested object should be Tree "
-                                     "or Blob, is %r" % type(obj))
-        nodes = dirnodes + filenodes
-        for node in nodes:
+                node = FileNode(obj_path, changeset=self, mode=stat)
+            nodes.append(node)
             if not node.path in self.nodes:
                 self.nodes[node.path] = node
-        nodes.sort()
         return nodes
 
     def get_node(self, path):
@@ -436,27 +567,24 @@ class GitChangeset(BaseChangeset):
         path = self._fix_path(path)
         if not path in self.nodes:
             try:
-                id_ = self._get_id_for_path(path)
+                mode, id_ = self._get_tree_entry(path)
             except ChangesetError:
                 raise NodeDoesNotExistError("Cannot find one of parents' "
                     "directories for a given path: %s" % path)
 
-            _GL = lambda m: m and objects.S_ISGITLINK(m)
-            if _GL(self._stat_modes.get(path)):
+            if mode and objects.S_ISGITLINK(mode):
                 node = SubModuleNode(path, url=None, changeset=id_,
                                      alias=self.repository.alias)
             else:
-                obj = self.repository._repo.get_object(id_)
+                type_name = self.repository._get_object_info(id_)[0]
 
-                if isinstance(obj, objects.Tree):
+                if type_name == objects.Tree.type_name:
                     if path == '':
                         node = RootNode(changeset=self)
                     else:
                         node = DirNode(path, changeset=self)
-                    node._tree = obj
-                elif isinstance(obj, objects.Blob):
+                elif type_name == objects.Blob.type_name:
                     node = FileNode(path, changeset=self)
-                    node._blob = obj
                 else:
                     raise NodeDoesNotExistError("There is no file nor directory "
                         "at the given path '%s' at revision %s"
@@ -489,25 +617,44 @@ class GitChangeset(BaseChangeset):
         modified = set()
         deleted = set()
         _r = self.repository._repo
+        tree_cache = self.repository._tree_cache
 
-        parents = self.parents
-        if not self.parents:
-            parents = [EmptyChangeset()]
+        parents = self._commit.parents or [None]
         for parent in parents:
-            if isinstance(parent, EmptyChangeset):
-                oid = None
-            else:
-                oid = _r[parent.raw_id].tree
-            changes = _r.object_store.tree_changes(oid, _r[self.raw_id].tree)
-            for (oldpath, newpath), (_, _), (_, _) in changes:
-                if newpath and oldpath:
-                    modified.add(newpath)
-                elif newpath and not oldpath:
-                    added.add(newpath)
-                elif not newpath and oldpath:
-                    deleted.add(oldpath)
+            oid = parent and _r[parent].tree
+            changes = self.repository._tree_changes_cache.get_changes(
+                tree_cache, _r.object_store, oid, self._commit.tree)
+            for change in changes:
+                if change.type == CHANGE_MODIFY:
+                    modified.add(change.new.path)
+                elif change.type == CHANGE_ADD:
+                    added.add(change.new.path)
+                else:
+                    deleted.add(change.old.path)
         return added, modified, deleted
 
+    def get_renames(self, threshold=RENAME_THRESHOLD, copies=False):
+        """
+        Returns list of tuples ``(old path, new path)`` of files renamed (or
+        copied) by this changeset, compared to its first parent, sorted by
+        new path.
+
+        :param threshold: minimal similarity (in percents) of contents of
+          removed and added file for them to be considered renamed
+        :param copies: if ``True``, files copied from unchanged ones are
+          detected as well (which requires all files to be compared)
+        """
+        _r = self.repository._repo
+        parent = self._commit.parents and self._commit.parents[0]
+        changes = self.repository._tree_changes_cache\
+            .get_changes_with_renames(self.repository._tree_cache,
+                _r.object_store, parent and _r[parent].tree,
+                self._commit.tree, threshold, copies)
+        return sorted([(change.old.path, change.new.path)
+                       for change in changes
+                       if change.type in (CHANGE_RENAME, CHANGE_COPY)],
+                      key=lambda paths: paths[1])
+
     def _get_paths_for_status(self, status):
         """
         Returns sorted list of paths for given ``status``.
@@ -550,3 +697,4 @@ class GitChangeset(BaseChangeset):
             return []
         return RemovedFileNodesGenerator([n for n in
                                 self._get_paths_for_status('deleted')], self)
+
@@ -0,0 +1,267 @@
+"""
+Executors limiting number of git commands run at once.
+
+Every git command run by the backend takes a slot of the executor of its
+repository (kept at repository's handle) and of the global executor shared
+by all repositories. If there is no free slot, command waits in a queue;
+waiting commands are started in the order they have come. If the slot is not
+free within ``GIT_COMMAND_QUEUE_TIMEOUT`` seconds, ``CommandQueueTimeoutError``
+is raised.
+
+Commands with streamed output keep their slots until their output is read
+entirely or closed. Slots are held per thread: further commands run by a
+thread holding a slot (e.g. while it reads a streamed output) reuse it
+instead of waiting for another one, so they are not limited either. Slot of
+a stream passed to another thread stays with the thread which has started
+the command; such streams should be read or closed promptly.
+
+Executors also build environment of commands: each command gets its own copy
+of ``os.environ`` (which is never modified) with executor's and call's
+variables applied.
+"""
+from __future__ import with_statement
+
+import os
+import time
+import threading
+from collections import deque
+
+from vcs.conf import settings
+
+
+class CommandQueueTimeoutError(EnvironmentError):
+    """
+    Raised if git command has not got a free slot of an executor in time.
+    """
+
+
+class FairSemaphore(object):
+    """
+    Semaphore with given number of slots, handing released slots to waiting
+    threads in the order they have started waiting.
+    """
+
+    def __init__(self, value):
+        self._value = value
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        """
+        Number of threads waiting for a slot.
+        """
+        return len(self._waiters)
+
+    def acquire(self, timeout=None):
+        """
+        Waits for a free slot at most ``timeout`` seconds (not limited if
+        ``None``). Returns ``True`` if the slot has been taken, ``False``
+        otherwise.
+        """
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return True
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        # set by ``release`` passing the slot over
+        waiter.wait(timeout)
+        with self._lock:
+            if waiter.isSet():
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self._value += 1
+
+
+class _Holder(object):
+    """
+    Slot of an executor held by a thread: number of commands using it and
+    parent executor with holder of its slot (if any).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.parent = None
+
+
+class GitCommandExecutor(object):
+    """
+    Limits number of git commands run at once to ``limit`` (not limited if
+    ``None``); commands take slots at the ``parent`` executor as well.
+
+    :param parent: executor or function returning it (called whenever a slot
+      is taken, so that it may change)
+    :param env: dictionary of environment variables set for all commands
+    """
+
+    def __init__(self, limit=None, parent=None, env=None):
+        self.limit = limit
+        self.parent = parent
+        self.env = env or {}
+        self._semaphore = limit and FairSemaphore(limit) or None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.running = 0
+        self.commands = 0
+        self.wait_time = 0.0
+
+    @property
+    def queued(self):
+        """
+        Number of commands waiting for a slot of this executor.
+        """
+        return self._semaphore and self._semaphore.waiting or 0
+
+    def get_parent(self):
+        """
+        Returns parent executor (or ``None``).
+        """
+        if callable(self.parent):
+            return self.parent()
+        return self.parent
+
+    def get_env(self, env=None):
+        """
+        Returns new environment dictionary for a command: copy of
+        ``os.environ`` without ``GIT_DIR``, with executor's variables and
+        given ``env`` applied.
+        """
+        result = dict(os.environ)
+        result.pop('GIT_DIR', None)
+        result['GIT_CONFIG_NOGLOBAL'] = '1'
+        result.update(self.env)
+        if env:
+            result.update(env)
+        return result
+
+    def acquire(self, timeout=None):
+        """
+        Waits for a free slot of this executor and then of its parent (at
+        most ``timeout`` seconds for each of them), unless current thread
+        already holds one. Records time spent waiting at ``wait_time`` (total
+        of all commands). Returns holder of the slot which should be passed
+        to ``release``.
+
+        :raises CommandQueueTimeoutError: if slot is not free in time
+        """
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = self._local.holder = _Holder()
+        with self._lock:
+            if holder.count:
+                holder.count += 1
+                self.commands += 1
+                return holder
+        start = time.time()
+        if self._semaphore is not None:
+            if not self._semaphore.acquire(timeout):
+                raise CommandQueueTimeoutError(
+                    'No free slot for git command in %s seconds '
+                    '(limit %d, %d commands waiting)'
+                    % (timeout, self.limit, self.queued))
+        parent = self.get_parent()
+        if parent is not None:
+            try:
+                holder.parent = parent, parent.acquire(timeout)
+            except:
+                if self._semaphore is not None:
+                    self._semaphore.release()
+                raise
+        with self._lock:
+            holder.count = 1
+            self.running += 1
+            self.commands += 1
+            self.wait_time += time.time() - start
+        return holder
+
+    def release(self, holder=None):
+        """
+        Frees slot taken by ``acquire`` (by current thread if ``holder`` is
+        not given).
+        """
+        if holder is None:
+            holder = self._local.holder
+        with self._lock:
+            holder.count -= 1
+            if holder.count:
+                return
+            self.running -= 1
+            parent, holder.parent = holder.parent, None
+        if parent is not None:
+            parent[0].release(parent[1])
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def stream(self, chunker, holder=None):
+        """
+        Returns iterator over output of given ``chunker`` which releases
+        the slot (of given ``holder``) once output ends or iterator is
+        closed.
+        """
+        if holder is None:
+            holder = self._local.holder
+        return StreamedCommand(chunker, lambda: self.release(holder))
+
+
+class StreamedCommand(object):
+    """
+    Iterator over output chunks of given ``chunker`` (other attributes are
+    taken from the chunker), calling ``release`` once output ends, reading
+    it fails or the iterator is closed.
+    """
+
+    def __init__(self, chunker, release):
+        self.chunker = chunker
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self.chunker, name)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self.chunker.next()
+        except:
+            self._done()
+            raise
+
+    def _done(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def close(self):
+        try:
+            self.chunker.close()
+        finally:
+            self._done()
+
+    def __del__(self):
+        self._done()
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns global ``GitCommandExecutor`` limited by
+    ``GIT_COMMAND_CONCURRENCY`` setting.
+    """
+    limit = settings.GIT_COMMAND_CONCURRENCY
+    with _executors_lock:
+        executor = _executors.get(limit)
+        if executor is None:
+            executor = _executors[limit] = GitCommandExecutor(limit)
+        return executor
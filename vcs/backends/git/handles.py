@@ -0,0 +1,174 @@
+"""
+Long lived ``dulwich`` repository handles.
+
+Constructing ``dulwich.repo.Repo`` means stat'ing control directory, reading
+graft files and, most importantly, starting with empty pack index and delta
+base caches. Handles defined here keep one ``Repo`` for each repository path,
+shared by all threads, and reopen it only when the repository has been
+changed on disk in a way ``dulwich`` would not notice itself (i.e.
+``packed-refs`` being rewritten or packs being repacked). At most
+``GIT_REPO_HANDLES`` handles are kept; least recently used ones are dropped
+(their idle ``git cat-file`` processes are stopped, while their ``Repo``
+objects are closed by garbage collection once nothing uses them).
+"""
+from __future__ import with_statement
+
+import os
+import threading
+
+from dulwich.object_store import DiskObjectStore
+from dulwich.repo import Repo
+
+from vcs.conf import settings
+from vcs.utils.lru import LRUCache
+
+
+class SharedObjectStore(DiskObjectStore):
+    """
+    ``DiskObjectStore`` which can be used by many threads at once. Packs
+    read objects seeking shared file objects (and update their caches), so
+    reads are serialized, as are updates of the cache of opened packs.
+    """
+
+    def __init__(self, path):
+        super(SharedObjectStore, self).__init__(path)
+        self._lock = threading.RLock()
+
+    @property
+    def packs(self):
+        with self._lock:
+            return super(SharedObjectStore, self).packs
+
+    def _update_pack_cache(self):
+        with self._lock:
+            return super(SharedObjectStore, self)._update_pack_cache()
+
+    def _add_known_pack(self, base_name, pack):
+        with self._lock:
+            super(SharedObjectStore, self)._add_known_pack(base_name, pack)
+
+    def get_raw(self, name):
+        with self._lock:
+            return super(SharedObjectStore, self).get_raw(name)
+
+    def close(self):
+        with self._lock:
+            super(SharedObjectStore, self).close()
+
+
+class GitRepoHandle(object):
+    """
+    Keeps ``dulwich.repo.Repo`` instance (shared by all threads) for a single
+    repository path. Objects stored at handle (such as caches set by the
+    backend) are shared by all ``GitRepository`` instances pointing at the
+    same path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._repo = None
+        self._stamp = None
+        self._lock = threading.Lock()
+        # ``GitRefsSnapshot`` of repository's refs and caches, maintained by
+        # the backend
+        self.refs_snapshot = None
+        self.tree_cache = None
+        self.last_changes_cache = None
+        self.tree_changes_cache = None
+        self.annotate_cache = None
+        # ``CatFilePool`` of ``git cat-file`` processes
+        self.cat_file_pool = None
+        # ``GitCommandExecutor`` running repository's git commands
+        self.executor = None
+
+    def _get_stamp(self, controldir):
+        """
+        Returns tuple of modification times of files which, if changed,
+        require the ``Repo`` to be reopened.
+        """
+        stamp = []
+        for name in ('packed-refs', os.path.join('objects', 'pack'),
+                     'shallow'):
+            try:
+                stamp.append(os.stat(os.path.join(controldir, name)).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    @property
+    def repo(self):
+        """
+        Returns ``Repo`` object, opening it if this is the first access or
+        repository has changed since it was opened.
+
+        :raises NotGitRepository: if there is no repository at handle's path
+        """
+        repo = self._repo
+        if repo is not None:
+            if self._get_stamp(repo.controldir()) == self._stamp:
+                return repo
+        with self._lock:
+            if self._repo is not repo:
+                # already reopened by another thread
+                return self._repo
+            repo = Repo(self.path)
+            self._set_repo(repo)
+            return repo
+
+    def set_repo(self, repo):
+        """
+        Stores given ``repo`` as the one to be used by all threads.
+        """
+        with self._lock:
+            self._set_repo(repo)
+
+    def _set_repo(self, repo):
+        if not isinstance(repo.object_store, SharedObjectStore):
+            repo.object_store = SharedObjectStore(repo.object_store.path)
+        # packed refs are cached by dulwich on first read; they are read
+        # before the repo is shared, so that no thread sees them half read
+        try:
+            repo.refs.get_packed_refs()
+        except StopIteration:
+            # empty packed-refs file, cached as no packed refs at all
+            pass
+        self._stamp = self._get_stamp(repo.controldir())
+        self._repo = repo
+
+    def invalidate(self):
+        """
+        Forces ``Repo`` to be reopened on next access.
+        """
+        self._repo = None
+
+    def close(self):
+        """
+        Stops idle ``git cat-file`` processes of the handle. ``Repo`` is not
+        closed, as other threads and repository objects may still use it; it
+        is closed by garbage collection once nothing refers to it.
+        """
+        if self.cat_file_pool is not None:
+            self.cat_file_pool.close()
+
+
+_handles = None
+_handles_lock = threading.Lock()
+
+
+def get_repo_handle(path):
+    """
+    Returns ``GitRepoHandle`` shared by all callers asking for the same
+    (absolute) ``path`` (as long as it is one of ``GIT_REPO_HANDLES`` most
+    recently used ones).
+    """
+    global _handles
+    with _handles_lock:
+        if _handles is None:
+            _handles = LRUCache(settings.GIT_REPO_HANDLES,
+                                evicted=GitRepoHandle.close)
+        _handles.size = settings.GIT_REPO_HANDLES
+        handle = _handles.get(path)
+        if handle is None:
+            handle = GitRepoHandle(path)
+            _handles.set(path, handle)
+        return handle
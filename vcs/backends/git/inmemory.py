@@ -151,9 +151,9 @@ class GitInMemoryChangeset(BaseInMemoryChangeset):
         repo.refs[ref] = commit.id
 
         # Update vcs repository object & recreate dulwich repo
-        self.repository.revisions.append(commit.id)
-        # invalidate parsed refs after commit
-        self.repository._parsed_refs = self.repository._get_parsed_refs()
+        self.repository._add_revision(commit, ref)
+        # take new snapshot of refs after commit
+        self.repository._refresh_refs()
         tip = self.repository.get_changeset()
         self.reset()
         return tip
@@ -0,0 +1,228 @@
+"""
+Snapshots of git repository's refs.
+
+Reading refs means listing ``refs/`` directory, reading every loose ref and
+``packed-refs`` file and peeling tags, so snapshot is built once and then
+shared (by all repository objects at the same path) until any of the files it
+has been built from changes. Files are not checked more often than once per
+given interval (refs changed by the backend itself are read immediately).
+
+Tags are peeled using values stored at ``packed-refs`` (written there by
+``git pack-refs`` and ``git gc``) whenever possible; the file is parsed once,
+by ``dulwich`` while reading refs. Only loose tags (and packed ones when the
+file has no peeled values) need their objects to be read. All lookups are
+computed while snapshot is built, so shared snapshot is never modified.
+"""
+from __future__ import with_statement
+
+import os
+import time
+
+from dulwich.objects import Tag
+
+from vcs.utils.ordered_dict import OrderedDict
+
+# prefixes of refs which are parsed, with their types
+REF_TYPES = [
+    ('refs/heads/', 'H'),
+    ('refs/remotes/origin/', 'RH'),
+    ('refs/tags/', 'T'),
+]
+
+# files modified less than this many seconds before snapshot was taken might
+# be modified again without their modification time changing (it has limited
+# resolution), so snapshot taken at such moment is rebuilt once this interval
+# passes
+RACY_INTERVAL = 2
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def get_refs_stamp(controldir):
+    """
+    Returns dictionary of paths which refs are read from (``HEAD``,
+    ``packed-refs`` and all directories within ``refs/``) mapped to their
+    modification times. Updating, adding or removing a loose ref always
+    changes modification time of the directory it is stored at.
+    """
+    stamp = {}
+    for name in ('HEAD', 'packed-refs'):
+        path = os.path.join(controldir, name)
+        stamp[path] = _get_mtime(path)
+    for root, dirs, files in os.walk(os.path.join(controldir, 'refs')):
+        stamp[root] = _get_mtime(root)
+    return stamp
+
+
+def has_peeled_packed_refs(controldir):
+    """
+    Returns ``True`` if ``packed-refs`` file exists and has been written with
+    peeled values of tags (only its header is read).
+    """
+    path = os.path.join(controldir, 'packed-refs')
+    try:
+        with open(path, 'rb') as f:
+            header = f.readline()
+    except IOError:
+        return False
+    return header.startswith('# pack-refs') and ' peeled' in header
+
+
+def peel_tag(store, sha):
+    """
+    Returns sha of the object tag with given ``sha`` (read from given object
+    ``store``) points at, following tags of tags.
+    """
+    obj = store[sha]
+    while isinstance(obj, Tag):
+        sha = obj.object[1]
+        obj = store[sha]
+    return sha
+
+
+class GitRefsSnapshot(object):
+    """
+    Immutable snapshot of repository's refs, together with lookups derived
+    from them. New snapshot is built whenever refs change and swapped with
+    the old one, so snapshot's attributes should never be modified.
+
+    **Attributes**
+
+        ``refs``
+            dictionary of all refs (name -> sha), as returned by ``dulwich``
+
+        ``parsed``
+            dictionary of short names of heads, remote heads of ``origin``
+            and tags mapped to lists ``[sha, type]`` (``H``, ``RH`` or ``T``
+            respectively); tags are peeled
+
+        ``branches``
+            ``OrderedDict`` of heads (name -> sha), sorted by name
+
+        ``tags``
+            ``OrderedDict`` of tags (name -> peeled sha), in reversed name
+            order
+
+        ``heads``
+            dictionary of names of heads and remote heads mapped to shas
+
+        ``heads_by_sha``
+            dictionary of shas mapped to names of heads pointing at them
+
+        ``tags_by_sha``
+            dictionary of shas mapped to lists of names of tags pointing at
+            them (in the same order as at ``tags``)
+
+        ``peeled``
+            dictionary of tags' shas mapped to shas of objects they point at
+
+    :param refs: dictionary of all refs
+    :param peel: callable returning sha of object the tag with given sha
+      points at; called only for tags not found at ``peeled``
+    :param peeled: dictionary of already known tags' shas mapped to shas of
+      objects they point at
+    :param stamp: result of ``get_refs_stamp`` taken before refs were read
+    :param racy: if ``True``, snapshot is considered stale once
+      ``RACY_INTERVAL`` passes since it was ``taken``
+    :param taken: time the ``stamp`` was taken at (now if not given)
+    """
+
+    def __init__(self, refs, peel, peeled=None, stamp=None, racy=False,
+                 taken=None):
+        self.refs = refs
+        self.stamp = stamp or {}
+        self.racy = racy
+        self.taken = taken or time.time()
+        # time files were last checked at; the only attribute modified after
+        # snapshot is built (by any thread, races are harmless)
+        self._checked = self.taken
+
+        # refs sorted by name, so that tags take precedence over heads with
+        # the same short name (as they do for git itself)
+        peeled = dict(peeled or {})
+        parsed = {}
+        heads = {}
+        branches = []
+        tags = []
+        for ref in sorted(refs):
+            for prefix, type_ in REF_TYPES:
+                if ref.startswith(prefix):
+                    name = ref[len(prefix):]
+                    sha = refs[ref]
+                    if type_ == 'T':
+                        if sha not in peeled:
+                            peeled[sha] = peel(sha)
+                        sha = peeled[sha]
+                        tags.append((name, sha))
+                    elif name != 'HEAD':
+                        heads[name] = sha
+                    if type_ == 'H':
+                        branches.append((name, sha))
+                    parsed[name] = [sha, type_]
+                    break
+        # tags' shas peeled by this snapshot, reused by the next one
+        self.peeled = peeled
+        self.parsed = parsed
+        self.heads = heads
+        self.heads_by_sha = dict((sha, name) for name, sha
+                                 in sorted(heads.iteritems(), reverse=True))
+        self.branches = OrderedDict(sorted(branches))
+        self.tags = OrderedDict(sorted(tags, reverse=True))
+        tags_by_sha = {}
+        for name, sha in self.tags.iteritems():
+            tags_by_sha.setdefault(sha, []).append(name)
+        self.tags_by_sha = tags_by_sha
+
+    @classmethod
+    def from_handle(cls, handle, previous=None):
+        """
+        Builds snapshot of refs of repository at the given ``GitRepoHandle``.
+        Tags peeled by ``previous`` snapshot are not peeled again.
+        """
+        repo = handle.repo
+        controldir = repo.controldir()
+        # stamp is taken first, so that refs changed while being read make
+        # snapshot stale
+        taken = time.time()
+        stamp = get_refs_stamp(controldir)
+        racy = any(mtime is not None and mtime >= taken - RACY_INTERVAL
+                   for mtime in stamp.itervalues())
+
+        refs = repo.get_refs()
+        peeled = {}
+        if previous is not None:
+            peeled.update(previous.peeled)
+        if has_peeled_packed_refs(controldir):
+            # values parsed by dulwich along with refs (tags overridden by
+            # loose ones are skipped)
+            packed = repo.refs.get_packed_refs()
+            for name, sha in refs.iteritems():
+                if name.startswith('refs/tags/') and packed.get(name) == sha:
+                    peeled[sha] = repo.refs.get_peeled(name)
+        store = repo.object_store
+        return cls(refs, lambda sha: peel_tag(store, sha), peeled, stamp,
+                   racy, taken)
+
+    def is_stale(self, interval=0):
+        """
+        Returns ``True`` if any of files refs have been read from has changed
+        since this snapshot was built (or snapshot is racy and
+        ``RACY_INTERVAL`` has passed since it was taken). Files are checked
+        at most once per ``interval`` seconds, snapshot is considered fresh
+        in between.
+        """
+        now = time.time()
+        if self.racy and now - self.taken > RACY_INTERVAL:
+            return True
+        if now - self._checked < interval:
+            return False
+        self._checked = now
+        for path, mtime in self.stamp.iteritems():
+            if _get_mtime(path) != mtime:
+                return True
+        return False
@@ -5,9 +5,9 @@ import time
 import urllib
 import urllib2
 import posixpath
-import string
+from array import array
+from itertools import izip
 
-from dulwich.objects import Tag
 from dulwich.repo import Repo, NotGitRepository
 
 from vcs import subprocessio
@@ -19,21 +19,67 @@ from vcs.exceptions import (
     RepositoryError, TagAlreadyExistError, TagDoesNotExistError
 )
 from vcs.utils import safe_unicode, makedate, date_fromtimestamp
+from vcs.utils.blame import AnnotateCache
+from vcs.utils.diffs import iter_file_diffs
 from vcs.utils.lazy import LazyProperty
-from vcs.utils.ordered_dict import OrderedDict
+from vcs.utils.lru import LRUCache
+from vcs.utils.metadata import ChangesetsMetadata, get_summary
 from vcs.utils.paths import abspath, get_user_home
+from vcs.utils.revisions import (
+    RevisionDates, filter_positions, make_bitset
+)
 
 from vcs.utils.hgcompat import (
     hg_url, httpbasicauthhandler, httpdigestauthhandler
 )
 
+from .catfile import CatFilePool
 from .changeset import GitChangeset
 from .config import ConfigFile
+from .executor import CommandQueueTimeoutError, GitCommandExecutor, \
+    get_executor
+from .handles import get_repo_handle
 from .inmemory import GitInMemoryChangeset
+from .bloom import (
+    MAX_PATHS, GitChangedPathsIndex, get_changed_paths,
+    get_index_path as get_changed_paths_index_path
+)
+from .refs import GitRefsSnapshot
+from .revindex import GitRevisionIndex, get_index_path
+from .trees import GitTreeCache, GitTreeChangesCache
+from .walker import GitCommitWalker, ORDER_DATE
 from .workdir import GitWorkdir
 
 SHA_PATTERN = re.compile(r'^[[0-9a-fA-F]{12}|[0-9a-fA-F]{40}]$')
 
+# refs selected by rev-list options which may be given at GIT_REV_FILTER
+REV_FILTER_PREFIXES = {
+    '--all': 'refs/',
+    '--branches': 'refs/heads/',
+    '--tags': 'refs/tags/',
+    '--remotes': 'refs/remotes/',
+}
+
+
+def _parse_commit(raw):
+    """
+    Returns tuple ``(author, commit time, message)`` of the commit with given
+    ``raw`` content (author and message are not decoded).
+    """
+    end = raw.find('\n\n')
+    if end == -1:
+        headers, message = raw, ''
+    else:
+        headers, message = raw[:end], raw[end + 2:]
+    author = ''
+    commit_time = 0
+    for line in headers.split('\n'):
+        if line.startswith('author '):
+            author = line[7:].rsplit(' ', 2)[0]
+        elif line.startswith('committer '):
+            commit_time = int(line[10:].rsplit(' ', 2)[1])
+    return author, commit_time, message
+
 
 class GitRepository(BaseRepository):
     """
@@ -46,7 +92,9 @@ class GitRepository(BaseRepository):
                  update_after_clone=False, bare=False):
 
         self.path = abspath(repo_path)
+        self._handle = get_repo_handle(self.path)
         repo = self._get_repo(create, src_url, update_after_clone, bare)
+        self._handle.set_repo(repo)
         self.bare = repo.bare
 
     @property
@@ -59,7 +107,126 @@ class GitRepository(BaseRepository):
 
     @property
     def _repo(self):
-        return Repo(self.path)
+        """
+        Returns ``dulwich.repo.Repo`` object shared by all repository objects
+        at the same path (within single thread). It is reopened only if
+        repository has been changed on disk.
+        """
+        return self._handle.repo
+
+    @property
+    def _tree_cache(self):
+        """
+        Returns ``GitTreeCache`` shared by all repository objects at the same
+        path.
+        """
+        handle = self._handle
+        if handle.tree_cache is None:
+            handle.tree_cache = GitTreeCache(settings.GIT_TREE_CACHE_SIZE)
+        return handle.tree_cache
+
+    @property
+    def _executor(self):
+        """
+        Returns ``GitCommandExecutor`` shared by all repository objects at
+        the same path, limited by ``GIT_REPOSITORY_COMMAND_CONCURRENCY``
+        setting (and global executor).
+        """
+        handle = self._handle
+        if handle.executor is None:
+            handle.executor = GitCommandExecutor(
+                settings.GIT_REPOSITORY_COMMAND_CONCURRENCY,
+                parent=get_executor)
+        return handle.executor
+
+    @property
+    def _cat_file_pool(self):
+        """
+        Returns ``CatFilePool`` shared by all repository objects at the same
+        path.
+        """
+        handle = self._handle
+        if handle.cat_file_pool is None:
+            handle.cat_file_pool = CatFilePool(self.path,
+                settings.GIT_CAT_FILE_PROCESSES)
+        return handle.cat_file_pool
+
+    def _get_object_content(self, sha):
+        """
+        Returns raw content of the object with given ``sha``, read by the
+        engine set at ``GIT_OBJECT_ENGINE`` setting.
+
+        :raises KeyError: if there is no such object
+        """
+        if settings.GIT_OBJECT_ENGINE == 'cat-file':
+            return self._cat_file_pool.get_object(sha)[1]
+        return self._repo[sha].as_raw_string()
+
+    def _get_object_info(self, sha):
+        """
+        Returns tuple ``(type name, size)`` of the object with given ``sha``,
+        read by the engine set at ``GIT_OBJECT_ENGINE`` setting.
+
+        :raises KeyError: if there is no such object
+        """
+        if settings.GIT_OBJECT_ENGINE == 'cat-file':
+            return self._cat_file_pool.get_info(sha)
+        obj = self._repo[sha]
+        return obj.type_name, obj.raw_length()
+
+    def _iter_objects_content(self, shas):
+        """
+        Yields tuples ``(type name, raw content)`` of objects with given
+        ``shas`` (``None`` for missing ones), read by the engine set at
+        ``GIT_OBJECT_ENGINE`` setting (requests are pipelined to a single
+        ``git cat-file`` process).
+        """
+        if settings.GIT_OBJECT_ENGINE == 'cat-file':
+            for response in self._cat_file_pool.iter_objects(shas):
+                yield response
+            return
+        for sha in shas:
+            try:
+                obj = self._repo[sha]
+            except KeyError:
+                yield None
+            else:
+                yield obj.type_name, obj.as_raw_string()
+
+    @property
+    def _tree_changes_cache(self):
+        """
+        Returns ``GitTreeChangesCache`` shared by all repository objects at
+        the same path.
+        """
+        handle = self._handle
+        if handle.tree_changes_cache is None:
+            handle.tree_changes_cache = GitTreeChangesCache(
+                settings.GIT_TREE_CACHE_SIZE)
+        return handle.tree_changes_cache
+
+    @property
+    def _last_changes_cache(self):
+        """
+        Returns ``LRUCache`` of last commits of directories' entries, shared
+        by all repository objects at the same path.
+        """
+        handle = self._handle
+        if handle.last_changes_cache is None:
+            handle.last_changes_cache = LRUCache(
+                settings.GIT_TREE_CACHE_SIZE, weight=len)
+        return handle.last_changes_cache
+
+    @property
+    def _annotate_cache(self):
+        """
+        Returns ``AnnotateCache`` of files' annotations, shared by all
+        repository objects at the same path.
+        """
+        handle = self._handle
+        if handle.annotate_cache is None:
+            handle.annotate_cache = AnnotateCache(settings.ANNOTATE_CACHE_SIZE)
+        return handle.annotate_cache
 
     @property
     def head(self):
@@ -72,9 +239,68 @@ class GitRepository(BaseRepository):
     def revisions(self):
         """
         Returns list of revisions' ids, in ascending order.  Being lazy
-        attribute allows external tools to inject shas from cache.
+        attribute allows external tools to inject shas from cache (those
+        should be wrapped with ``RevisionList`` to keep lookups fast).
+        """
+        return self._revision_index.revisions
+
+    @LazyProperty
+    def _revision_index(self):
+        """
+        Returns ``GitRevisionIndex`` for this repository. If
+        ``settings.GIT_REVISION_INDEX`` is turned on, index is read from
+        repository's control directory and extended with commits reachable
+        from refs which have changed since it was written.
+        """
+        return self._get_revision_index()
+
+    @LazyProperty
+    def _revision_dates(self):
+        """
+        Returns ``RevisionDates`` with commit timestamps of ``revisions``.
         """
-        return self._get_all_revisions()
+        index = self._revision_index
+        if self.revisions is index.revisions:
+            return RevisionDates(index.timestamps)
+        # revisions have been injected
+        return RevisionDates(array('l', (self._repo[rev].commit_time
+                                         for rev in self.revisions)))
+
+    @LazyProperty
+    def _branch_bits(self):
+        """
+        Dictionary of branch names mapped to tuples (head, bitset of
+        positions of commits reachable from that head).
+        """
+        return {}
+
+    def _get_branch_bits(self, name):
+        """
+        Returns bitset of positions of commits reachable from the branch with
+        given ``name`` (``0`` if there is no such branch). If branch has moved
+        forward since last call, only newly reachable commits are visited.
+        """
+        head = self.branches.get(name)
+        if head is None:
+            return 0
+        cached_head, bits = self._branch_bits.get(name, (None, 0))
+        if cached_head == head:
+            return bits
+        index = self._revision_index
+        positions = self.revisions.positions
+        pos = positions.get(head)
+        if pos is None or self.revisions is not index.revisions:
+            # branch is not selected by rev filter or revisions have been
+            # injected, so index cannot be used
+            bits = make_bitset(positions[rev]
+                for rev in GitCommitWalker(self, [head]) if rev in positions)
+        else:
+            old_pos = positions.get(cached_head)
+            if old_pos is None or not index.is_ancestor(old_pos, pos):
+                bits = 0
+            bits = index.get_ancestors_bits(pos, bits)
+        self._branch_bits[name] = (head, bits)
+        return bits
 
     @classmethod
     def _run_git_command(cls, cmd, **opts):
@@ -83,7 +309,17 @@ class GitRepository(BaseRepository):
         (stdout, stderr).
 
         :param cmd: git command to be executed
-        :param opts: env options to pass into Subprocess command
+        :param opts: env options to pass into Subprocess command; if
+          ``_stream`` is given, stdout is not buffered and iterator of its
+          chunks (read as command produces them) is returned instead;
+          ``_max_output`` and ``_timeout`` override ``GIT_COMMAND_MAX_OUTPUT``
+          and ``GIT_COMMAND_TIMEOUT`` settings; ``_executor`` is
+          ``GitCommandExecutor`` command is run by (global one by default);
+          variables given at ``env`` are added to command's environment
+        :raises OutputLimitError: if command writes more output than allowed
+        :raises SubprocessTimeoutError: if command does not end in time
+        :raises CommandQueueTimeoutError: if command does not get a slot of
+          executor in ``GIT_COMMAND_QUEUE_TIMEOUT`` seconds
         """
 
         if '_bare' in opts:
@@ -96,17 +332,18 @@ class GitRepository(BaseRepository):
             #no exc on failure
             del opts['_safe']
             safe_call = True
+        stream = opts.pop('_stream', False)
+        max_output = opts.pop('_max_output', settings.GIT_COMMAND_MAX_OUTPUT)
+        timeout = opts.pop('_timeout', settings.GIT_COMMAND_TIMEOUT)
+        executor = opts.pop('_executor', None) or get_executor()
 
         _str_cmd = False
         if isinstance(cmd, basestring):
             cmd = [cmd]
             _str_cmd = True
 
-        gitenv = os.environ
-        # need to clean fix GIT_DIR !
-        if 'GIT_DIR' in gitenv:
-            del gitenv['GIT_DIR']
-        gitenv['GIT_CONFIG_NOGLOBAL'] = '1'
+        # GIT_DIR is removed from the copy of environment
+        gitenv = executor.get_env(opts.pop('env', None))
 
         _git_path = settings.GIT_EXECUTABLE_PATH
         cmd = [_git_path] + _copts + cmd
@@ -116,9 +353,24 @@ class GitRepository(BaseRepository):
             _opts = dict(
                 env=gitenv,
                 shell=False,
+                max_output=max_output,
+                timeout=timeout,
             )
             _opts.update(opts)
-            p = subprocessio.SubprocessIOChunker(cmd, **_opts)
+            if settings.GIT_COMMAND_ENGINE == 'select':
+                chunker = subprocessio.SelectIOChunker
+            else:
+                chunker = subprocessio.SubprocessIOChunker
+            holder = executor.acquire(settings.GIT_COMMAND_QUEUE_TIMEOUT)
+            try:
+                p = chunker(cmd, **_opts)
+            except:
+                executor.release(holder)
+                raise
+        except (subprocessio.OutputLimitError,
+                subprocessio.SubprocessTimeoutError,
+                CommandQueueTimeoutError):
+            raise
         except (EnvironmentError, OSError), err:
             tb_err = ("Couldn't run git command (%s).\n"
                       "Original error was:%s\n" % (cmd, err))
@@ -127,12 +379,18 @@ class GitRepository(BaseRepository):
             else:
                 raise RepositoryError(tb_err)
 
-        return ''.join(p.output), ''.join(p.error)
+        if stream:
+            p = executor.stream(p, holder)
+            return p, p.error
+        try:
+            return ''.join(p.output), ''.join(p.error)
+        finally:
+            executor.release(holder)
 
-    def run_git_command(self, cmd):
-        opts = {}
+    def run_git_command(self, cmd, **opts):
         if os.path.isdir(self.path):
-            opts['cwd'] = self.path
+            opts.setdefault('cwd', self.path)
+        opts.setdefault('_executor', self._executor)
         return self._run_git_command(cmd, **opts)
 
     @classmethod
@@ -204,22 +462,193 @@ class GitRepository(BaseRepository):
             raise RepositoryError(err)
 
     def _get_all_revisions(self):
-        # we must check if this repo is not empty, since later command
-        # fails if it is. And it's cheaper to ask than throw the subprocess
-        # errors
-        try:
-            self._repo.head()
-        except KeyError:
-            return []
+        return self._get_revision_index().revisions
 
+    def _get_rev_filter_prefixes(self):
+        """
+        Returns list of ref name prefixes selected by
+        ``settings.GIT_REV_FILTER`` or ``None`` if filter contains options
+        which cannot be expressed that way.
+        """
+        prefixes = []
+        for option in settings.GIT_REV_FILTER.split():
+            if option not in REV_FILTER_PREFIXES:
+                return None
+            prefixes.append(REV_FILTER_PREFIXES[option])
+        return prefixes
+
+    def _get_rev_filter_refs(self):
+        """
+        Returns dictionary of refs (name -> sha) selected by
+        ``settings.GIT_REV_FILTER`` or ``None`` if those cannot be determined
+        without running ``git rev-list``.
+        """
+        prefixes = self._get_rev_filter_prefixes()
+        if prefixes is None:
+            return None
+        refs = {}
+        for name, sha in self._refs.refs.iteritems():
+            if name.startswith(tuple(prefixes)) or (name == 'HEAD' and
+                    '--all' in settings.GIT_REV_FILTER.split()):
+                refs[name] = sha
+        return refs
+
+    @LazyProperty
+    def _changed_paths_index(self):
+        path = get_changed_paths_index_path(self._repo.controldir())
+        index = GitChangedPathsIndex.load(path)
+        if index is None or not index.matches(self.revisions):
+            index = GitChangedPathsIndex()
+        return index
+
+    def _get_changed_paths_index(self):
+        """
+        Returns ``GitChangedPathsIndex`` (with filters of at most
+        ``settings.GIT_CHANGED_PATHS_BATCH`` new revisions computed and saved
+        first) or ``None`` if ``settings.GIT_CHANGED_PATHS_INDEX`` is turned
+        off. Revisions without filters are walked without the index.
+        """
+        if not settings.GIT_CHANGED_PATHS_INDEX:
+            return None
+        return self.update_changed_paths_index(
+            settings.GIT_CHANGED_PATHS_BATCH)
+
+    def update_changed_paths_index(self, limit=None):
+        """
+        Computes filters of at most ``limit`` (all if ``None``) revisions
+        which have none yet, oldest first, and saves the changed-paths index.
+        Returns the index. May be called by maintenance jobs so that walks
+        never have to compute filters of many revisions.
+        """
+        index = self._changed_paths_index
+        revisions = self.revisions
+        end = len(revisions)
+        if limit is not None:
+            end = min(end, len(index) + limit)
+        if len(index) < end:
+            tree_cache = self._tree_cache
+            store = self._repo.object_store
+            for pos in xrange(len(index), end):
+                commit = store[revisions[pos]]
+                parent_tree = None
+                if commit.parents:
+                    try:
+                        parent_tree = store[commit.parents[0]].tree
+                    except KeyError:
+                        # parent behind shallow clone's boundary
+                        pass
+                index.append(commit.id, get_changed_paths(tree_cache, store,
+                    parent_tree, commit.tree, MAX_PATHS))
+            index.save(get_changed_paths_index_path(self._repo.controldir()))
+        return index
+
+    def _get_revision_index(self):
         rev_filter = settings.GIT_REV_FILTER
-        cmd = 'rev-list %s --reverse --date-order' % (rev_filter)
+        refs = self._get_rev_filter_refs()
+        persistent = settings.GIT_REVISION_INDEX and refs is not None
+        path = get_index_path(self._repo.controldir())
+
+        index = None
+        if persistent:
+            index = GitRevisionIndex.load(path)
+            if index is not None and index.rev_filter != rev_filter:
+                index = None
+            if index is not None and index.refs == refs:
+                return index
+            if index is not None:
+                index = self._update_revision_index(index, refs)
+        if index is None:
+            index = self._build_revision_index(rev_filter, refs)
+        if persistent:
+            index.save(path)
+        return index
+
+    def _get_rev_filter_tips(self):
+        """
+        Returns list of ids of commits (or tags) selected by
+        ``settings.GIT_REV_FILTER``.
+        """
+        refs = self._get_rev_filter_refs()
+        if refs is not None:
+            # same order git uses, so that commits with equal dates are
+            # listed the same way
+            names = sorted(refs, key=lambda name: (name != 'HEAD', name))
+            return [refs[name] for name in names]
         try:
-            so, se = self.run_git_command(cmd)
+            so, se = self.run_git_command('rev-parse %s'
+                                          % settings.GIT_REV_FILTER)
         except RepositoryError:
             # Can be raised for empty repositories
             return []
-        return so.splitlines()
+        return [line for line in so.split() if len(line) == 40]
+
+    def _build_revision_index(self, rev_filter, refs):
+        index = GitRevisionIndex(rev_filter, refs)
+        tips = self._get_rev_filter_tips()
+        for revision, parents, timestamp in self._walk_revisions(tips):
+            index.append(revision, parents, timestamp)
+        return index
+
+    def _update_revision_index(self, index, refs):
+        """
+        Extends given ``index`` with commits reachable from ``refs`` which
+        have been added or moved forward since the index was written. Returns
+        ``None`` if index cannot be updated this way (i.e. some ref has been
+        removed or rewound) and should be rebuilt. New commits are appended
+        after all indexed ones, even if they are older.
+        """
+        positions = index.revisions.positions
+        moved = []
+        for name, sha in index.refs.iteritems():
+            if refs.get(name) == sha:
+                continue
+            if name not in refs or sha not in positions:
+                return None
+            moved.append(name)
+
+        include = [sha for name, sha in refs.iteritems()
+                   if index.refs.get(name) != sha]
+        entries = self._walk_revisions(include, index.refs.values())
+        for revision, parents, timestamp in entries:
+            if revision not in positions:
+                index.append(revision, parents, timestamp)
+
+        for name in moved:
+            pos = positions.get(refs[name])
+            if pos is None or not index.is_ancestor(
+                    positions[index.refs[name]], pos):
+                return None
+        index.refs = refs
+        return index
+
+    def _walk_revisions(self, include, exclude=None):
+        """
+        Returns list of (id, parents, timestamp) tuples of commits reachable
+        from ``include`` but not from ``exclude``, in ascending date order.
+        """
+        walker = GitCommitWalker(self, include, exclude, order=ORDER_DATE,
+                                 reverse=True)
+        return [(commit.id, commit.parents, commit.commit_time)
+                for commit in walker.iter_commits()]
+
+    def _add_revision(self, commit, ref):
+        """
+        Adds given (newly created) ``commit``, which ``ref`` now points at,
+        to the revisions of this repository.
+        """
+        index = self._revision_index
+        if commit.id not in index.revisions:
+            index.append(commit.id, commit.parents, commit.commit_time)
+        prefixes = self._get_rev_filter_prefixes()
+        if prefixes is not None and (ref in index.refs
+                                     or ref.startswith(tuple(prefixes))):
+            index.refs[ref] = commit.id
+            if 'HEAD' in index.refs and \
+                    self._repo.refs.read_ref('HEAD') == 'ref: %s' % ref:
+                index.refs['HEAD'] = commit.id
+        if self.revisions is not index.revisions:
+            # revisions have been injected
+            self.revisions.append(commit.id)
 
     def _get_all_revisions2(self):
         #alternate implementation using dulwich
@@ -258,15 +687,27 @@ class GitRepository(BaseRepository):
             if _ref_revision:  # and _ref_revision[1] in ['H', 'RH', 'T']:
                 return _ref_revision[0]
 
-            _tags_shas = self.tags.values()
+            if revision in self.revisions:
+                return revision
+
             # maybe it's a tag ? we don't have them in self.revisions
-            if revision in _tags_shas:
-                return _tags_shas[_tags_shas.index(revision)]
+            if revision in self._refs.tags_by_sha:
+                return revision
 
-            elif not SHA_PATTERN.match(revision) or revision not in self.revisions:
+            elif not SHA_PATTERN.match(revision):
                 raise ChangesetDoesNotExistError("Revision %s does not exist "
                     "for this repository" % (revision))
 
+            # maybe it's an abbreviated id
+            matches = []
+            if len(revision) < 40 and hasattr(self.revisions,
+                                              'get_by_prefix'):
+                matches = self.revisions.get_by_prefix(revision)
+            if len(matches) != 1:
+                raise ChangesetDoesNotExistError("Revision %s does not exist "
+                    "for this repository" % (revision))
+            revision = matches[0]
+
         # Ensure we return full id
         if not SHA_PATTERN.match(str(revision)):
             raise ChangesetDoesNotExistError("Given revision %s not recognized"
@@ -340,23 +781,16 @@ class GitRepository(BaseRepository):
     def branches(self):
         if not self.revisions:
             return {}
-        sortkey = lambda ctx: ctx[0]
-        _branches = [(x[0], x[1][0])
-                     for x in self._parsed_refs.iteritems() if x[1][1] == 'H']
-        return OrderedDict(sorted(_branches, key=sortkey, reverse=False))
+        return self._refs.branches
 
-    @LazyProperty
+    @property
     def tags(self):
         return self._get_tags()
 
     def _get_tags(self):
         if not self.revisions:
             return {}
-
-        sortkey = lambda ctx: ctx[0]
-        _tags = [(x[0], x[1][0])
-                 for x in self._parsed_refs.iteritems() if x[1][1] == 'T']
-        return OrderedDict(sorted(_tags, key=sortkey, reverse=True))
+        return self._refs.tags
 
     def tag(self, name, user, revision=None, message=None, date=None,
             **kwargs):
@@ -378,8 +812,7 @@ class GitRepository(BaseRepository):
             changeset.raw_id)
         self._repo.refs["refs/tags/%s" % name] = changeset._commit.id
 
-        self._parsed_refs = self._get_parsed_refs()
-        self.tags = self._get_tags()
+        self._refresh_refs()
         return changeset
 
     def remove_tag(self, name, user, message=None, date=None):
@@ -398,47 +831,41 @@ class GitRepository(BaseRepository):
         tagpath = posixpath.join(self._repo.refs.path, 'refs', 'tags', name)
         try:
             os.remove(tagpath)
-            self._parsed_refs = self._get_parsed_refs()
-            self.tags = self._get_tags()
+            self._refresh_refs()
         except OSError, e:
             raise RepositoryError(e.strerror)
 
-    @LazyProperty
-    def _parsed_refs(self):
-        return self._get_parsed_refs()
-
-    def _get_parsed_refs(self):
-        # cache the property
-        _repo = self._repo
-        refs = _repo.get_refs()
-        keys = [('refs/heads/', 'H'),
-                ('refs/remotes/origin/', 'RH'),
-                ('refs/tags/', 'T')]
-        _refs = {}
-        for ref, sha in refs.iteritems():
-            for k, type_ in keys:
-                if ref.startswith(k):
-                    _key = ref[len(k):]
-                    if type_ == 'T':
-                        obj = _repo.get_object(sha)
-                        if isinstance(obj, Tag):
-                            sha = _repo.get_object(sha).object[1]
-                    _refs[_key] = [sha, type_]
-                    break
-        return _refs
+    @property
+    def _refs(self):
+        """
+        Returns ``GitRefsSnapshot`` of repository's refs. Snapshot is shared
+        by all repository objects pointing at the same path and rebuilt only
+        if refs have changed on disk since it was taken (which is checked at
+        most once per ``settings.GIT_REFS_CHECK_INTERVAL`` seconds).
+        """
+        snapshot = self._handle.refs_snapshot
+        if snapshot is None or snapshot.is_stale(
+                settings.GIT_REFS_CHECK_INTERVAL):
+            snapshot = self._refresh_refs()
+        return snapshot
 
-    def _heads(self, reverse=False):
-        refs = self._repo.get_refs()
-        heads = {}
+    def _refresh_refs(self):
+        """
+        Takes new snapshot of refs and swaps it with the shared one. Should be
+        called whenever refs are changed by the backend itself.
+        """
+        handle = self._handle
+        snapshot = GitRefsSnapshot.from_handle(handle, handle.refs_snapshot)
+        handle.refs_snapshot = snapshot
+        return snapshot
 
-        for key, val in refs.items():
-            for ref_key in ['refs/heads/', 'refs/remotes/origin/']:
-                if key.startswith(ref_key):
-                    n = key[len(ref_key):]
-                    if n not in ['HEAD']:
-                        heads[n] = val
+    @property
+    def _parsed_refs(self):
+        return self._refs.parsed
 
-        return heads if reverse else dict((y, x) for x, y in heads.iteritems())
+    def _heads(self, reverse=False):
+        refs = self._refs
+        return refs.heads if reverse else refs.heads_by_sha
 
     def get_changeset(self, revision=None):
         """
@@ -468,6 +895,10 @@ class GitRepository(BaseRepository):
         :param reverse: if ``True``, returned generator would be reversed
           (meaning that returned changesets would have descending date order)
 
+        ``start`` or ``end`` which exists but is not listed at ``revisions``
+        (i.e. commit reachable only from refs excluded by ``GIT_REV_FILTER``
+        setting) is ignored.
+
         :raise BranchDoesNotExistError: If given ``branch_name`` does not
             exist.
         :raise ChangesetDoesNotExistError: If changeset for given ``start`` or
@@ -477,52 +908,67 @@ class GitRepository(BaseRepository):
         if branch_name and branch_name not in self.branches:
             raise BranchDoesNotExistError("Branch '%s' not found" \
                                           % branch_name)
-        # %H at format means (full) commit hash, initial hashes are retrieved
-        # in ascending date order
-        cmd_template = 'log --date-order --reverse --pretty=format:"%H"'
-        cmd_params = {}
-        if start_date:
-            cmd_template += ' --since "$since"'
-            cmd_params['since'] = start_date.strftime('%m/%d/%y %H:%M:%S')
-        if end_date:
-            cmd_template += ' --until "$until"'
-            cmd_params['until'] = end_date.strftime('%m/%d/%y %H:%M:%S')
-        if branch_name:
-            cmd_template += ' $branch_name'
-            cmd_params['branch_name'] = branch_name
-        else:
-            rev_filter = settings.GIT_REV_FILTER
-            cmd_template += ' %s' % (rev_filter)
-
-        cmd = string.Template(cmd_template).safe_substitute(**cmd_params)
-        revs = self.run_git_command(cmd)[0].splitlines()
-        start_pos = 0
-        end_pos = len(revs)
-        if start:
-            _start = self._get_revision(start)
-            try:
-                start_pos = revs.index(_start)
-            except ValueError:
-                pass
-
+        start_pos = end_pos = None
+        if start is not None:
+            start_pos = self.revisions.get(self._get_revision(start))
         if end is not None:
-            _end = self._get_revision(end)
-            try:
-                end_pos = revs.index(_end)
-            except ValueError:
-                pass
-
-        if None not in [start, end] and start_pos > end_pos:
+            end_pos = self.revisions.get(self._get_revision(end))
+        if None not in [start_pos, end_pos] and start_pos > end_pos:
             raise RepositoryError('start cannot be after end')
 
-        if end_pos is not None:
-            end_pos += 1
+        since = until = None
+        if start_date:
+            since = time.mktime(start_date.timetuple())
+        if end_date:
+            until = time.mktime(end_date.timetuple())
+        positions = self._revision_dates.get_positions(since, until,
+                                                       start_pos or 0, end_pos)
+        if branch_name:
+            positions = filter_positions(self._get_branch_bits(branch_name),
+                                         positions)
+        revs = [self.revisions[pos] for pos in positions]
 
-        revs = revs[start_pos:end_pos]
         if reverse:
-            revs = reversed(revs)
+            revs.reverse()
         return CollectionGenerator(self, revs)
 
+    def get_changesets_metadata(self, revisions=None, messages=True):
+        """
+        Returns ``ChangesetsMetadata`` of changesets with given ``revisions``
+        (all changesets if ``None``), in the same order. Commits are read by
+        the engine set at ``GIT_OBJECT_ENGINE`` setting and parsed in place,
+        without creating ``GitChangeset`` objects. Dates are commit dates,
+        as at ``GitChangeset.date``.
+
+        :param revisions: iterable of full changesets' ids
+        :param messages: if ``False``, only summaries of messages are decoded
+          and kept
+
+        :raises ChangesetDoesNotExistError: if any of ``revisions`` could not
+          be found
+        """
+        if revisions is None:
+            revisions = self.revisions
+        revisions = list(revisions)
+        metadata = ChangesetsMetadata(messages)
+        objects = self._iter_objects_content(revisions)
+        try:
+            for raw_id, response in izip(revisions, objects):
+                try:
+                    position = self.revisions.index(raw_id)
+                except ValueError:
+                    response = None
+                if response is None or response[0] != 'commit':
+                    raise ChangesetDoesNotExistError("Revision %s does not "
+                        "exist for this repository" % raw_id)
+                author, commit_time, message = _parse_commit(response[1])
+                metadata.append(raw_id, position, safe_unicode(author),
+                    commit_time, safe_unicode(get_summary(message)),
+                    safe_unicode(message) if messages else None)
+        finally:
+            objects.close()
+        return metadata
+
     def get_diff(self, rev1, rev2, path=None, ignore_whitespace=False,
                  context=3):
         """
@@ -538,6 +984,36 @@ class GitRepository(BaseRepository):
         :param context: How many lines before/after changed lines should be
           shown. Defaults to ``3``.
         """
+        cmd = self._get_diff_command(rev1, rev2, path, ignore_whitespace,
+                                     context)
+        stdout, stderr = self.run_git_command(cmd)
+        # If we used 'show' command, strip first few lines (until actual diff
+        # starts)
+        if cmd.startswith('show '):
+            if not stdout.startswith('diff'):
+                start = stdout.find('\ndiff')
+                stdout = stdout[start + 1:] if start != -1 else ''
+            # Append new line just like 'diff' command do
+            if not stdout.endswith('\n'):
+                stdout += '\n'
+        return stdout
+
+    def iter_diff(self, rev1, rev2, path=None, ignore_whitespace=False,
+                  context=3, file_limit=None, total_limit=None):
+        """
+        Returns generator of patches of single files (as tuples ``(patch,
+        truncated)``) of the *diff* returned by ``get_diff`` with the same
+        arguments, yielded as ``git diff`` produces them. See
+        ``vcs.utils.diffs.iter_file_diffs`` for ``file_limit`` and
+        ``total_limit``.
+        """
+        cmd = self._get_diff_command(rev1, rev2, path, ignore_whitespace,
+                                     context)
+        chunks, _ = self.run_git_command(cmd, _stream=True)
+        return iter_file_diffs(chunks, file_limit, total_limit)
+
+    def _get_diff_command(self, rev1, rev2, path, ignore_whitespace,
+                          context):
         flags = ['-U%s' % context, '--full-index', '--binary', '-p', '-M', '--abbrev=40']
         if ignore_whitespace:
             flags.append('-w')
@@ -558,20 +1034,7 @@ class GitRepository(BaseRepository):
 
         if path:
             cmd += ' -- "%s"' % path
-
-        stdout, stderr = self.run_git_command(cmd)
-        # If we used 'show' command, strip first few lines (until actual diff
-        # starts)
-        if rev1 == self.EMPTY_CHANGESET:
-            lines = stdout.splitlines()
-            x = 0
-            for line in lines:
-                if line.startswith('diff'):
-                    break
-                x += 1
-            # Append new line just like 'diff' command do
-            stdout = '\n'.join(lines[x:]) + '\n'
-        return stdout
+        return cmd
 
     @LazyProperty
     def in_memory_changeset(self):
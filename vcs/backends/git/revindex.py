@@ -0,0 +1,339 @@
+"""
+Persistent revision index for git repositories.
+
+Index keeps ids of all commits (in the order ``git rev-list --reverse
+--date-order`` would list them), their parents (as positions within the
+index), commit timestamps and generation numbers. It is stored within
+repository's control directory and extended with new commits only, whenever
+refs it was written for have moved forward.
+
+New commits are appended after all indexed ones (ordered among themselves
+only), so that positions of indexed commits never change. Order of the
+extended index may therefore differ from the order of the index built from
+scratch, i.e. after a branch with commits older than the tip of the index has
+been pushed; ``revisions`` are in ascending date order only as long as the
+history grows forward.
+
+File format (all integers are stored in native byte order, which is checked
+on load along with item sizes)::
+
+    header:   MAGIC, version, byteorder, itemsizes, counts
+    filter:   rev filter the index has been built for
+    refs:     (20 bytes binary sha, ref name length, ref name) * refs count
+    ids:      20 bytes binary sha * commits count
+    arrays:   timestamps, generations, parent offsets, parent positions
+    trailer:  sha1 checksum of all of above
+
+File is always written under a lock file and renamed into place, so readers
+never see partially written index. Any file which cannot be verified is
+simply ignored (and rebuilt). Lock files older than ``STALE_LOCK_AGE``
+seconds are left behind by crashed processes and are removed.
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import struct
+import logging
+from array import array
+from binascii import hexlify, unhexlify
+from hashlib import sha1
+
+from dulwich.file import GitFile
+
+from vcs.utils.compat import bin
+from vcs.utils.revisions import RevisionList
+
+MAGIC = 'VCSRIDX\0'
+VERSION = 1
+INDEX_FILENAME = 'vcs-revindex'
+
+log = logging.getLogger(__name__)
+
+# writing the index takes few seconds at most, so older lock files have been
+# left behind by crashed processes
+STALE_LOCK_AGE = 300
+
+_HEADER = struct.Struct('=8sIBBBIIII')
+_REF_NAME_LEN = struct.Struct('=H')
+
+
+class GitRevisionIndex(object):
+    """
+    In-memory representation of the revision index.
+
+    **Attributes**
+
+        ``revisions``
+            ``RevisionList`` of commits' ids, in ascending order
+
+        ``timestamps``
+            commit times, aligned with ``revisions``
+
+        ``generations``
+            generation numbers (1 for root commits, otherwise one more than
+            maximal generation of the parents), aligned with ``revisions``
+
+        ``refs``
+            dictionary of refs (name -> sha) the index has been built for
+
+        ``rev_filter``
+            value of ``settings.GIT_REV_FILTER`` the index has been built for
+    """
+
+    def __init__(self, rev_filter, refs=None):
+        self.rev_filter = rev_filter
+        self.refs = refs or {}
+        self.revisions = RevisionList()
+        self.timestamps = array('l')
+        self.generations = array('i')
+        self._parent_offsets = array('i', [0])
+        self._parent_positions = array('i')
+        # children of commits known when they were first asked for are kept
+        # in the same layout as parents, children of commits appended later
+        # go to the dictionary
+        self._child_offsets = None
+        self._child_positions = None
+        self._extra_children = {}
+
+    def __len__(self):
+        return len(self.revisions)
+
+    def append(self, revision, parents, timestamp):
+        """
+        Appends commit with the given ``revision`` id, list of ``parents``'
+        ids and commit ``timestamp``. Parents not present at the index (i.e.
+        behind shallow clone's boundary) are skipped.
+        """
+        positions = self.revisions.positions
+        generation = 0
+        for parent in parents:
+            pos = positions.get(parent)
+            if pos is None:
+                continue
+            self._parent_positions.append(pos)
+            generation = max(generation, self.generations[pos])
+            if self._child_offsets is not None:
+                self._extra_children.setdefault(pos, []).append(len(self))
+        self._parent_offsets.append(len(self._parent_positions))
+        self.generations.append(generation + 1)
+        self.timestamps.append(int(timestamp))
+        self.revisions.append(revision)
+
+    def get_parents(self, pos):
+        """
+        Returns list of positions of parents of commit at given ``pos``.
+        """
+        offsets = self._parent_offsets
+        return self._parent_positions[offsets[pos]:offsets[pos + 1]].tolist()
+
+    def get_children(self, pos):
+        """
+        Returns list of positions of children of commit at given ``pos``.
+        """
+        if self._child_offsets is None:
+            self._build_children()
+        offsets = self._child_offsets
+        children = []
+        if pos + 1 < len(offsets):
+            children = self._child_positions[
+                offsets[pos]:offsets[pos + 1]].tolist()
+        return children + self._extra_children.get(pos, [])
+
+    def _build_children(self):
+        count = len(self)
+        parent_offsets = self._parent_offsets
+        parent_positions = self._parent_positions
+        offsets = array('i', [0]) * (count + 1)
+        for parent in parent_positions:
+            offsets[parent + 1] += 1
+        for pos in xrange(count):
+            offsets[pos + 1] += offsets[pos]
+        filled = array('i', offsets)
+        children = array('i', [0]) * len(parent_positions)
+        for pos in xrange(count):
+            for i in xrange(parent_offsets[pos], parent_offsets[pos + 1]):
+                parent = parent_positions[i]
+                children[filled[parent]] = pos
+                filled[parent] += 1
+        self._child_offsets = offsets
+        self._child_positions = children
+        self._extra_children = {}
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        Returns ``True`` if commit at position ``ancestor`` is reachable from
+        commit at position ``descendant``. Generation numbers are used to
+        avoid descending below ``ancestor``.
+        """
+        if ancestor == descendant:
+            return True
+        generations = self.generations
+        limit = generations[ancestor]
+        seen = set([descendant])
+        stack = [descendant]
+        while stack:
+            pos = stack.pop()
+            for parent in self.get_parents(pos):
+                if parent == ancestor:
+                    return True
+                if parent not in seen and generations[parent] > limit:
+                    seen.add(parent)
+                    stack.append(parent)
+        return False
+
+    def get_ancestors_bits(self, pos, known=0):
+        """
+        Returns bitset (``long`` with bits set at positions) of commit at
+        given ``pos`` and all of its ancestors. If ``known`` bitset of
+        ancestors of some ancestor of that commit is given, it is only
+        extended.
+        """
+        flags = array('c', bin(known)[:1:-1].ljust(pos + 1, '0'))
+        stack = [pos]
+        while stack:
+            pos = stack.pop()
+            if flags[pos] == '1':
+                continue
+            flags[pos] = '1'
+            stack.extend(self.get_parents(pos))
+        flags.reverse()
+        return long(flags.tostring(), 2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads index from the file at the given ``path``. Returns ``None`` if
+        file does not exist or cannot be used (is corrupted or was written by
+        incompatible version or platform).
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            return cls._parse(data)
+        except (struct.error, ValueError, EOFError, IndexError):
+            return None
+
+    @classmethod
+    def _parse(cls, data):
+        if len(data) < _HEADER.size + 20 or \
+                sha1(data[:-20]).digest() != data[-20:]:
+            raise ValueError('Index checksum mismatch')
+        (magic, version, byteorder, pos_size, ts_size, filter_len, refs_count,
+         count, parents_count) = _HEADER.unpack_from(data)
+        if (magic != MAGIC or version != VERSION
+            or byteorder != (sys.byteorder == 'little')
+            or pos_size != array('i').itemsize
+            or ts_size != array('l').itemsize):
+            raise ValueError('Index written by incompatible version')
+        offset = _HEADER.size
+        rev_filter = data[offset:offset + filter_len]
+        offset += filter_len
+
+        refs = {}
+        for i in xrange(refs_count):
+            sha = hexlify(data[offset:offset + 20])
+            offset += 20
+            name_len = _REF_NAME_LEN.unpack_from(data, offset)[0]
+            offset += _REF_NAME_LEN.size
+            refs[data[offset:offset + name_len]] = sha
+            offset += name_len
+
+        index = cls(rev_filter, refs)
+        ids = data[offset:offset + 20 * count]
+        offset += 20 * count
+        index.revisions = RevisionList(hexlify(ids[i:i + 20])
+                                       for i in xrange(0, len(ids), 20))
+
+        arrays = []
+        for typecode, length in (('l', count), ('i', count),
+                                 ('i', count + 1), ('i', parents_count)):
+            arr = array(typecode)
+            size = arr.itemsize * length
+            arr.fromstring(data[offset:offset + size])
+            offset += size
+            arrays.append(arr)
+        (index.timestamps, index.generations, index._parent_offsets,
+         index._parent_positions) = arrays
+        if offset != len(data) - 20:
+            raise ValueError('Index has unexpected size')
+        return index
+
+    def save(self, path):
+        """
+        Writes index into the file at the given ``path``. Returns ``False``
+        if index could not be written (i.e. other process is writing it at
+        the same time or repository is read only), ``True`` otherwise.
+        """
+        chunks = [_HEADER.pack(MAGIC, VERSION, sys.byteorder == 'little',
+            array('i').itemsize, array('l').itemsize, len(self.rev_filter),
+            len(self.refs), len(self.revisions), len(self._parent_positions)),
+            self.rev_filter]
+        for name, sha in sorted(self.refs.iteritems()):
+            chunks.extend([unhexlify(sha), _REF_NAME_LEN.pack(len(name)),
+                           name])
+        chunks.append(''.join(unhexlify(rev) for rev in self.revisions))
+        for arr in (self.timestamps, self.generations, self._parent_offsets,
+                    self._parent_positions):
+            chunks.append(arr.tostring())
+        return write_index_file(path, ''.join(chunks))
+
+
+def _remove_stale_lock(path):
+    """
+    Removes lock file of the file at given ``path`` if it is older than
+    ``STALE_LOCK_AGE``. Returns ``True`` if lock has been removed.
+    """
+    lock_path = path + '.lock'
+    try:
+        age = time.time() - os.stat(lock_path).st_mtime
+        if age < STALE_LOCK_AGE:
+            return False
+        os.remove(lock_path)
+    except OSError:
+        return False
+    log.warning("Removed stale lock file %s", lock_path)
+    return True
+
+
+def write_index_file(path, data):
+    """
+    Writes given ``data`` followed by its sha1 checksum into the file at
+    given ``path`` (under lock file, renamed into place). Returns ``False``
+    if file could not be written (i.e. other process is writing it at the
+    same time or repository is read only), ``True`` otherwise.
+
+    If stale lock file is removed while other process is still writing
+    (which is not expected), one of written files may be broken - readers
+    verify checksums, so such file would be ignored and rebuilt.
+    """
+    for retry in (False, True):
+        try:
+            # fails if lock file already exists
+            f = GitFile(path, 'wb')
+            break
+        except (IOError, OSError), err:
+            if retry or not _remove_stale_lock(path):
+                log.info("Couldn't write index %s: %s", path, err)
+                return False
+    try:
+        f.write(data)
+        f.write(sha1(data).digest())
+        f.close()
+    except (IOError, OSError), err:
+        f.abort()
+        log.warning("Couldn't write index %s: %s", path, err)
+        return False
+    return True
+
+
+def get_index_path(controldir):
+    """
+    Returns path of the revision index file for the given git control
+    directory.
+    """
+    return os.path.join(controldir, INDEX_FILENAME)
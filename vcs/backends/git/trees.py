@@ -0,0 +1,198 @@
+"""
+Caches of parsed git trees and of differences between them.
+
+Consecutive commits share nearly all of their trees, so entries of parsed
+trees are kept at one cache per repository (stored at repository's handle)
+rather than at every changeset. Trees are immutable, hence cache is keyed by
+tree's sha and never needs to be invalidated. The same holds for changes
+between two trees, which are cached by pair of trees' shas.
+"""
+from stat import S_ISDIR
+
+from dulwich.diff_tree import (
+    CHANGE_MODIFY, RENAME_THRESHOLD, RenameDetector, TreeChange
+)
+from dulwich.errors import NotTreeError
+from dulwich.objects import Tree, TreeEntry
+
+from vcs.utils.lru import LRUCache
+
+
+class GitTreeCache(LRUCache):
+    """
+    Least recently used cache of trees' entries. Cache is thread safe.
+
+    :param size: maximal number of entries (of all cached trees together)
+      kept at the cache; trees with more entries are never cached
+    """
+
+    def __init__(self, size):
+        super(GitTreeCache, self).__init__(size, weight=len)
+
+    def get_entries(self, tree_id, store):
+        """
+        Returns dictionary of names of entries of the tree with given
+        ``tree_id`` mapped to tuples ``(mode, sha)``. Tree is read from the
+        given object ``store`` if it has not been cached yet.
+
+        :raises KeyError: if there is no object with given ``tree_id``
+        :raises NotTreeError: if object with given ``tree_id`` is not a tree
+        """
+        entries = self.get(tree_id)
+        if entries is None:
+            tree = store[tree_id]
+            if not isinstance(tree, Tree):
+                raise NotTreeError(tree_id)
+            entries = dict((name, (mode, sha))
+                           for name, mode, sha in tree.iteritems())
+            self.set(tree_id, entries)
+        return entries
+
+    def get_entry(self, root_id, path, store):
+        """
+        Returns tuple ``(mode, sha)`` of the entry at the given (non empty)
+        ``path`` within the tree with given ``root_id`` or ``None`` if there
+        is no such entry.
+        """
+        splitted = path.strip('/').split('/')
+        tree_id = root_id
+        for name in splitted[:-1]:
+            entry = self.get_entries(tree_id, store).get(name)
+            if entry is None or not S_ISDIR(entry[0]):
+                return None
+            tree_id = entry[1]
+        return self.get_entries(tree_id, store).get(splitted[-1])
+
+    def get_tree_id(self, root_id, path, store):
+        """
+        Returns sha of the tree at the given ``path`` within the tree with
+        given ``root_id`` or ``None`` if there is no directory at that path.
+        """
+        if not path.strip('/'):
+            return root_id
+        entry = self.get_entry(root_id, path, store)
+        if entry is None or not S_ISDIR(entry[0]):
+            return None
+        return entry[1]
+
+
+def diff_trees(tree_cache, store, old_id, new_id):
+    """
+    Returns tuple of ``TreeChange`` objects (``add``, ``delete`` and
+    ``modify`` ones, sorted by path) of files which differ between trees
+    with ids ``old_id`` and ``new_id`` (any of them may be ``None``). Trees
+    are read through given ``tree_cache`` and subtrees with the same sha at
+    both sides are never descended into.
+    """
+    changes = []
+    stack = [('', old_id, new_id)]
+    while stack:
+        prefix, old_id, new_id = stack.pop()
+        old = old_id and tree_cache.get_entries(old_id, store) or {}
+        new = new_id and tree_cache.get_entries(new_id, store) or {}
+        for name in set(old).union(new):
+            old_entry, new_entry = old.get(name), new.get(name)
+            if old_entry == new_entry:
+                continue
+            path = prefix + name
+            old_dir = old_entry is not None and S_ISDIR(old_entry[0])
+            new_dir = new_entry is not None and S_ISDIR(new_entry[0])
+            if old_dir or new_dir:
+                stack.append((path + '/', old_dir and old_entry[1] or None,
+                              new_dir and new_entry[1] or None))
+            old_file = old_entry is not None and not old_dir
+            new_file = new_entry is not None and not new_dir
+            if old_file and new_file:
+                changes.append(TreeChange(CHANGE_MODIFY,
+                    TreeEntry(path, *old_entry), TreeEntry(path, *new_entry)))
+            elif old_file:
+                changes.append(TreeChange.delete(TreeEntry(path, *old_entry)))
+            elif new_file:
+                changes.append(TreeChange.add(TreeEntry(path, *new_entry)))
+    changes.sort(key=lambda change: (change.new.path or change.old.path))
+    return tuple(changes)
+
+
+# dulwich's RenameDetector reads changes between trees itself and has no
+# public way to be given them, so _CachedRenameDetector overrides its private
+# ``_collect_changes`` method and feeds changes through private ``_add_change``
+# one (both present as of dulwich 0.10). If they are missing, plain
+# RenameDetector is used.
+_CAN_FEED_CHANGES = (hasattr(RenameDetector, '_collect_changes')
+                     and hasattr(RenameDetector, '_add_change'))
+
+
+class _CachedRenameDetector(RenameDetector):
+    """
+    Rename detector taking changes between trees from the cache. It must not
+    be used to find copies harder (unchanged files are not cached).
+    """
+
+    def __init__(self, changes_cache, tree_cache, store, **kwargs):
+        super(_CachedRenameDetector, self).__init__(store, **kwargs)
+        self._changes_cache = changes_cache
+        self._tree_cache = tree_cache
+        self._cached_store = store
+
+    def _collect_changes(self, tree1_id, tree2_id):
+        for change in self._changes_cache.get_changes(self._tree_cache,
+                self._cached_store, tree1_id, tree2_id):
+            self._add_change(change)
+
+
+def _get_rename_detector(changes_cache, tree_cache, store, threshold,
+                         copies):
+    """
+    Returns rename detector taking changes from ``changes_cache`` if
+    possible, plain ``RenameDetector`` otherwise.
+    """
+    if copies or not _CAN_FEED_CHANGES:
+        return RenameDetector(store, rename_threshold=threshold,
+                              find_copies_harder=copies)
+    return _CachedRenameDetector(changes_cache, tree_cache, store,
+                                 rename_threshold=threshold)
+
+
+class GitTreeChangesCache(LRUCache):
+    """
+    Least recently used cache of changes between pairs of trees. Cache is
+    thread safe.
+
+    :param size: maximal number of changes (of all cached pairs together)
+      kept at the cache
+    """
+
+    def __init__(self, size):
+        super(GitTreeChangesCache, self).__init__(size, weight=len)
+
+    def get_changes(self, tree_cache, store, old_id, new_id):
+        """
+        Returns changes between trees with ids ``old_id`` and ``new_id`` (as
+        returned by ``diff_trees``).
+        """
+        key = (old_id, new_id)
+        changes = self.get(key)
+        if changes is None:
+            changes = diff_trees(tree_cache, store, old_id, new_id)
+            self.set(key, changes)
+        return changes
+
+    def get_changes_with_renames(self, tree_cache, store, old_id, new_id,
+                                 threshold=RENAME_THRESHOLD, copies=False):
+        """
+        Returns changes between trees with ids ``old_id`` and ``new_id``
+        with renames (and copies) detected, as ``TreeChange`` objects.
+
+        :param threshold: minimal similarity (in percents) of contents of
+          added and removed files for them to be considered renamed
+        :param copies: if ``True``, unchanged files are considered as
+          sources of copies as well
+        """
+        key = (old_id, new_id, threshold, copies)
+        changes = self.get(key)
+        if changes is None:
+            detector = _get_rename_detector(self, tree_cache, store,
+                                            threshold, copies)
+            changes = tuple(detector.changes_with_renames(old_id, new_id))
+            self.set(key, changes)
+        return changes
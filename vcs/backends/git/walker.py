@@ -0,0 +1,304 @@
+"""
+In-process commit walker for git repositories.
+
+Commits are read straight from repository's object store (so caches of the
+shared ``dulwich`` repository are used) and yielded lazily, which saves us
+from running ``git rev-list`` or ``git log`` and buffering their whole output
+just to list some commits.
+"""
+import heapq
+import itertools
+
+from dulwich.errors import NotTreeError
+from dulwich.object_store import tree_lookup_path
+from dulwich.objects import Commit, Tag
+
+from .bloom import get_path_keys
+
+ORDER_DATE = 'date'
+ORDER_TOPO = 'topo'
+
+# number of commits walked after only uninteresting ones are left at the
+# queue (the same value git uses), so that commits with skewed dates do not
+# end the walk too early
+SLOP = 5
+
+
+class GitCommitWalker(object):
+    """
+    Walks commits reachable from ``include`` but not from ``exclude``, newest
+    first. Iterating over walker yields commits' ids, ``iter_commits`` yields
+    ``dulwich.objects.Commit`` objects.
+
+    :param repository: ``GitRepository`` instance
+    :param include: list of commits' (or tags') ids walk starts from
+    :param exclude: list of commits' ids which should not be walked, together
+      with all of their ancestors
+    :param order: ``None`` to yield commits as they are found, in commit date
+      order (like ``git rev-list`` does by default), ``ORDER_DATE`` or
+      ``ORDER_TOPO`` to never show parents before all of their children (like
+      ``--date-order`` and ``--topo-order`` options do)
+    :param since: timestamp; if given, older commits (and their ancestors)
+      are not walked
+    :param until: timestamp; if given, newer commits are skipped
+    :param paths: if given, only commits changing any of those paths are
+      yielded (history is simplified the same way ``git log -- <paths>``
+      does)
+    :param max_count: maximal number of commits to yield
+    :param reverse: if ``True``, commits are yielded oldest first
+
+    Walks with ``exclude``, ``order`` or ``reverse`` given need to reach all
+    interesting commits before yielding the first one, others are lazy.
+    """
+
+    def __init__(self, repository, include, exclude=None, order=None,
+                 since=None, until=None, paths=None, max_count=None,
+                 reverse=False):
+        if order not in (None, ORDER_DATE, ORDER_TOPO):
+            raise ValueError("Unknown order %r" % order)
+        self.repository = repository
+        self.include = list(include)
+        self.exclude = list(exclude or [])
+        self.order = order
+        self.since = since
+        self.until = until
+        self.paths = [path.strip('/') for path in paths or []]
+        self.max_count = max_count
+        self.reverse = reverse
+        self._store = repository._repo.object_store
+        self._commits = {}
+        self._path_ids = {}
+        self._counter = itertools.count()
+        self._changed_paths = None
+        if self.paths:
+            self._changed_paths = repository._get_changed_paths_index()
+            self._path_keys = [get_path_keys(path) for path in self.paths]
+            self._positions = getattr(repository.revisions, 'positions', {})
+
+    def __iter__(self):
+        for commit in self.iter_commits():
+            yield commit.id
+
+    def iter_commits(self):
+        """
+        Yields ``dulwich.objects.Commit`` objects of walked commits.
+        """
+        if self.exclude or self.order or self.reverse:
+            commits = self._limit()
+            if self.order:
+                commits = self._sort(commits)
+        else:
+            commits = self._walk()
+        count = 0
+        if self.reverse:
+            if self.max_count is not None:
+                commits = commits[:self.max_count]
+            commits = reversed(commits)
+        for commit in commits:
+            if self.max_count is not None and count >= self.max_count:
+                break
+            count += 1
+            yield commit
+
+    def _get_commit(self, sha):
+        """
+        Returns commit for the given ``sha`` (peeling tags) or ``None`` if
+        there is no such commit in the repository (i.e. it is behind shallow
+        clone's boundary).
+        """
+        commit = self._commits.pop(sha, None)
+        if commit is not None:
+            return commit
+        try:
+            obj = self._store[sha]
+            while isinstance(obj, Tag):
+                obj = self._store[obj.object[1]]
+        except KeyError:
+            return None
+        if not isinstance(obj, Commit):
+            return None
+        return obj
+
+    def _get_path_ids(self, commit):
+        """
+        Returns tuple of ids of objects at walked paths within the tree of
+        given ``commit`` (``None`` for paths which do not exist there).
+        """
+        ids = self._path_ids.get(commit.tree)
+        if ids is None:
+            ids = []
+            for path in self.paths:
+                try:
+                    ids.append(tree_lookup_path(self._store.__getitem__,
+                                                commit.tree, path)[1])
+                except (KeyError, NotTreeError):
+                    ids.append(None)
+            ids = self._path_ids[commit.tree] = tuple(ids)
+        return ids
+
+    def _simplify(self, commit):
+        """
+        Returns tuple ``(show, parents)`` where ``show`` tells if ``commit``
+        changes any of walked paths and ``parents`` are ids of its parents
+        walk should continue with. If commit is the same as one of its parents
+        at walked paths, only that parent is followed.
+        """
+        if not self.paths:
+            return True, commit.parents
+        if commit.parents and self._changed_paths is not None:
+            # commits which certainly have not changed walked paths are the
+            # same as their first parents
+            pos = self._positions.get(commit.id)
+            if pos is not None and not self._changed_paths.might_change(pos,
+                    commit.id, self._path_keys):
+                return False, commit.parents[:1]
+        ids = self._get_path_ids(commit)
+        if not commit.parents:
+            return ids != (None,) * len(ids), []
+        for sha in commit.parents:
+            parent = self._get_commit(sha)
+            if parent is None:
+                continue
+            self._commits[sha] = parent
+            if self._get_path_ids(parent) == ids:
+                return False, [sha]
+        return True, commit.parents
+
+    def _push(self, queue, seen, sha):
+        """
+        Puts commit with given ``sha`` into the ``queue``, unless it has
+        already been ``seen``, and returns it.
+        """
+        commit = self._get_commit(sha)
+        if commit is not None and commit.id not in seen:
+            seen.add(commit.id)
+            heapq.heappush(queue, (-commit.commit_time, self._counter.next(),
+                                   commit))
+        return commit
+
+    def _walk(self):
+        """
+        Yields interesting commits lazily, in commit date order.
+        """
+        queue = []
+        seen = set()
+        for sha in self.include:
+            self._push(queue, seen, sha)
+        while queue:
+            commit = heapq.heappop(queue)[2]
+            if self.since is not None and commit.commit_time < self.since:
+                continue
+            show, parents = self._simplify(commit)
+            for sha in parents:
+                if sha not in seen:
+                    self._push(queue, seen, sha)
+            if show and (self.until is None
+                         or commit.commit_time <= self.until):
+                yield commit
+
+    def _limit(self):
+        """
+        Returns list of interesting commits, in commit date order. Commits
+        reachable from ``exclude`` are marked as uninteresting while walking
+        and walk ends once there are only uninteresting ones left.
+        """
+        queue = []
+        seen = set()
+        uninteresting = set()
+        # ids of queued commits which are not (yet) known to be uninteresting
+        pending = set()
+        walked = {}
+        shown = []
+
+        def push(sha):
+            size = len(queue)
+            commit = self._push(queue, seen, sha)
+            if len(queue) > size and commit.id not in uninteresting:
+                pending.add(commit.id)
+            return commit
+
+        def mark(sha):
+            uninteresting.add(sha)
+            pending.discard(sha)
+
+        def mark_parents(commit):
+            stack = list(commit.parents)
+            while stack:
+                sha = stack.pop()
+                if sha in uninteresting:
+                    continue
+                mark(sha)
+                if sha in walked:
+                    stack.extend(walked[sha].parents)
+                elif sha not in seen:
+                    push(sha)
+
+        for sha in self.exclude:
+            commit = push(sha)
+            if commit is not None:
+                mark(commit.id)
+        for sha in self.include:
+            push(sha)
+
+        slop = SLOP
+        while queue:
+            commit = heapq.heappop(queue)[2]
+            pending.discard(commit.id)
+            if commit.id not in uninteresting and self.since is not None \
+                    and commit.commit_time < self.since:
+                mark(commit.id)
+            if commit.id in uninteresting:
+                mark_parents(commit)
+                if not pending:
+                    slop -= 1
+                    if not slop:
+                        break
+                else:
+                    slop = SLOP
+                continue
+            walked[commit.id] = commit
+            show, parents = self._simplify(commit)
+            for sha in parents:
+                if sha not in seen:
+                    push(sha)
+            if show and (self.until is None
+                         or commit.commit_time <= self.until):
+                shown.append(commit)
+        return [item for item in shown if item.id not in uninteresting]
+
+    def _sort(self, commits):
+        """
+        Returns given ``commits`` (which are in commit date order) sorted so
+        that no parent comes before any of its children.
+        """
+        positions = dict((commit.id, pos)
+                         for pos, commit in enumerate(commits))
+        indegrees = [0] * len(commits)
+        for commit in commits:
+            for sha in commit.parents:
+                if sha in positions:
+                    indegrees[positions[sha]] += 1
+        # newest commit first with ORDER_DATE, otherwise last started line of
+        # history is continued
+        ready = [(-commit.commit_time, pos)
+                 for pos, commit in enumerate(commits) if not indegrees[pos]]
+        if self.order == ORDER_DATE:
+            heapq.heapify(ready)
+            pop = lambda: heapq.heappop(ready)[1]
+            push = lambda pos: heapq.heappush(ready,
+                (-commits[pos].commit_time, pos))
+        else:
+            ready.reverse()
+            pop = lambda: ready.pop()[1]
+            push = lambda pos: ready.append((None, pos))
+        result = []
+        while ready:
+            commit = commits[pop()]
+            result.append(commit)
+            for sha in commit.parents:
+                pos = positions.get(sha)
+                if pos is not None:
+                    indegrees[pos] -= 1
+                    if not indegrees[pos]:
+                        push(pos)
+        return result
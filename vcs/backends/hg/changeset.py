@@ -1,5 +1,6 @@
 import os
 import posixpath
+from itertools import imap, islice
 
 from vcs.conf import settings
 from vcs.backends.base import BaseChangeset
@@ -12,8 +13,11 @@ from vcs.nodes import (
     NodeKind, RemovedFileNodesGenerator, RootNode, SubModuleNode
 )
 from vcs.utils import safe_str, safe_unicode, date_fromtimestamp
+from vcs.utils.archive_cache import ArchiveCache
+from vcs.utils.blame import iter_annotate
 from vcs.utils.lazy import LazyProperty
 from vcs.utils.paths import get_dirs_for_path
+from vcs.utils.revisions import get_next_position, get_prev_position
 from vcs.utils.hgcompat import archival, hex
 
 
@@ -110,48 +114,31 @@ class MercurialChangeset(BaseChangeset):
                 for child in self._ctx.children() if child.rev() >= 0]
 
     def next(self, branch=None):
-
-        if branch and self.branch != branch:
-            raise VCSError('Branch option used on changeset not belonging '
-                           'to that branch')
-
-        def _next(changeset, branch):
-            try:
-                next_ = changeset.revision + 1
-                next_rev = changeset.repository.revisions[next_]
-            except IndexError:
-                raise ChangesetDoesNotExistError
-            cs = changeset.repository.get_changeset(next_rev)
-
-            if branch and branch != cs.branch:
-                return _next(cs, branch)
-
-            return cs
-
-        return _next(self, branch)
+        if branch:
+            bits = self._get_branch_bits(branch)
+            pos = get_next_position(bits, self.revision)
+        else:
+            pos = self.revision + 1
+        if pos is None or pos >= len(self.repository.revisions):
+            raise ChangesetDoesNotExistError
+        return self.repository.get_changeset(self.repository.revisions[pos])
 
     def prev(self, branch=None):
-        if branch and self.branch != branch:
+        if branch:
+            bits = self._get_branch_bits(branch)
+            pos = get_prev_position(bits, self.revision)
+        else:
+            pos = self.revision - 1
+        if pos is None or pos < 0:
+            raise ChangesetDoesNotExistError
+        return self.repository.get_changeset(self.repository.revisions[pos])
+
+    def _get_branch_bits(self, branch):
+        bits = self.repository._get_branch_bits(branch)
+        if not bits >> self.revision & 1:
             raise VCSError('Branch option used on changeset not belonging '
                            'to that branch')
-
-        def _prev(changeset, branch):
-            try:
-                prev_ = changeset.revision - 1
-                if prev_ < 0:
-                    raise IndexError
-                prev_rev = changeset.repository.revisions[prev_]
-            except IndexError:
-                raise ChangesetDoesNotExistError
-
-            cs = changeset.repository.get_changeset(prev_rev)
-
-            if branch and branch != cs.branch:
-                return _prev(cs, branch)
-
-            return cs
-
-        return _prev(self, branch)
+        return bits
 
     def diff(self, ignore_whitespace=True, context=3):
         return ''.join(self._ctx.diff(git=True,
@@ -223,33 +210,96 @@ class MercurialChangeset(BaseChangeset):
         """
         return self.get_file_history(path, limit=1)[0]
 
+    def get_last_changesets(self, path):
+        """
+        Returns dictionary of paths of all nodes within the directory at the
+        given ``path`` mapped to the changesets which last changed them.
+        Files are mapped to changesets which have introduced their revisions
+        (as ``last_changeset`` of file nodes is), directories to the newest of
+        those of files within them (files removed from directories are not
+        taken into account).
+        """
+        if self._get_kind(path) != NodeKind.DIR:
+            raise ChangesetError("Directory does not exist for revision %s at "
+                " '%s'" % (self.revision, path))
+        path = self._fix_path(path)
+        prefix = path and path + '/' or ''
+        revs = {}
+        for f in self._file_paths:
+            if not f.startswith(prefix):
+                continue
+            node_path = prefix + f[len(prefix):].split('/')[0]
+            rev = self._get_filectx(f).linkrev()
+            if rev > revs.get(node_path, -1):
+                revs[node_path] = rev
+        changesets = {}
+        result = {}
+        for node_path, rev in revs.iteritems():
+            if rev not in changesets:
+                changesets[rev] = self.repository.get_changeset(rev)
+            result[node_path] = changesets[rev]
+        return result
+
     def get_file_history(self, path, limit=None):
         """
         Returns history of file as reversed list of ``Changeset`` objects for
         which file at given ``path`` has been modified.
         """
-        fctx = self._get_filectx(path)
-        hist = []
-        cnt = 0
-        for cs in reversed([x for x in fctx.filelog()]):
-            cnt += 1
-            hist.append(hex(fctx.filectx(cs).node()))
-            if limit and cnt == limit:
-                break
+        return list(self.iter_file_history(path, limit=limit or None))
+
+    def iter_file_history(self, path, offset=0, limit=None, follow=False):
+        """
+        Returns iterator over ``Changeset`` objects (newest first) for which
+        file at given ``path`` has been modified. File's revisions are
+        walked lazily, from the one at this changeset down to its ancestors.
 
-        return [self.repository.get_changeset(node) for node in hist]
+        :param offset: number of changesets to skip
+        :param limit: maximal number of changesets to return
+        :param follow: if ``True``, history is continued beyond renames
+        """
+        fctx = self._get_filectx(path)
+        # context of the file at this changeset points to this changeset even
+        # if it has not modified the file, so walk starts at the changeset
+        # which has introduced file's revision
+        fctx = fctx.filectx(fctx.filenode())
+        nodes = (hex(f.node())
+                 for f in self._iter_filectx_ancestors(fctx, follow))
+        if offset or limit is not None:
+            nodes = islice(nodes, offset,
+                           None if limit is None else offset + limit)
+        return imap(self.repository.get_changeset, nodes)
+
+    def _iter_filectx_ancestors(self, fctx, follow):
+        """
+        Yields given ``fctx`` and its ancestors, in descending order of their
+        changesets' revisions.
+        """
+        visit = {}
+        seen = set()
+        while fctx is not None:
+            yield fctx
+            for parent in fctx.parents():
+                if not follow and parent.path() != fctx.path():
+                    continue
+                key = (parent.path(), parent.filenode())
+                if key not in seen:
+                    seen.add(key)
+                    visit[(parent.rev(), key)] = parent
+            fctx = visit and visit.pop(max(visit)) or None
 
     def get_file_annotate(self, path):
         """
         Returns a generator of four element tuples with
             lineno, sha, changeset lazy loader and line
-        """
 
+        Complete annotation is cached (by file's node and changeset).
+        """
         fctx = self._get_filectx(path)
-        for i, annotate_data in enumerate(fctx.annotate()):
-            ln_no = i + 1
-            sha = hex(annotate_data[0].node())
-            yield (ln_no, sha, lambda: self.repository.get_changeset(sha), annotate_data[1],)
+        return iter_annotate(self, path,
+            lambda: ((hex(f.node()), line) for f, line in fctx.annotate()))
+
+    def _get_annotate_key(self, path):
+        return hex(self._get_filectx(path).filenode()), self.raw_id
 
     def fill_archive(self, stream=None, kind='tgz', prefix=None,
                      subrepos=False):
@@ -268,15 +318,25 @@ class MercurialChangeset(BaseChangeset):
         :raise VcsError: If given stream is None
         """
 
+        if stream is None:
+            raise VCSError('You need to pass in a valid stream for filling'
+                           ' with archival data')
+        self._fill_archive(stream, *self._prepare_archive(kind, prefix,
+                                                          subrepos))
+
+        if stream.closed and hasattr(stream, 'name'):
+            stream = open(stream.name, 'rb')
+        elif hasattr(stream, 'mode') and 'r' not in stream.mode:
+            stream = open(stream.name, 'rb')
+        else:
+            stream.seek(0)
+
+    def _prepare_archive(self, kind='tgz', prefix=None, subrepos=False):
         allowed_kinds = settings.ARCHIVE_SPECS.keys()
         if kind not in allowed_kinds:
             raise ImproperArchiveTypeError('Archive kind not supported use one'
                 'of %s', allowed_kinds)
 
-        if stream is None:
-            raise VCSError('You need to pass in a valid stream for filling'
-                           ' with archival data')
-
         if prefix is None:
             prefix = '%s-%s' % (self.repository.name, self.short_id)
         elif prefix.startswith('/'):
@@ -284,17 +344,17 @@ class MercurialChangeset(BaseChangeset):
         elif prefix.strip() == '':
             raise VCSError("Prefix cannot be empty")
 
-        archival.archive(self.repository._repo, stream, self.raw_id,
-                         kind, prefix=prefix, subrepos=subrepos)
+        def fill(stream):
+            archival.archive(self.repository._repo, stream, self.raw_id,
+                             kind, prefix=prefix, subrepos=subrepos)
 
-        if stream.closed and hasattr(stream, 'name'):
-            stream = open(stream.name, 'rb')
-        elif hasattr(stream, 'mode') and 'r' not in stream.mode:
-            stream = open(stream.name, 'rb')
-        else:
-            stream.seek(0)
+        # archives embed changeset's id (at .hg_archival.txt), so manifest
+        # alone does not identify them
+        key = ArchiveCache.get_key('hg', self.raw_id,
+            hex(self._ctx.manifestnode()), kind, safe_str(prefix), subrepos)
+        return key, fill
 
-    def get_nodes(self, path):
+    def get_nodes(self, path, offset=0, limit=None):
         """
         Returns combined ``DirNode`` and ``FileNode`` objects list representing
         state of changeset at the given ``path``. If node at the given ``path``
@@ -306,25 +366,36 @@ class MercurialChangeset(BaseChangeset):
                 " '%s'" % (self.revision, path))
         path = self._fix_path(path)
 
-        filenodes = [FileNode(f, changeset=self) for f in self._file_paths
+        # paths are sorted first, so that nodes are created only for the
+        # requested page
+        items = [(NodeKind.FILE, f) for f in self._file_paths
             if os.path.dirname(f) == path]
-        dirs = path == '' and '' or [d for d in self._dir_paths
-            if d and posixpath.dirname(d) == path]
-        dirnodes = [DirNode(d, changeset=self) for d in dirs
-            if os.path.dirname(d) == path]
-
+        items.extend((NodeKind.DIR, d) for d in self._dir_paths
+            if d and posixpath.dirname(d) == path)
+        submodules = self._extract_submodules()
+        items.extend((NodeKind.SUBMODULE, k) for k in submodules)
+        items.sort(key=lambda item: (item[0],
+                                     safe_unicode(item[1].split('/')[-1])))
+        if limit is not None:
+            items = items[offset:offset + limit]
+        elif offset:
+            items = items[offset:]
+
+        nodes = []
         als = self.repository.alias
-        for k, vals in self._extract_submodules().iteritems():
-            #vals = url,rev,type
-            loc = vals[0]
-            cs = vals[1]
-            dirnodes.append(SubModuleNode(k, url=loc, changeset=cs,
-                                          alias=als))
-        nodes = dirnodes + filenodes
-        # cache nodes
-        for node in nodes:
+        for kind, item_path in items:
+            if kind == NodeKind.SUBMODULE:
+                #vals = url,rev,type
+                vals = submodules[item_path]
+                node = SubModuleNode(item_path, url=vals[0],
+                                     changeset=vals[1], alias=als)
+            elif kind == NodeKind.DIR:
+                node = DirNode(item_path, changeset=self)
+            else:
+                node = FileNode(item_path, changeset=self)
+            nodes.append(node)
+            # cache nodes
             self.nodes[node.path] = node
-        nodes.sort()
 
         return nodes
 
@@ -17,20 +17,28 @@ import datetime
 
 
 from vcs.backends.base import BaseRepository, CollectionGenerator
+from vcs.conf import settings
 
 from vcs.exceptions import (
     BranchDoesNotExistError, ChangesetDoesNotExistError, EmptyRepositoryError,
     RepositoryError, VCSError, TagAlreadyExistError, TagDoesNotExistError
 )
 from vcs.utils import (
-    author_email, author_name, date_fromtimestamp, makedate, safe_unicode
+    author_email, author_name, date_fromtimestamp, makedate, safe_str,
+    safe_unicode
 )
+from vcs.utils.blame import AnnotateCache
+from vcs.utils.diffs import iter_file_diffs
 from vcs.utils.lazy import LazyProperty
+from vcs.utils.metadata import ChangesetsMetadata, get_summary
 from vcs.utils.ordered_dict import OrderedDict
 from vcs.utils.paths import abspath
+from vcs.utils.revisions import (
+    RevisionDates, RevisionList, filter_positions, make_bitset
+)
 from vcs.utils.hgcompat import (
     ui, nullid, match, patch, diffopts, clone, get_contact, pull,
-    localrepository, RepoLookupError, Abort, RepoError, hex, scmutil, hg_url,
+    localrepository, RepoLookupError, Abort, RepoError, hex, hg_url,
     httpbasicauthhandler, httpdigestauthhandler
 )
 
@@ -88,6 +96,66 @@ class MercurialRepository(BaseRepository):
         """
         return self._get_all_revisions()
 
+    @LazyProperty
+    def _revision_dates(self):
+        return RevisionDates()
+
+    @LazyProperty
+    def _revision_branches(self):
+        """
+        List of names of branches of ``revisions``.
+        """
+        return []
+
+    @LazyProperty
+    def _branch_bits(self):
+        """
+        Dictionary of branch names mapped to tuples (number of revisions
+        checked, bitset of positions of revisions at that branch).
+        """
+        return {}
+
+    @LazyProperty
+    def _annotate_cache(self):
+        """
+        ``AnnotateCache`` of files' annotations.
+        """
+        return AnnotateCache(settings.ANNOTATE_CACHE_SIZE)
+
+    def _read_changelog(self):
+        """
+        Reads timestamps and branches of revisions added since last call.
+        """
+        dates = self._revision_dates
+        branches = self._revision_branches
+        changelog = self._repo.changelog
+        for rev in xrange(len(dates), len(self.revisions)):
+            entry = changelog.read(rev)
+            dates.append(entry[2][0])
+            branches.append(entry[5].get('branch', self.DEFAULT_BRANCH_NAME))
+
+    def _get_revision_dates(self):
+        """
+        Returns ``RevisionDates`` with commit timestamps of ``revisions``.
+        """
+        self._read_changelog()
+        return self._revision_dates
+
+    def _get_branch_bits(self, name):
+        """
+        Returns bitset of positions of revisions at the branch with given
+        ``name``.
+        """
+        self._read_changelog()
+        name = safe_str(name)
+        branches = self._revision_branches
+        checked, bits = self._branch_bits.get(name, (0, 0))
+        if checked < len(branches):
+            bits |= make_bitset(pos for pos in xrange(checked, len(branches))
+                                if branches[pos] == name)
+            self._branch_bits[name] = (len(branches), bits)
+        return bits
+
     @LazyProperty
     def name(self):
         return os.path.basename(self.path)
@@ -238,7 +306,8 @@ class MercurialRepository(BaseRepository):
 
     def _get_all_revisions(self):
 
-        return map(lambda x: hex(x[7]), self._repo.changelog.index)[:-1]
+        return RevisionList(map(lambda x: hex(x[7]),
+                                self._repo.changelog.index)[:-1])
 
     def get_diff(self, rev1, rev2, path='', ignore_whitespace=False,
                   context=3):
@@ -255,6 +324,22 @@ class MercurialRepository(BaseRepository):
         :param context: How many lines before/after changed lines should be
           shown. Defaults to ``3``.
         """
+        return ''.join(self._get_diff_chunks(rev1, rev2, path,
+                                             ignore_whitespace, context))
+
+    def iter_diff(self, rev1, rev2, path='', ignore_whitespace=False,
+                  context=3, file_limit=None, total_limit=None):
+        """
+        Returns generator of patches of single files (as tuples ``(patch,
+        truncated)``) of the *diff* returned by ``get_diff`` with the same
+        arguments, yielded as mercurial produces them. See
+        ``vcs.utils.diffs.iter_file_diffs`` for ``file_limit`` and
+        ``total_limit``.
+        """
+        return iter_file_diffs(self._get_diff_chunks(rev1, rev2, path,
+            ignore_whitespace, context), file_limit, total_limit)
+
+    def _get_diff_chunks(self, rev1, rev2, path, ignore_whitespace, context):
         if hasattr(rev1, 'raw_id'):
             rev1 = getattr(rev1, 'raw_id')
 
@@ -271,10 +356,10 @@ class MercurialRepository(BaseRepository):
         else:
             file_filter = None
 
-        return ''.join(patch.diff(self._repo, rev1, rev2, match=file_filter,
+        return patch.diff(self._repo, rev1, rev2, match=file_filter,
                           opts=diffopts(git=True,
                                         ignorews=ignore_whitespace,
-                                        context=context)))
+                                        context=context))
 
     @classmethod
     def _check_url(cls, url):
@@ -481,28 +566,53 @@ class MercurialRepository(BaseRepository):
         if branch_name and branch_name not in self.allbranches.keys():
             raise BranchDoesNotExistError('Branch %s not found in'
                                   ' this repository' % branch_name)
-        if end_pos is not None:
-            end_pos += 1
-        #filter branches
-        filter_ = []
-        if branch_name:
-            filter_.append('branch("%s")' % (branch_name))
-
+        since = until = None
         if start_date:
-            filter_.append('date(">%s")' % start_date)
+            since = time.mktime(start_date.timetuple())
         if end_date:
-            filter_.append('date("<%s")' % end_date)
-        if filter_:
-            revisions = scmutil.revrange(self._repo, [" and ".join(filter_)])
-        else:
-            revisions = self.revisions
+            until = time.mktime(end_date.timetuple())
+        positions = self._get_revision_dates().get_positions(since, until,
+            start_pos or 0, end_pos)
+        if branch_name:
+            positions = filter_positions(self._get_branch_bits(branch_name),
+                                         positions)
 
-        revs = revisions[start_pos:end_pos]
+        revs = [self.revisions[pos] for pos in positions]
         if reverse:
-            revs = reversed(revs)
+            revs.reverse()
 
         return CollectionGenerator(self, revs)
 
+    def get_changesets_metadata(self, revisions=None, messages=True):
+        """
+        Returns ``ChangesetsMetadata`` of changesets with given ``revisions``
+        (all changesets if ``None``), in the same order. Entries are read
+        from the changelog, without creating changeset contexts.
+
+        :param revisions: iterable of full changesets' ids
+        :param messages: if ``False``, only summaries of messages are decoded
+          and kept
+
+        :raises ChangesetDoesNotExistError: if any of ``revisions`` could not
+          be found
+        """
+        if revisions is None:
+            revisions = self.revisions
+        changelog = self._repo.changelog
+        metadata = ChangesetsMetadata(messages)
+        for raw_id in revisions:
+            try:
+                rev = self.revisions.index(raw_id)
+            except ValueError:
+                raise ChangesetDoesNotExistError("Revision %s does not "
+                    "exist for this repository" % raw_id)
+            entry = changelog.read(changelog.node(rev))
+            user, date, message = entry[1], entry[2], entry[4]
+            metadata.append(raw_id, rev, safe_unicode(user), date[0],
+                safe_unicode(get_summary(message)),
+                safe_unicode(message) if messages else None)
+        return metadata
+
     def pull(self, url):
         """
         Tries to pull changes from external location.
@@ -21,14 +21,61 @@ DEFAULT_ENCODINGS = aslist('utf8')
 
 # path to git executable runned by run_git_command function
 GIT_EXECUTABLE_PATH = 'git'
+# engine running git commands: 'threads' (input and output streams of every
+# command are served by separate threads) or 'select' (streams are
+# multiplexed by the calling thread; POSIX only)
+GIT_COMMAND_ENGINE = 'threads'
+# maximal number of bytes of output and number of seconds git commands may
+# take (commands are killed once they are exceeded; not limited if not set)
+GIT_COMMAND_MAX_OUTPUT = None
+GIT_COMMAND_TIMEOUT = None
+# maximal number of git commands run at once (by all repositories and by
+# single repository); further commands wait in order they came in
+GIT_COMMAND_CONCURRENCY = None
+GIT_REPOSITORY_COMMAND_CONCURRENCY = None
+# maximal number of seconds git commands wait for a free slot (not limited if
+# not set)
+GIT_COMMAND_QUEUE_TIMEOUT = None
 # can be also --branches --tags
 GIT_REV_FILTER = '--all'
+# minimal number of seconds between checks whether refs of git repositories
+# have been changed on disk (by other processes)
+GIT_REFS_CHECK_INTERVAL = 1
+# keep revisions of git repositories at the index file within repository
+GIT_REVISION_INDEX = True
+# keep Bloom filters of paths changed by commits of git repositories at the
+# file within repository (speeds up history of files)
+GIT_CHANGED_PATHS_INDEX = True
+# maximal number of commits whose filters are computed by single walk (the
+# rest of them is walked without filters until later walks compute them)
+GIT_CHANGED_PATHS_BATCH = 1000
+# number of git repositories whose dulwich ``Repo`` objects (with open pack
+# files and caches) are kept open
+GIT_REPO_HANDLES = 100
+# number of entries of git trees kept in memory (shared by changesets)
+GIT_TREE_CACHE_SIZE = 100000
+# engine reading contents and sizes of git objects: 'dulwich' or 'cat-file'
+# (long lived ``git cat-file --batch`` processes, at most
+# GIT_CAT_FILE_PROCESSES per repository)
+GIT_OBJECT_ENGINE = 'dulwich'
+GIT_CAT_FILE_PROCESSES = 4
+# number of lines of files' annotations kept in memory (per repository)
+ANNOTATE_CACHE_SIZE = 100000
 
 BACKENDS = {
     'hg': 'vcs.backends.hg.MercurialRepository',
     'git': 'vcs.backends.git.GitRepository',
 }
 
+# compression level of archives (0-9) and number of threads compressing them
+# (number of CPUs if not set)
+ARCHIVE_COMPRESSION_LEVEL = 6
+ARCHIVE_THREADS = None
+# directory archives are cached at (not cached if not set) and maximal total
+# size (in bytes) of cached archives
+ARCHIVE_CACHE_DIR = None
+ARCHIVE_CACHE_SIZE = 1024 ** 3
+
 ARCHIVE_SPECS = {
     'tar': ('application/x-tar', '.tar'),
     'tbz2': ('application/x-bzip2', '.tar.bz2'),
@@ -22,9 +22,135 @@ You should have received a copy of the GNU Lesser General Public License
 along with git_http_backend.py Project.
 If not, see <http://www.gnu.org/licenses/>.
 '''
+from __future__ import with_statement
+
 import os
+import time
+import errno
+import select
+import signal
+import tempfile
+import threading
 import subprocess
-from vcs.utils.compat import deque, Event, Thread, _bytes, _bytearray
+from vcs.utils.compat import deque, Event, Thread, _bytes, _bytearray, kill
+
+# number of bytes which may be written into a writable pipe without blocking
+PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+
+class OutputLimitError(EnvironmentError):
+    """
+    Raised if subprocess has written more output than allowed (subprocess
+    is killed).
+    """
+
+
+class SubprocessTimeoutError(EnvironmentError):
+    """
+    Raised if subprocess has not ended in time (subprocess is killed).
+    """
+
+
+def _get_popen_kwargs(kwargs, max_output, timeout):
+    """
+    Returns ``Popen`` keyword arguments starting subprocess in a new process
+    group (on POSIX) if it may need to be killed, so that processes started
+    by the shell are killed as well.
+    """
+    if (max_output or timeout) and hasattr(os, 'setsid'):
+        kwargs.setdefault('preexec_fn', os.setsid)
+    return kwargs
+
+
+def _kill(process):
+    """
+    Kills given ``process`` together with its process group, if it has been
+    started by ``_get_popen_kwargs`` in a new one.
+    """
+    try:
+        if hasattr(os, 'killpg') and os.getpgid(process.pid) == process.pid:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            kill(process)
+    except OSError:
+        # already gone
+        pass
+
+
+class SpooledBuffer(object):
+    """
+    Thread safe first in, first out queue of chunks of data. Chunks are kept
+    in memory until ``max_memory`` bytes are queued, further data is
+    written to a temporary file and read back in chunks of ``chunk_size``
+    bytes. Queue may be used in place of ``deque`` by chunkers.
+    """
+
+    def __init__(self, max_memory, chunk_size=4096, starting_values=[]):
+        self.max_memory = max_memory
+        self.chunk_size = chunk_size
+        self._chunks = deque(starting_values)
+        self._memory = sum(len(chunk) for chunk in starting_values)
+        self._file = None
+        self._read_pos = self._write_pos = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns number of chunks in the queue (spooled data is counted in
+        chunks it would be read back in).
+        """
+        spooled = self._write_pos - self._read_pos
+        return len(self._chunks) + (spooled + self.chunk_size - 1) \
+            // self.chunk_size
+
+    def append(self, data):
+        with self._lock:
+            if self._write_pos == self._read_pos and \
+                    self._memory + len(data) <= self.max_memory:
+                self._chunks.append(data)
+                self._memory += len(data)
+                return
+            if self._file is None:
+                self._file = tempfile.TemporaryFile()
+            self._file.seek(self._write_pos)
+            self._file.write(data)
+            self._write_pos += len(data)
+
+    def extend(self, chunks):
+        for chunk in chunks:
+            self.append(chunk)
+
+    def appendleft(self, data):
+        with self._lock:
+            self._chunks.appendleft(data)
+            self._memory += len(data)
+
+    def popleft(self):
+        with self._lock:
+            if self._chunks:
+                data = self._chunks.popleft()
+                self._memory -= len(data)
+                return data
+            if self._read_pos == self._write_pos:
+                raise IndexError('pop from an empty buffer')
+            self._file.seek(self._read_pos)
+            data = self._file.read(min(self.chunk_size,
+                                       self._write_pos - self._read_pos))
+            self._read_pos += len(data)
+            if self._read_pos == self._write_pos:
+                # file is reused from the start
+                self._file.seek(0)
+                self._file.truncate()
+                self._read_pos = self._write_pos = 0
+            return data
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._chunks.clear()
+            self._memory = self._read_pos = self._write_pos = 0
 
 
 class StreamFeeder(Thread):
@@ -77,7 +203,12 @@ class StreamFeeder(Thread):
 
 
 class InputStreamChunker(Thread):
-    def __init__(self, source, target, buffer_size, chunk_size):
+    def __init__(self, source, target, buffer_size, chunk_size,
+                 max_bytes=None):
+        '''
+        If ``buffer_size`` is ``None``, reading never pauses. If more than
+        ``max_bytes`` are read, reading stops and ``limit_exceeded`` is set.
+        '''
 
         super(InputStreamChunker, self).__init__()
 
@@ -85,8 +216,13 @@ class InputStreamChunker(Thread):
 
         self.source = source
         self.target = target
-        self.chunk_count_max = int(buffer_size / chunk_size) + 1
+        if buffer_size is None:
+            self.chunk_count_max = None
+        else:
+            self.chunk_count_max = int(buffer_size / chunk_size) + 1
         self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.limit_exceeded = False
 
         self.data_added = Event()
         self.data_added.clear()
@@ -125,8 +261,13 @@ class InputStreamChunker(Thread):
         except ValueError:
             b = ''
 
+        read = 0
         while b and go.is_set():
-            if len(t) > ccm:
+            read += len(b)
+            if self.max_bytes is not None and read > self.max_bytes:
+                self.limit_exceeded = True
+                break
+            if ccm is not None and len(t) > ccm:
                 kr.clear()
                 kr.wait(2)
 #                # this only works on 2.7.x and up
@@ -156,17 +297,28 @@ class BufferedGenerator():
     '''
 
     def __init__(self, source, buffer_size=65536, chunk_size=4096,
-                 starting_values=[], bottomless=False):
+                 starting_values=[], bottomless=False, spool_size=None,
+                 max_bytes=None, timeout=None, kill=None):
 
         if bottomless:
             maxlen = int(buffer_size / chunk_size)
         else:
             maxlen = None
 
-        self.data = deque(starting_values, maxlen)
+        if spool_size is not None:
+            # reading never pauses, data beyond spool_size goes to disk
+            self.data = SpooledBuffer(spool_size, chunk_size, starting_values)
+            buffer_size = None
+        else:
+            self.data = deque(starting_values, maxlen)
 
         self.worker = InputStreamChunker(source, self.data, buffer_size,
-                                         chunk_size)
+                                         chunk_size, max_bytes)
+        # limits are checked whenever data is asked for, ``kill`` stops the
+        # source's writer if they are exceeded
+        self.timeout = timeout
+        self.deadline = timeout is not None and time.time() + timeout or None
+        self.kill = kill
         if starting_values:
             self.worker.data_added.set()
         self.worker.start()
@@ -182,6 +334,8 @@ class BufferedGenerator():
         while not len(self.data) and not self.worker.EOF.is_set():
             self.worker.data_added.clear()
             self.worker.data_added.wait(0.2)
+            self.check_limits()
+        self.check_limits()
         if len(self.data):
             self.worker.keep_reading.set()
             return _bytes(self.data.popleft())
@@ -192,6 +346,26 @@ class BufferedGenerator():
         if not self.worker.EOF.is_set():
             raise type(value)
 
+    def check_limits(self):
+        '''
+        Raises ``OutputLimitError`` if more than ``max_bytes`` have been read
+        or ``SubprocessTimeoutError`` if ``timeout`` has passed while source
+        has not ended yet, stopping reading and the writer.
+        '''
+        if self.worker.limit_exceeded:
+            error = OutputLimitError("Subprocess has written more than %s "
+                                     "bytes of output" % self.worker.max_bytes)
+        elif self.deadline is not None and time.time() > self.deadline \
+                and not self.worker.EOF.is_set():
+            error = SubprocessTimeoutError("Subprocess has not ended in %s "
+                                           "seconds" % self.timeout)
+        else:
+            return
+        self.worker.stop()
+        if self.kill is not None:
+            self.kill()
+        raise error
+
     def start(self):
         self.worker.start()
 
@@ -326,7 +500,8 @@ class SubprocessIOChunker(object):
 
     '''
     def __init__(self, cmd, inputstream=None, buffer_size=65536,
-                 chunk_size=4096, starting_values=[], **kwargs):
+                 chunk_size=4096, starting_values=[], max_output=None,
+                 timeout=None, spool_size=None, **kwargs):
         '''
         Initializes SubprocessIOChunker
 
@@ -335,12 +510,22 @@ class SubprocessIOChunker(object):
         :param buffer_size: (Default: 65536) A size of total buffer per stream in bytes.
         :param chunk_size: (Default: 4096) A max size of a chunk. Actual chunk may be smaller.
         :param starting_values: (Default: []) An array of strings to put in front of output que.
+        :param max_output: (Default: None) A max number of bytes of output; if
+          subprocess writes more, it is killed and OutputLimitError is raised.
+        :param timeout: (Default: None) A number of seconds after which still
+          running subprocess is killed and SubprocessTimeoutError is raised.
+        :param spool_size: (Default: None) If set, output is read as fast as
+          subprocess writes it (rather than pausing once buffer is full) and
+          buffered output beyond that many bytes is kept at a temporary file.
         '''
 
         if inputstream:
             input_streamer = StreamFeeder(inputstream)
             input_streamer.start()
             inputstream = input_streamer.output
+            # subprocess must not inherit writing end of the feeder's pipe,
+            # otherwise it would never see end of its input
+            kwargs.setdefault('close_fds', True)
 
         if isinstance(cmd, (list, tuple)):
             cmd = ' '.join(cmd)
@@ -352,14 +537,25 @@ class SubprocessIOChunker(object):
             stdin=inputstream,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            **kwargs
+            **_get_popen_kwargs(kwargs, max_output, timeout)
             )
 
-        bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size, starting_values)
+        bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size,
+            starting_values, spool_size=spool_size, max_bytes=max_output,
+            timeout=timeout, kill=lambda: _kill(_p))
         bg_err = BufferedGenerator(_p.stderr, 16000, 1, bottomless=True)
 
+        max_chunks = buffer_size / chunk_size
         while not bg_out.done_reading and not bg_out.reading_paused and not bg_err.length:
+            if spool_size is not None and bg_out.length > max_chunks:
+                # reading goes on, but buffer is full
+                break
             # doing this until we reach either end of file, or end of buffer.
+            try:
+                bg_out.check_limits()
+            except EnvironmentError:
+                bg_err.stop()
+                raise
             bg_out.data_added_event.wait(1)
             bg_out.data_added_event.clear()
 
@@ -388,6 +584,7 @@ class SubprocessIOChunker(object):
         return self
 
     def next(self):
+        self.output.check_limits()
         if self.process.poll():
             err = '%s' % ''.join(self.error)
             raise EnvironmentError("Subprocess exited due to an error:\n" + err)
@@ -413,3 +610,273 @@ class SubprocessIOChunker(object):
 
     def __del__(self):
         self.close()
+
+
+def _wait(readers, writers, timeout=None):
+    '''
+    Waits (at most ``timeout`` seconds, if given) until any of given file
+    descriptors is ready for reading (or has been closed) or for writing.
+    Returns tuple of lists of ready ones (both empty if waiting has timed out
+    or has been interrupted by a signal).
+
+    Uses ``poll`` if available, as ``select`` cannot wait for descriptors
+    with numbers above ``FD_SETSIZE``.
+    '''
+    try:
+        if not hasattr(select, 'poll'):
+            return select.select(readers, writers, [], timeout)[:2]
+        poller = select.poll()
+        for fd in readers:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        for fd in writers:
+            poller.register(fd, select.POLLOUT)
+        if timeout is not None:
+            timeout = max(int(timeout * 1000), 0)
+        ready = [fd for fd, _ in poller.poll(timeout)]
+    except (select.error, OSError), err:
+        if err.args[0] == errno.EINTR:
+            return [], []
+        raise
+    return ([fd for fd in ready if fd in readers],
+            [fd for fd in ready if fd in writers])
+
+
+class SelectIOChunker(object):
+    '''
+    Thread free alternative to ``SubprocessIOChunker`` with the same
+    interface and arguments.
+
+    Input, output and error streams of the subprocess are multiplexed with
+    ``poll`` (``select`` where it is not available) by the calling thread, so
+    no thread is started per command. Initializer reads output until the
+    buffer is filled or the subprocess ends and raises ``EnvironmentError``
+    if the subprocess has failed or, while it is still running, has written
+    something to stderr.
+    Afterwards output is read only when the iteration asks for more of it:
+    a slow consumer pauses the subprocess (once pipe's buffer is full) rather
+    than filling the memory. Stderr is read and input is fed whenever output
+    is waited for, last ``16000`` bytes of stderr are kept.
+
+    If ``spool_size`` is given, initializer reads whole output (buffered
+    output beyond that many bytes is kept at a temporary file), so the
+    subprocess ends as soon as possible regardless of the consumer.
+    ``max_output`` and ``timeout`` are checked whenever output is read or
+    waited for.
+
+    Works on POSIX systems only.
+    '''
+    error_size = 16000
+    process = None
+    _open = ()
+
+    def __init__(self, cmd, inputstream=None, buffer_size=65536,
+                 chunk_size=4096, starting_values=[], max_output=None,
+                 timeout=None, spool_size=None, **kwargs):
+        '''
+        Initializes SelectIOChunker; see ``SubprocessIOChunker`` for
+        arguments.
+        '''
+        self._input = None
+        self._pending_input = ''
+        stdin = None
+        if inputstream:
+            stdin = subprocess.PIPE
+            if type(inputstream) in (type(''), _bytes, _bytearray):
+                self._pending_input = _bytes(inputstream)
+            elif type(inputstream) in (int, long):
+                self._input = os.fdopen(inputstream, 'rb', 16384)
+            elif hasattr(inputstream, 'read'):
+                self._input = inputstream
+            else:
+                raise TypeError("SelectIOChunker's inputstream must be a "
+                    "readable file-like, a file descriptor, or a string-like.")
+
+        if isinstance(cmd, (list, tuple)):
+            cmd = ' '.join(cmd)
+
+        _shell = kwargs.get('shell') or True
+        kwargs['shell'] = _shell
+        _p = subprocess.Popen(cmd,
+            bufsize=-1,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **_get_popen_kwargs(kwargs, max_output, timeout)
+            )
+
+        self.process = _p
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.max_output = max_output
+        self.timeout = timeout
+        self._deadline = timeout is not None and time.time() + timeout or None
+        self._output_length = 0
+        if spool_size is not None:
+            self._chunks = SpooledBuffer(spool_size, chunk_size,
+                                         starting_values)
+        else:
+            self._chunks = deque(starting_values)
+        self._buffered = sum(len(chunk) for chunk in starting_values)
+        self._errors = deque()
+        self._errors_length = 0
+        self._stdout = _p.stdout.fileno()
+        self._stderr = _p.stderr.fileno()
+        self._stdin = stdin and _p.stdin.fileno()
+        self._open = set([self._stdout, self._stderr])
+        if stdin:
+            self._open.add(self._stdin)
+
+        while self._stdout in self._open and (spool_size is not None or
+                                              self._buffered < buffer_size):
+            # doing this until we reach either end of file, or end of buffer
+            # (stopping at first error output would make result depend on
+            # the order streams happen to be read in)
+            self._pump()
+        if self._stdout not in self._open:
+            self._finish()
+
+        _returncode = _p.poll()
+        if _returncode or (_returncode == None and self._errors):
+            self.close()
+            err = ''.join(self._errors)
+            if err:
+                raise EnvironmentError("Subprocess exited due to an error:\n" + err)
+            raise EnvironmentError("Subprocess exited with non 0 ret code:%s" % _returncode)
+
+        self.output = self._iter_output()
+        self.error = self._iter_error()
+
+    def _close(self, fd):
+        self._open.discard(fd)
+        for f in (self.process.stdin, self.process.stdout,
+                  self.process.stderr):
+            if f is not None and not f.closed and f.fileno() == fd:
+                f.close()
+
+    def _pump(self):
+        '''
+        Waits for any of subprocess' streams and serves the ready ones.
+        '''
+        readers = [fd for fd in (self._stdout, self._stderr)
+                   if fd in self._open]
+        writers = [fd for fd in (self._stdin,) if fd in self._open]
+        timeout = None
+        if self._deadline is not None:
+            timeout = self._deadline - time.time()
+            if timeout <= 0:
+                self._fail(SubprocessTimeoutError("Subprocess has not ended "
+                    "in %s seconds" % self.timeout))
+        readable, writable = _wait(readers, writers, timeout)
+        for fd in readable:
+            try:
+                data = os.read(fd, self.chunk_size)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                self._close(fd)
+            elif fd == self._stdout:
+                self._output_length += len(data)
+                if self.max_output is not None and \
+                        self._output_length > self.max_output:
+                    self._fail(OutputLimitError("Subprocess has written more "
+                        "than %s bytes of output" % self.max_output))
+                self._chunks.append(data)
+                self._buffered += len(data)
+            else:
+                self._add_error(data)
+        if writable:
+            self._write_input()
+
+    def _fail(self, error):
+        _kill(self.process)
+        self.close()
+        raise error
+
+    def _add_error(self, data):
+        self._errors.append(data)
+        self._errors_length += len(data)
+        while self._errors_length - len(self._errors[0]) >= self.error_size:
+            self._errors_length -= len(self._errors.popleft())
+
+    def _write_input(self):
+        if not self._pending_input and self._input is not None:
+            self._pending_input = self._input.read(4096)
+        if not self._pending_input:
+            self._close(self._stdin)
+            return
+        try:
+            written = os.write(self._stdin, self._pending_input[:PIPE_BUF])
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                return
+            if err.errno != errno.EPIPE:
+                raise
+            # subprocess does not read its input anymore
+            self._pending_input = ''
+            self._input = None
+            self._close(self._stdin)
+            return
+        self._pending_input = self._pending_input[written:]
+
+    def _finish(self):
+        '''
+        Reads rest of stderr and waits for the subprocess once its output
+        has ended.
+        '''
+        if self._stdin in self._open:
+            self._close(self._stdin)
+        while self._stderr in self._open:
+            self._pump()
+        if self._deadline is None:
+            self.process.wait()
+            return
+        while self.process.poll() is None:
+            if time.time() > self._deadline:
+                self._fail(SubprocessTimeoutError("Subprocess has not ended "
+                    "in %s seconds" % self.timeout))
+            time.sleep(0.01)
+
+    def _iter_output(self):
+        while True:
+            while not self._chunks and self._stdout in self._open:
+                self._pump()
+            if self._chunks:
+                chunk = self._chunks.popleft()
+                self._buffered -= len(chunk)
+                yield _bytes(chunk)
+            else:
+                self._finish()
+                return
+
+    def _iter_error(self):
+        while self._stderr in self._open:
+            self._pump()
+        while self._errors:
+            yield self._errors.popleft()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.process.poll():
+            err = '%s' % ''.join(self._errors)
+            raise EnvironmentError("Subprocess exited due to an error:\n" + err)
+        return self.output.next()
+
+    def throw(self, type, value=None, traceback=None):
+        if self._chunks or self._stdout in self._open:
+            raise type(value)
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except:
+                pass
+        for fd in list(self._open):
+            self._close(fd)
+
+    def __del__(self):
+        self.close()
@@ -37,6 +37,7 @@ from test_hg import *
 from test_inmemchangesets import *
 from test_nodes import *
 from test_repository import *
+from test_subprocessio import *
 from test_tags import *
 from test_utils import *
 from test_utils_filesize import *
@@ -1,15 +1,23 @@
 from __future__ import with_statement
 
 import os
+import time
+import gzip
 import tarfile
 import zipfile
 import datetime
 import tempfile
+import threading
 import StringIO
+import mock
 from vcs.tests.base import BackendTestMixin
 from vcs.tests.conf import SCM_TESTS
+from vcs.conf import settings
 from vcs.exceptions import VCSError
 from vcs.nodes import FileNode
+from vcs.utils.archive_cache import ArchiveCache
+from vcs.utils import archivers
+from vcs.utils.archivers import BLOCK_SIZE, GzipWriter, get_archiver
 from vcs.utils.compat import unittest
 
 
@@ -83,6 +91,44 @@ class ArchivesTestCaseMixin(BackendTestMixin):
         with open(tmppath, 'r') as f:
             self.assertEqual(f.read(), mystream.read())
 
+    def test_archive_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        with mock.patch.object(settings, 'ARCHIVE_CACHE_DIR', cache_dir):
+            stream = StringIO.StringIO()
+            self.tip.fill_archive(stream=stream, kind='tgz', prefix='repo')
+            names = os.listdir(cache_dir)
+            self.assertEqual(len(names), 1)
+            path = os.path.join(cache_dir, names[0])
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), stream.getvalue())
+
+            # archive is not built again
+            with open(path, 'wb') as f:
+                f.write('cached')
+            stream = StringIO.StringIO()
+            self.tip.fill_archive(stream=stream, kind='tgz', prefix='repo')
+            self.assertEqual(stream.getvalue(), 'cached')
+            self.assertEqual(''.join(self.tip.get_chunked_archive(kind='tgz',
+                prefix='repo', chunk_size=2)), 'cached')
+
+            self.tip.fill_archive(stream=StringIO.StringIO(), kind='zip',
+                                  prefix='repo')
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_open_archive(self):
+        self.assertEqual(self.tip.open_archive(kind='zip'), None)
+        cache_dir = tempfile.mkdtemp()
+        with mock.patch.object(settings, 'ARCHIVE_CACHE_DIR', cache_dir):
+            stream = StringIO.StringIO()
+            self.tip.fill_archive(stream=stream, kind='tbz2', prefix='repo')
+            for kind in ('tbz2', 'zip'):
+                with self.tip.open_archive(kind=kind, prefix='repo') as f:
+                    self.assertEqual(os.path.dirname(f.name), cache_dir)
+                    with open(f.name, 'rb') as cached:
+                        self.assertEqual(cached.read(), f.read())
+            with self.tip.open_archive(kind='tbz2', prefix='repo') as f:
+                self.assertEqual(f.read(), stream.getvalue())
+
     def test_archive_wrong_kind(self):
         with self.assertRaises(VCSError):
             self.tip.fill_archive(kind='wrong kind')
@@ -95,6 +141,163 @@ class ArchivesTestCaseMixin(BackendTestMixin):
         with self.assertRaises(VCSError):
             self.tip.fill_archive(prefix='/any')
 
+class GzipWriterTest(unittest.TestCase):
+
+    def test_blocks_compressed_in_parallel(self):
+        data = ''.join('line %d\n' % x for x in xrange(100000))
+        for threads in (1, 4):
+            stream = StringIO.StringIO()
+            writer = GzipWriter(stream, level=6, threads=threads)
+            for x in xrange(0, len(data), 10000):
+                writer.write(data[x:x + 10000])
+            writer.close()
+            self.assertTrue(len(data) > 4 * BLOCK_SIZE)
+            self.assertTrue(len(stream.getvalue()) < len(data))
+            stream.seek(0)
+            self.assertEqual(gzip.GzipFile(fileobj=stream).read(), data)
+
+    def test_empty(self):
+        stream = StringIO.StringIO()
+        GzipWriter(stream, level=9, threads=2).close()
+        stream.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=stream).read(), '')
+
+
+    def test_threads_shared_between_writers(self):
+        GzipWriter(StringIO.StringIO(), level=1, threads=2).close()
+        count = threading.active_count()
+        for x in xrange(3):
+            GzipWriter(StringIO.StringIO(), level=1, threads=2).close()
+        self.assertEqual(threading.active_count(), count)
+
+
+class ZipArchiverTest(unittest.TestCase):
+
+    def _get_zip(self, data, threads):
+        stream = StringIO.StringIO()
+        archiver = get_archiver('zip', stream, 'repo', 0, threads=threads,
+                                comment='comment')
+        archiver.add_dir('')
+        archiver.add_file('big.txt', data)
+        archiver.add_file('run.sh', 'exit 0', executable=True)
+        archiver.add_symlink('link', 'run.sh')
+        archiver.close()
+        stream.seek(0)
+        archive = zipfile.ZipFile(stream)
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(archive.comment, 'comment')
+        self.assertEqual(archive.namelist(), ['repo/', 'repo/big.txt',
+            'repo/run.sh', 'repo/link'])
+        self.assertEqual([info.external_attr >> 16 for info in
+            archive.infolist()], [040755, 0100644, 0100755, 0120777])
+        self.assertEqual(archive.read('repo/big.txt'), data)
+        self.assertEqual(archive.read('repo/link'), 'run.sh')
+        return archive
+
+    def test_blocks_compressed_in_parallel(self):
+        data = ''.join('line %d\n' % x for x in xrange(100000))
+        self.assertTrue(len(data) > 4 * BLOCK_SIZE)
+        for threads in (1, 4):
+            self._get_zip(data, threads)
+
+    def test_zip64(self):
+        with mock.patch.object(archivers, 'ZIP64_LIMIT', 10):
+            self._get_zip('Foobar' * 10, 2)
+
+
+class ArchiveCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ArchiveCache(tempfile.mkdtemp(), size=10)
+        self.built = []
+
+    def _open(self, key, content):
+        def fill(f):
+            self.built.append(key)
+            f.write(content)
+        with self.cache.open(key, fill) as f:
+            return f.read()
+
+    def test_built_once(self):
+        self.assertEqual(self._open('a', 'aaa'), 'aaa')
+        self.assertEqual(self._open('a', 'bbb'), 'aaa')
+        self.assertEqual(self.built, ['a'])
+
+    def test_least_recently_used_evicted(self):
+        self._open('a', 'aaaa')
+        self._open('b', 'bbbb')
+        path = os.path.join(self.cache.path, 'b')
+        os.utime(path, (0, 0))
+        # served archive becomes the most recently used one
+        self._open('b', 'bbbb')
+        os.utime(os.path.join(self.cache.path, 'a'), (1, 1))
+        self._open('c', 'cccc')
+        self.assertEqual(sorted(os.listdir(self.cache.path)), ['b', 'c'])
+        self.assertEqual(self.built, ['a', 'b', 'c'])
+
+    def test_directory_listed_only_when_budget_is_exceeded(self):
+        with mock.patch.object(os, 'listdir', wraps=os.listdir) as listdir:
+            self._open('a', 'aaa')
+            self._open('b', 'bbb')
+            self._open('a', 'aaa')
+            self._open('c', 'ccc')
+            self.assertEqual(listdir.call_count, 1)
+            self._open('d', 'ddd')
+            self.assertEqual(listdir.call_count, 2)
+        self.assertEqual(len(os.listdir(self.cache.path)), 3)
+        self.assertEqual(self.cache._total, 9)
+        self.cache.clear()
+        self._open('a', 'aaa')
+        self.assertEqual(self.cache._total, 3)
+
+    def test_failed_build_not_cached(self):
+        def fill(f):
+            f.write('partial')
+            raise IOError
+        self.assertRaises(IOError, self.cache.open, 'a', fill)
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+    def test_concurrent_requests_build_once(self):
+        started, release = threading.Event(), threading.Event()
+
+        def fill(f):
+            self.built.append('a')
+            started.set()
+            release.wait()
+            f.write('aaa')
+
+        results = []
+
+        def target():
+            with self.cache.open('a', fill) as f:
+                results.append(f.read())
+        threads = [threading.Thread(target=target) for x in xrange(2)]
+        threads[0].start()
+        started.wait()
+        threads[1].start()
+        while self.cache._locks['a'][1] < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['aaa', 'aaa'])
+        self.assertEqual(self.built, ['a'])
+
+    def test_locks_dropped_once_unused(self):
+        self._open('a', 'aaa')
+        self._open('b', 'bbb')
+        self.assertEqual(self.cache._locks, {})
+
+        def fill(f):
+            raise IOError
+        self.assertRaises(IOError, self.cache.open, 'c', fill)
+        self.assertEqual(self.cache._locks, {})
+
+    def test_archive_bigger_than_budget(self):
+        self.assertEqual(self._open('a', 'a' * 20), 'a' * 20)
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+
 # For each backend create test case class
 for alias in SCM_TESTS:
     attrs = {
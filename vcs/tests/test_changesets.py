@@ -1,6 +1,7 @@
 from __future__ import with_statement
 
 import datetime
+import mock
 import vcs
 from vcs.tests.base import BackendTestMixin
 from vcs.tests.conf import SCM_TESTS
@@ -11,9 +12,10 @@ from vcs.nodes import (
     ChangedFileNodesGenerator, RemovedFileNodesGenerator
 )
 from vcs.exceptions import (
-    BranchDoesNotExistError, ChangesetDoesNotExistError,
-    RepositoryError
+    BranchDoesNotExistError, ChangesetDoesNotExistError, ChangesetError,
+    RepositoryError, VCSError
 )
+from vcs.utils import blame
 from vcs.utils.compat import unittest
 
 
@@ -76,6 +78,159 @@ class ChangesetsWithCommitsTestCaseixin(BackendTestMixin):
         # 'foobar' should be the only branch that contains the new commit
         self.assertNotEqual(*self.repo.branches.values())
 
+    def test_get_last_changesets(self):
+        self.imc.add(FileNode('docs/index.txt', content='Documentation\n'))
+        self.imc.change(FileNode('file_1.txt', content='Changed'))
+        tip = self.imc.commit(message=u'Docs', author=u'joe')
+        expected = {'docs': tip, 'file_1.txt': tip}
+        for x in (0, 2, 3, 4):
+            expected['file_%d.txt' % x] = self.repo.get_changeset(x)
+        self.assertEqual(tip.get_last_changesets(''), expected)
+        self.assertEqual(tip.get_last_changesets('docs'),
+            {'docs/index.txt': tip})
+        self.assertEqual(self.repo.get_changeset(2).get_last_changesets(''),
+            dict(('file_%d.txt' % x, self.repo.get_changeset(x))
+                 for x in xrange(3)))
+        self.assertRaises(ChangesetError, tip.get_last_changesets,
+            'file_1.txt')
+
+    def test_get_last_changesets_of_merges(self):
+        date = datetime.datetime(2010, 1, 10, 20)
+        self.imc.add(FileNode('d/a.txt', content='a'))
+        self.imc.add(FileNode('d/b.txt', content='b'))
+        self.imc.add(FileNode('d/e/c.txt', content='c'))
+        base = self.imc.commit(message=u'Base', author=u'joe', date=date)
+        self.imc.change(FileNode('d/a.txt', content='main'))
+        main = self.imc.commit(message=u'Main', author=u'joe',
+            parents=[base], date=date + datetime.timedelta(hours=1))
+        self.imc.change(FileNode('d/a.txt', content='side'))
+        self.imc.change(FileNode('d/b.txt', content='side'))
+        self.imc.change(FileNode('d/e/c.txt', content='side'))
+        side = self.imc.commit(message=u'Side', author=u'joe',
+            branch='side', parents=[base],
+            date=date + datetime.timedelta(hours=2))
+        # merge drops changes of a.txt and d/e made at side branch
+        self.imc.change(FileNode('d/b.txt', content='merged'))
+        merge = self.imc.commit(message=u'Merge', author=u'joe',
+            branch=self.backend_class.DEFAULT_BRANCH_NAME,
+            parents=[main, side], date=date + datetime.timedelta(hours=3))
+        last = merge.get_last_changesets('d')
+        self.assertEqual(last, {'d/a.txt': main, 'd/b.txt': merge,
+                                'd/e': base})
+        for path in ('d/a.txt', 'd/b.txt'):
+            self.assertEqual(last[path], merge.get_node(path).last_changeset)
+
+    def test_get_last_changesets_of_unicode_path(self):
+        path = u'd\u017a/\u017c\xf3\u0142w.txt'.encode('utf-8')
+        self.imc.add(FileNode(path, content='Zolw'))
+        tip = self.imc.commit(message=u'Unicode', author=u'joe')
+        self.assertEqual(tip.get_last_changesets(u'd\u017a'), {path: tip})
+        self.assertEqual(tip.get_last_changesets(u'd\u017a'.encode('utf-8')),
+            {path: tip})
+        self.assertEqual(tip.get_last_changesets(u'd\u017a').keys(),
+            [node.path for node in tip.get_node(u'd\u017a').nodes])
+
+    def test_iter_file_history(self):
+        for x in xrange(3):
+            self.imc.change(FileNode('file_1.txt', content='Change %d' % x))
+            self.imc.commit(message=u'Change %d' % x, author=u'joe')
+        tip = self.repo.get_changeset()
+        history = [cs.revision for cs in tip.iter_file_history('file_1.txt')]
+        self.assertEqual(history, [7, 6, 5, 1])
+        self.assertEqual([cs.revision for cs in
+            tip.iter_file_history('file_1.txt', offset=1, limit=2)], [6, 5])
+        self.assertEqual([cs.revision for cs in
+            tip.iter_file_history('file_1.txt', offset=3)], [1])
+        self.assertEqual(tip.get_file_history('file_1.txt', limit=1),
+            [tip])
+        self.assertEqual([cs.revision for cs in self.repo.get_changeset(5)
+            .iter_file_history('file_1.txt')], [5, 1])
+
+    def test_file_history_of_unmodified_file(self):
+        self.imc.change(FileNode('file_2.txt', content='Changed'))
+        tip = self.imc.commit(message=u'Change', author=u'joe')
+        self.assertEqual([cs.revision for cs in
+            tip.get_file_history('file_1.txt')], [1])
+        self.assertEqual(tip.get_node('file_1.txt').last_changeset.revision,
+            1)
+        self.assertEqual([cs.revision for cs in self.repo.get_changeset(3)
+            .iter_file_history('file_0.txt')], [0])
+
+    def test_get_file_annotate(self):
+        self.imc.change(FileNode('file_1.txt',
+            content='Foobar 1\nline 2\nline 3\n'))
+        first = self.imc.commit(message=u'Lines', author=u'joe')
+        self.imc.change(FileNode('file_1.txt',
+            content='Foobar 1\nchanged\nline 3\nline 4'))
+        tip = self.imc.commit(message=u'Change', author=u'joe')
+
+        # partially read annotation is not cached
+        annotate = tip.get_file_annotate('file_1.txt')
+        annotate.next()
+        annotate.close()
+        self.assertEqual(len(self.repo._annotate_cache), 0)
+
+        annotate = list(tip.get_file_annotate('file_1.txt'))
+        self.assertEqual([(lineno, sha, line)
+            for lineno, sha, loader, line in annotate], [
+            (1, first.raw_id, 'Foobar 1\n'),
+            (2, tip.raw_id, 'changed\n'),
+            (3, first.raw_id, 'line 3\n'),
+            (4, tip.raw_id, 'line 4'),
+        ])
+        self.assertEqual([loader() for lineno, sha, loader, line in annotate],
+            [first, tip, first, tip])
+        # every distinct changeset gets single loader
+        self.assertTrue(annotate[0][2] is annotate[2][2])
+        self.assertTrue(annotate[1][2]() is annotate[3][2]())
+
+        self.assertEqual(len(self.repo._annotate_cache), 1)
+        cached = list(tip.get_file_annotate('file_1.txt'))
+        self.assertEqual([x[:2] + x[3:] for x in cached],
+                         [x[:2] + x[3:] for x in annotate])
+        self.assertEqual(len(self.repo._annotate_cache), 1)
+        self.assertRaises(VCSError, tip.get_file_annotate, 'missing')
+
+    def test_get_file_annotate_derived_from_parent(self):
+        self.imc.change(FileNode('file_1.txt', content='a\nb\nc\n'))
+        first = self.imc.commit(message=u'Lines', author=u'joe')
+        self.imc.add(FileNode('other.txt', content='other'))
+        self.imc.commit(message=u'Other', author=u'joe')
+        self.imc.change(FileNode('file_1.txt', content='a\nB\nC\nc\n'))
+        tip = self.imc.commit(message=u'Change', author=u'joe')
+        expected = [x[:2] + x[3:] for x in tip.get_file_annotate('file_1.txt')]
+
+        self.repo._annotate_cache.clear()
+        list(first.get_file_annotate('file_1.txt'))
+        with mock.patch('vcs.utils.blame._iter_caching') as computed:
+            derived = [x[:2] + x[3:]
+                       for x in tip.get_file_annotate('file_1.txt')]
+            self.assertFalse(computed.called)
+        self.assertEqual(derived, expected)
+        self.assertEqual([sha for lineno, sha, line in derived],
+            [first.raw_id, tip.raw_id, tip.raw_id, first.raw_id])
+        # annotations of changesets in between are cached as well
+        self.assertEqual(len(self.repo._annotate_cache), 3)
+
+    def test_get_file_annotate_not_derived_if_ambiguous(self):
+        self.imc.change(FileNode('file_1.txt', content='a\n\nb\n'))
+        first = self.imc.commit(message=u'Lines', author=u'joe')
+        self.imc.change(FileNode('file_1.txt', content='a\n\nb\n\nb\n'))
+        tip = self.imc.commit(message=u'Change', author=u'joe')
+        self.repo._annotate_cache.clear()
+        list(first.get_file_annotate('file_1.txt'))
+        with mock.patch('vcs.utils.blame._iter_caching',
+                        wraps=blame._iter_caching) as computed:
+            list(tip.get_file_annotate('file_1.txt'))
+            self.assertTrue(computed.called)
+
+    def test_get_file_annotate_does_not_walk_uncached_paths(self):
+        self.repo._annotate_cache.clear()
+        list(self.repo.get_changeset(3).get_file_annotate('file_1.txt'))
+        tip = self.repo.get_changeset()
+        list(tip.get_file_annotate('file_0.txt'))
+        self.assertFalse('parents' in tip.__dict__)
+
     def test_new_head_in_default_branch(self):
         tip = self.repo.get_changeset()
         self.imc.add(vcs.nodes.FileNode('docs/index.txt',
@@ -124,6 +279,30 @@ class ChangesetsWithCommitsTestCaseixin(BackendTestMixin):
             branch_name=self.repo.DEFAULT_BRANCH_NAME)
         self.assertNotIn(doc_changeset, default_branch_changesets)
 
+    def test_next_and_prev_respect_branch(self):
+        tip = self.repo.get_changeset()
+        self.imc.add(vcs.nodes.FileNode('docs/index.txt',
+            content='Documentation\n'))
+        doc_changeset = self.imc.commit(
+            message=u'New branch: docs',
+            author=u'joe',
+            branch='docs',
+        )
+        self.imc.add(vcs.nodes.FileNode('newfile', content=''))
+        default_tip = self.imc.commit(
+            message=u'Back in default branch',
+            author=u'joe',
+            parents=[tip],
+        )
+        default = self.repo.DEFAULT_BRANCH_NAME
+        self.assertEqual(tip.next(), doc_changeset)
+        self.assertEqual(tip.next(default), default_tip)
+        self.assertEqual(default_tip.prev(), doc_changeset)
+        self.assertEqual(default_tip.prev(default), tip)
+        self.assertRaises(VCSError, doc_changeset.next, default)
+        self.assertRaises(ChangesetDoesNotExistError, default_tip.next,
+            default)
+
     def test_get_changeset_by_branch(self):
         for branch, sha in self.repo.branches.iteritems():
             self.assertEqual(sha, self.repo.get_changeset(branch).raw_id)
@@ -220,6 +399,13 @@ class ChangesetsTestCaseMixin(BackendTestMixin):
             self.assertGreaterEqual(cs.date, start_date)
             self.assertLessEqual(cs.date, end_date)
 
+    def test_get_changesets_respects_start_and_start_date(self):
+        start_date = datetime.datetime(2010, 1, 2, 12)
+        changesets = list(self.repo.get_changesets(
+            start=self.repo.revisions[2], start_date=start_date))
+        self.assertEqual([cs.raw_id for cs in changesets],
+            self.repo.revisions[2:])
+
     def test_get_changesets_respects_start_date_and_end_date_and_branch_name(self):
         start_date = datetime.datetime(2010, 1, 1)
         end_date = datetime.datetime(2010, 1, 3)
@@ -343,6 +529,17 @@ class ChangesetsChangesTestCaseMixin(BackendTestMixin):
         self.assertEqual(len(changeset.removed), 1)
         self.assertEqual(list(changeset.removed)[0].path, 'qwe')
 
+    def test_get_nodes_paginated(self):
+        changeset = self.repo.get_changeset()
+        nodes = changeset.get_nodes('')
+        self.assertEqual([node.path for node in nodes],
+            ['foo', 'fallout', 'foobar'])
+        self.assertEqual(changeset.get_nodes('', offset=1, limit=1),
+            [changeset.get_node('fallout')])
+        self.assertEqual(changeset.get_nodes('', offset=1), nodes[1:])
+        self.assertEqual(changeset.get_nodes('', limit=2), nodes[:2])
+        self.assertEqual(changeset.get_nodes('', offset=3), [])
+
 
 # For each backend create test case class
 for alias in SCM_TESTS:
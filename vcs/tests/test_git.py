@@ -2,11 +2,33 @@ from __future__ import with_statement
 
 import os
 import mock
+import time
+import threading
+import tarfile
+import zipfile
 import datetime
+import StringIO
+from dulwich import objects
 from vcs.backends.git import GitRepository, GitChangeset
-from vcs.exceptions import RepositoryError, VCSError, NodeDoesNotExistError
+from vcs.backends.git import refs
+from vcs.backends.git import bloom
+from vcs.backends.git import revindex
+from vcs.backends.git import handles
+from vcs.backends.git.bloom import GitChangedPathsIndex, get_path_keys
+from vcs.backends.git.catfile import CatFilePool, PIPELINE_DEPTH
+from vcs.backends.git.executor import CommandQueueTimeoutError, \
+    FairSemaphore, GitCommandExecutor
+from vcs.backends.git.revindex import GitRevisionIndex, get_index_path
+from vcs.backends.git.trees import GitTreeCache, GitTreeChangesCache
+from vcs.backends.git.walker import GitCommitWalker, ORDER_DATE, ORDER_TOPO
+from vcs.conf import settings
+from vcs.exceptions import (
+    ChangesetError, ChangesetDoesNotExistError, NodeDoesNotExistError,
+    RepositoryError, VCSError
+)
 from vcs.nodes import NodeKind, FileNode, DirNode, NodeState
-from vcs.utils.compat import unittest
+from vcs.subprocessio import OutputLimitError
+from vcs.utils.compat import kill, unittest
 from vcs.tests.base import BackendTestMixin
 from vcs.tests.conf import TEST_GIT_REPO, TEST_GIT_REPO_CLONE, get_new_dir
 
@@ -630,6 +652,201 @@ class GitSpecificWithRepoTest(BackendTestMixin, unittest.TestCase):
         self.assertEqual(cs.get_node('foobar/static/js/admin/base.js').content,
             'base')
 
+    def test_get_changesets_ignores_unlisted_start_and_end(self):
+        first, second = self.repo.revisions
+        commit = objects.Commit()
+        commit.tree = self.repo._repo[second].tree
+        commit.parents = [second]
+        commit.author = commit.committer = 'Joe Doe <joe.doe@example.com>'
+        commit.author_time = commit.commit_time = 1262383200
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = 'Tagged only'
+        self.repo._repo.object_store.add_object(commit)
+        self.repo._repo.refs['refs/tags/lone'] = commit.id
+        self.repo._refresh_refs()
+        with mock.patch.object(settings, 'GIT_REV_FILTER', '--branches'):
+            repo = GitRepository(self.repo.path)
+            self.assertEqual(list(repo.revisions), [first, second])
+            for kwargs in ({'start': 'lone'}, {'end': commit.id},
+                           {'start': 'lone', 'end': 'lone'}):
+                self.assertEqual([cs.raw_id for cs in
+                                  repo.get_changesets(**kwargs)],
+                                 [first, second])
+            self.assertEqual([cs.raw_id for cs in
+                              repo.get_changesets(start=second, end='lone')],
+                             [second])
+            self.assertRaises(ChangesetDoesNotExistError,
+                              repo.get_changesets, start='f' * 40)
+
+    def test_fill_archive_of_directory(self):
+        cs = self.repo.get_changeset()
+        for kind, mode in (('tgz', 'r|gz'), ('tbz2', 'r|bz2'),
+                           ('tar', 'r|')):
+            stream = StringIO.StringIO()
+            with mock.patch.object(settings, 'ARCHIVE_THREADS', 3):
+                cs.fill_archive(stream, kind, prefix='repo',
+                                path='foobar/static', level=1)
+            stream.seek(0)
+            archive = tarfile.open(fileobj=stream, mode=mode)
+            self.assertEqual([info.name for info in archive], ['repo',
+                'repo/admin', 'repo/js', 'repo/js/admin',
+                'repo/js/admin/base.js'])
+        self.assertRaises(ChangesetError, cs.fill_archive, stream,
+                          path='foo')
+
+        stream = StringIO.StringIO()
+        cs.fill_archive(stream, 'zip', prefix='repo', path='foobar/static/js',
+                        level=0)
+        archive = zipfile.ZipFile(stream)
+        self.assertEqual(archive.namelist(), ['repo/', 'repo/admin/',
+            'repo/admin/base.js'])
+        self.assertEqual(archive.read('repo/admin/base.js'), 'base')
+        self.assertEqual(archive.comment, cs.raw_id)
+
+    def test_trees_are_shared_between_changesets(self):
+        cache = self.repo._tree_cache
+        cache.clear()
+        path = 'foobar/static/js/admin/base.js'
+        self.assertEqual(self.repo.get_changeset(0).get_file_content(path),
+            'base')
+        self.assertEqual(len(cache), 5)
+        changeset = GitRepository(self.repo.path).get_changeset(1)
+        self.assertEqual(changeset.get_file_content(path), 'base')
+        self.assertEqual(len(cache), 6)
+        self.assertEqual(changeset.get_file_mode('foobar/static/js'),
+            040000)
+        self.assertRaises(NodeDoesNotExistError, changeset.get_node,
+            'foo/bar')
+
+    def test_last_changesets_are_cached(self):
+        last = self.repo.get_changeset().get_last_changesets('foobar/static')
+        self.assertEqual(last, {
+            'foobar/static/js': self.repo.get_changeset(0),
+            'foobar/static/admin': self.repo.get_changeset(0),
+        })
+        changeset = GitRepository(self.repo.path).get_changeset()
+        with mock.patch.object(GitChangeset, '_get_last_changes') as m:
+            self.assertEqual(changeset.get_last_changesets('foobar/static'),
+                last)
+            self.assertFalse(m.called)
+
+    def test_get_nodes_does_not_read_objects(self):
+        cs = self.repo.get_changeset()
+        self.assertEqual(len(cs.get_nodes('foobar/static')), 2)
+        store = self.repo._repo.object_store
+        with mock.patch.object(type(store), '__getitem__',
+                               side_effect=AssertionError):
+            nodes = cs.get_nodes('foobar/static')
+        self.assertEqual([node.path for node in nodes],
+            ['foobar/static/js', 'foobar/static/admin'])
+
+    def test_tree_cache_is_bounded(self):
+        cache = GitTreeCache(size=3)
+        store = self.repo._repo.object_store
+        first = self.repo.get_changeset(0)._tree_id
+        second = self.repo.get_changeset(1)._tree_id
+        self.assertEqual(sorted(cache.get_entries(first, store)),
+            ['foo', 'foobar'])
+        self.assertTrue(first in cache)
+        self.assertEqual(len(cache.get_entries(second, store)), 3)
+        self.assertFalse(first in cache)
+        self.assertTrue(second in cache)
+
+    def test_tree_changes_are_cached(self):
+        self.assertEqual([node.path for node in
+            self.repo.get_changeset(1).added], ['foo2'])
+        with mock.patch('vcs.backends.git.trees.diff_trees',
+                        side_effect=AssertionError):
+            changeset = GitRepository(self.repo.path).get_changeset(1)
+            self.assertEqual([node.path for node in changeset.added],
+                ['foo2'])
+
+    def test_tree_changes_skip_identical_subtrees(self):
+        store = self.repo._repo.object_store
+        first = self.repo.get_changeset(0)._tree_id
+        second = self.repo.get_changeset(1)._tree_id
+        cache = GitTreeCache(size=100)
+        with mock.patch.object(cache, 'get_entries',
+                               wraps=cache.get_entries) as get_entries:
+            changes = GitTreeChangesCache(size=100).get_changes(cache, store,
+                first, second)
+        self.assertEqual([change.new.path for change in changes], ['foo2'])
+        # only root trees are read, ``foobar`` is the same at both sides
+        self.assertEqual(get_entries.call_count, 2)
+
+    def test_renames_are_detected_from_cached_changes(self):
+        store = self.repo._repo.object_store
+        first = self.repo.get_changeset(0)._tree_id
+        second = self.repo.get_changeset(1)._tree_id
+        cache = GitTreeChangesCache(size=100)
+        cache.get_changes(self.repo._tree_cache, store, first, second)
+        with mock.patch('vcs.backends.git.trees.diff_trees',
+                        side_effect=AssertionError):
+            changes = cache.get_changes_with_renames(self.repo._tree_cache,
+                store, first, second)
+        self.assertEqual([change.new.path for change in changes], ['foo2'])
+
+    def test_tree_changes_cache_is_bounded(self):
+        cache = GitTreeChangesCache(size=3)
+        tree_cache = self.repo._tree_cache
+        store = self.repo._repo.object_store
+        first = self.repo.get_changeset(0)._tree_id
+        second = self.repo.get_changeset(1)._tree_id
+        self.assertEqual(len(cache.get_changes(tree_cache, store, None,
+                                               first)), 3)
+        self.assertTrue((None, first) in cache)
+        self.assertEqual(len(cache.get_changes(tree_cache, store, first,
+                                               second)), 1)
+        self.assertFalse((None, first) in cache)
+        self.assertTrue((first, second) in cache)
+
+    def test_dulwich_repo_is_reused(self):
+        self.assertTrue(self.repo._repo is self.repo._repo)
+        other = GitRepository(self.repo.path)
+        self.assertTrue(other._repo is self.repo._repo)
+
+    def test_dulwich_repo_is_shared_between_threads(self):
+        repos = []
+        thread = threading.Thread(target=lambda:
+                                  repos.append(self.repo._repo))
+        thread.start()
+        thread.join()
+        self.assertTrue(repos[0] is self.repo._repo)
+
+    def test_least_recently_used_handles_are_dropped(self):
+        handle = self.repo._handle
+        store = self.repo._repo.object_store
+        pool = self.repo._cat_file_pool
+        with mock.patch.object(settings, 'GIT_REPO_HANDLES', 1):
+            self.assertTrue(handles.get_repo_handle(self.repo.path) is handle)
+            with mock.patch.object(store, 'close') as close:
+                with mock.patch.object(pool, 'close') as close_pool:
+                    other = handles.get_repo_handle(self.repo.path + '-other')
+                    close_pool.assert_called_once_with()
+                # repo may still be used by other threads
+                self.assertFalse(close.called)
+            self.assertFalse(other is handle)
+            self.assertFalse(handles.get_repo_handle(self.repo.path)
+                             is handle)
+        # repository objects holding dropped handle keep working
+        self.assertTrue(self.repo._repo.object_store is store)
+        self.assertEqual(self.repo.get_changeset().raw_id,
+                         self.repo.revisions[-1])
+
+    def test_dulwich_repo_is_reopened_if_packed_refs_changed(self):
+        old = self.repo._repo
+        packed_refs = os.path.join(old.controldir(), 'packed-refs')
+        open(packed_refs, 'a').close()
+        os.utime(packed_refs, (1, 1))
+        self.assertFalse(self.repo._repo is old)
+        self.assertTrue(self.repo._repo is self.repo._repo)
+
+    def test_get_changeset_by_abbreviated_id(self):
+        tip = self.repo.get_changeset()
+        self.assertEqual(self.repo.get_changeset(tip.short_id), tip)
+        self.assertRaises(ChangesetDoesNotExistError,
+            self.repo.get_changeset, 'deadbeefdeadbeef')
+
     def test_workdir_get_branch(self):
         self.repo.run_git_command('checkout -b production')
         # Regression test: one of following would fail if we don't check
@@ -639,6 +856,16 @@ class GitSpecificWithRepoTest(BackendTestMixin, unittest.TestCase):
         self.repo.run_git_command('checkout master')
         self.assertEqual(self.repo.workdir.get_branch(), 'master')
 
+    def test_git_command_output_is_limited(self):
+        self.assertEqual(len(self.repo.run_git_command('log -p',
+                                                       _max_output=10000)[0]),
+                         len(self.repo.run_git_command('log -p')[0]))
+        self.assertRaises(OutputLimitError, self.repo.run_git_command,
+                          'log -p', _max_output=10)
+        with mock.patch.object(settings, 'GIT_COMMAND_MAX_OUTPUT', 10):
+            self.assertRaises(OutputLimitError, self.repo.run_git_command,
+                              'log -p')
+
     def test_get_diff_runs_git_command_with_hashes(self):
         self.repo.run_git_command = mock.Mock(return_value=['', ''])
         self.repo.get_diff(0, 1)
@@ -661,6 +888,593 @@ class GitSpecificWithRepoTest(BackendTestMixin, unittest.TestCase):
             % (3, self.repo._get_revision(0), self.repo._get_revision(1)))
 
 
+class GitRevisionIndexTest(BackendTestMixin, unittest.TestCase):
+    backend_alias = 'git'
+    recreate_repo_per_test = True
+
+    def _get_index_path(self):
+        return get_index_path(self.repo._repo.controldir())
+
+    def test_revision_index_is_persisted(self):
+        revisions = GitRepository(self.repo.path).revisions
+        self.assertEqual(revisions, self.repo.revisions)
+        index = GitRevisionIndex.load(self._get_index_path())
+        self.assertEqual(index.revisions, revisions)
+        self.assertEqual(list(index.generations), [1, 2])
+        self.assertEqual(index.get_parents(1), [0])
+        self.assertTrue(index.is_ancestor(0, 1))
+        self.assertFalse(index.is_ancestor(1, 0))
+
+    def test_revision_index_is_extended_with_new_commits(self):
+        GitRepository(self.repo.path).revisions
+        self.imc.add(FileNode('foo3', content='foo3'))
+        tip = self.imc.commit(u'Third', u'joe.doe@example.com')
+        with mock.patch.object(GitRepository, '_build_revision_index') as m:
+            revisions = GitRepository(self.repo.path).revisions
+            self.assertFalse(m.called)
+        self.assertEqual(revisions, self.repo.revisions)
+        self.assertEqual(revisions[-1], tip.raw_id)
+        index = GitRevisionIndex.load(self._get_index_path())
+        self.assertEqual(index.revisions, revisions)
+
+    def test_stale_lock_file_is_removed(self):
+        path = self._get_index_path()
+        index = GitRevisionIndex.load(path)
+        os.remove(path)
+        lock_path = path + '.lock'
+        open(lock_path, 'wb').close()
+        self.assertFalse(index.save(path))
+        old = time.time() - revindex.STALE_LOCK_AGE - 1
+        os.utime(lock_path, (old, old))
+        self.assertTrue(index.save(path))
+        self.assertFalse(os.path.exists(lock_path))
+        self.assertEqual(GitRevisionIndex.load(path).revisions,
+            index.revisions)
+
+    def test_revision_index_is_rebuilt_if_branch_is_rewound(self):
+        revisions = GitRepository(self.repo.path).revisions
+        self.repo._repo.refs['refs/heads/master'] = revisions[0]
+        with mock.patch.object(settings, 'GIT_REFS_CHECK_INTERVAL', 0):
+            self.assertEqual(GitRepository(self.repo.path).revisions,
+                revisions[:1])
+
+    def test_branch_bits_are_extended_with_new_commits(self):
+        self.assertEqual(self.repo._get_branch_bits('master'), 0b11)
+        self.imc.add(FileNode('foo3', content='foo3'))
+        self.imc.commit(u'Third', u'joe.doe@example.com')
+        index = self.repo._revision_index
+        with mock.patch.object(index, 'get_ancestors_bits',
+                               wraps=index.get_ancestors_bits) as m:
+            self.assertEqual(self.repo._get_branch_bits('master'), 0b111)
+            m.assert_called_once_with(2, 0b11)
+
+    def test_children_are_kept_for_new_commits(self):
+        index = self.repo._revision_index
+        self.assertEqual(index.get_children(0), [1])
+        self.assertEqual(index.get_children(1), [])
+        self.imc.add(FileNode('foo3', content='foo3'))
+        tip = self.imc.commit(u'Third', u'joe.doe@example.com')
+        self.assertEqual(index.get_children(1), [2])
+        self.assertEqual(self.repo.get_changeset(1).children, [tip])
+
+    def test_corrupted_revision_index_is_ignored(self):
+        revisions = GitRepository(self.repo.path).revisions
+        with open(self._get_index_path(), 'r+b') as f:
+            f.seek(30)
+            f.write('garbage')
+        self.assertEqual(GitRevisionIndex.load(self._get_index_path()), None)
+        self.assertEqual(GitRepository(self.repo.path).revisions, revisions)
+
+
+class GitRefsSnapshotTest(BackendTestMixin, unittest.TestCase):
+    backend_alias = 'git'
+    recreate_repo_per_test = True
+
+    def _add_annotated_tag(self, name, sha):
+        tag = objects.Tag()
+        tag.name = name
+        tag.object = (objects.Commit, sha)
+        tag.tagger = 'Joe Doe <joe.doe@example.com>'
+        tag.message = 'Release'
+        tag.tag_time = 1234567890
+        tag.tag_timezone = 0
+        self.repo._repo.object_store.add_object(tag)
+        self.repo._repo.refs['refs/tags/%s' % name] = tag.id
+
+    def test_snapshot_is_shared_and_reused(self):
+        with mock.patch.object(refs, 'RACY_INTERVAL', -1):
+            snapshot = self.repo._refresh_refs()
+            repo = GitRepository(self.repo.path)
+            self.assertTrue(repo._refs is snapshot)
+            self.assertEqual(repo.branches.keys(), ['master'])
+            self.assertTrue(self.repo._refs is snapshot)
+
+    def test_snapshot_is_rebuilt_if_refs_changed(self):
+        snapshot = self.repo._refs
+        tip = self.repo.revisions[-1]
+        repo = GitRepository(self.repo.path)
+        repo._repo.refs['refs/heads/foo'] = tip
+        repo._repo.refs['refs/tags/bar'] = tip
+        self.assertTrue(self.repo._refs is snapshot)
+        with mock.patch.object(settings, 'GIT_REFS_CHECK_INTERVAL', 0):
+            self.assertFalse(self.repo._refs is snapshot)
+        self.assertEqual(self.repo.branches.keys(), ['foo', 'master'])
+        self.assertEqual(self.repo.tags.keys(), ['bar'])
+        self.assertEqual(self.repo._heads(reverse=True)['foo'], tip)
+
+    def test_refs_are_checked_once_per_interval(self):
+        snapshot = self.repo._refresh_refs()
+        snapshot.racy = False
+        with mock.patch.object(refs, '_get_mtime') as get_mtime:
+            self.assertFalse(snapshot.is_stale(60))
+            self.assertFalse(get_mtime.called)
+            snapshot._checked -= 60
+            self.assertTrue(snapshot.is_stale(60))
+            self.assertTrue(get_mtime.called)
+            get_mtime.reset_mock()
+            self.assertFalse(snapshot.is_stale(60))
+            self.assertFalse(get_mtime.called)
+
+    def test_racy_snapshot_is_rebuilt_once_interval_passes(self):
+        snapshot = self.repo._refresh_refs()
+        self.assertTrue(snapshot.racy)
+        self.assertFalse(snapshot.is_stale(60))
+        snapshot.taken -= refs.RACY_INTERVAL + 1
+        self.assertTrue(snapshot.is_stale(60))
+
+    def test_snapshot_is_swapped_after_tag_changes(self):
+        repo = GitRepository(self.repo.path)
+        changeset = self.repo.get_changeset(0)
+        self.repo.tag('v0.1', 'joe', revision=changeset.raw_id)
+        self.assertEqual(repo.tags.keys(), ['v0.1'])
+        self.assertEqual(repo.get_changeset(0).tags, ['v0.1'])
+        self.assertEqual(repo.get_changeset('v0.1'), changeset)
+        self.repo.remove_tag('v0.1', 'joe')
+        self.assertEqual(repo.tags.keys(), [])
+
+    def test_changeset_branch(self):
+        self.imc.add(FileNode('foo3', content='foo3'))
+        tip = self.imc.commit(u'Third', u'joe.doe@example.com',
+                              branch='feature')
+        self.assertEqual(tip.branch, u'feature')
+        self.assertEqual(GitRepository(self.repo.path).branches.keys(),
+                         ['feature', 'master'])
+        self.assertEqual(self.repo.get_changeset(0).branch, None)
+
+    def test_packed_tags_are_peeled_without_reading_objects(self):
+        tip = self.repo.revisions[-1]
+        self._add_annotated_tag('v1.0', tip)
+        self.repo.run_git_command('tag v1.1 %s' % tip)
+        self.repo.run_git_command('pack-refs --all')
+        with mock.patch.object(refs, 'peel_tag') as peel_tag:
+            snapshot = self.repo._refresh_refs()
+            self.assertFalse(peel_tag.called)
+        self.assertEqual(snapshot.tags, {'v1.0': tip, 'v1.1': tip})
+        self.assertEqual(snapshot.tags_by_sha, {tip: ['v1.1', 'v1.0']})
+
+    def test_loose_tags_are_peeled_once(self):
+        tip = self.repo.revisions[-1]
+        self._add_annotated_tag('v1.0', tip)
+        snapshot = self.repo._refresh_refs()
+        self.assertEqual(snapshot.tags, {'v1.0': tip})
+        self.assertNotEqual(snapshot.refs['refs/tags/v1.0'], tip)
+        with mock.patch.object(refs, 'peel_tag', return_value=tip) as m:
+            self.repo.tag('v1.1', 'joe', revision=tip)
+            m.assert_called_once_with(mock.ANY, tip)
+        self.assertEqual(self.repo._refs.tags, {'v1.0': tip, 'v1.1': tip})
+
+    def test_snapshot_lookups_are_computed_when_built(self):
+        tip = self.repo.revisions[-1]
+        self.repo.run_git_command('tag v1.0 %s' % tip)
+        snapshot = self.repo._refresh_refs()
+        lookups = dict(vars(snapshot))
+        self.assertEqual(snapshot.tags_by_sha, {tip: ['v1.0']})
+        self.assertEqual(snapshot.parsed['master'], [tip, 'H'])
+        self.assertEqual(vars(snapshot), lookups)
+
+
+class GitChangedPathsIndexTest(BackendTestMixin, unittest.TestCase):
+    backend_alias = 'git'
+    recreate_repo_per_test = True
+
+    def _get_index_path(self):
+        return bloom.get_index_path(self.repo._repo.controldir())
+
+    def _might_change(self, index, revision, path):
+        return index.might_change(self.repo.revisions.index(revision),
+            revision, [get_path_keys(path)])
+
+    def test_filters(self):
+        index = GitChangedPathsIndex()
+        index.append('a' * 40, ['foo', 'foo/bar'])
+        index.append('b' * 40, [])
+        index.append('c' * 40, None)
+        self.assertTrue(index.might_change(0, 'a' * 40, [get_path_keys('foo')]))
+        self.assertTrue(index.might_change(0, 'a' * 40,
+            [get_path_keys('baz'), get_path_keys('foo/bar')]))
+        self.assertFalse(index.might_change(1, 'b' * 40,
+            [get_path_keys('foo')]))
+        self.assertTrue(index.might_change(2, 'c' * 40,
+            [get_path_keys('foo')]))
+        # filters not matching revisions or not computed yet are not trusted
+        self.assertTrue(index.might_change(1, 'd' * 40,
+            [get_path_keys('foo')]))
+        self.assertTrue(index.might_change(3, 'd' * 40,
+            [get_path_keys('foo')]))
+
+    def test_changed_paths_index_is_persisted(self):
+        self.assertEqual(self.repo.get_changeset().get_file_history('foobar'),
+            [self.repo.get_changeset(1), self.repo.get_changeset(0)])
+        index = GitChangedPathsIndex.load(self._get_index_path())
+        self.assertEqual(len(index), 2)
+        self.assertTrue(index.matches(self.repo.revisions))
+        tip = self.repo.revisions[-1]
+        self.assertTrue(self._might_change(index, tip, 'foobar'))
+        self.assertTrue(self._might_change(index, tip, 'some'))
+        self.assertTrue(self._might_change(index, tip, 'some/new.txt'))
+        self.assertFalse(self._might_change(index, tip, 'foo'))
+
+    def test_changed_paths_index_is_extended_with_new_commits(self):
+        self.repo.get_changeset().get_file_history('foobar')
+        self.imc.add(FileNode('foo/bar/qux', content='qux'))
+        tip = self.imc.commit(u'Fourth', u'joe.doe@example.com')
+        repo = GitRepository(self.repo.path)
+        with mock.patch('vcs.backends.git.repository.get_changed_paths',
+                        wraps=bloom.get_changed_paths) as m:
+            self.assertEqual(list(GitCommitWalker(repo,
+                [tip.raw_id], paths=['foo/bar'])), repo.revisions[::-2])
+            self.assertEqual(m.call_count, 1)
+        index = GitChangedPathsIndex.load(self._get_index_path())
+        self.assertEqual(len(index), 3)
+        self.assertTrue(self._might_change(index, tip.raw_id, 'foo'))
+        self.assertTrue(self._might_change(index, tip.raw_id, 'foo/bar/qux'))
+
+    def test_walk_computes_bounded_number_of_filters(self):
+        tip = self.repo.revisions[-1]
+        with mock.patch.object(settings, 'GIT_CHANGED_PATHS_BATCH', 1):
+            self.assertEqual(list(GitCommitWalker(self.repo, [tip],
+                paths=['foobar'])), self.repo.revisions[::-1])
+            self.assertEqual(len(GitChangedPathsIndex.load(
+                self._get_index_path())), 1)
+            repo = GitRepository(self.repo.path)
+            self.assertEqual(list(GitCommitWalker(repo, [tip],
+                paths=['foo/bar'])), [repo.revisions[0]])
+        self.assertEqual(len(GitChangedPathsIndex.load(
+            self._get_index_path())), 2)
+
+    def test_update_changed_paths_index(self):
+        index = self.repo.update_changed_paths_index()
+        self.assertEqual(len(index), len(self.repo.revisions))
+        self.assertEqual(len(GitChangedPathsIndex.load(
+            self._get_index_path())), len(self.repo.revisions))
+
+    def test_history_skips_commits_not_changing_paths(self):
+        walker = GitCommitWalker(self.repo, [self.repo.revisions[-1]],
+            paths=['foo/bar/baz'])
+        with mock.patch.object(walker, '_get_path_ids',
+                               wraps=walker._get_path_ids) as m:
+            self.assertEqual(list(walker), [self.repo.revisions[0]])
+            # only the root commit needs its tree to be read
+            self.assertEqual(m.call_count, 1)
+
+
+class GitCatFilePoolTest(BackendTestMixin, unittest.TestCase):
+    backend_alias = 'git'
+    recreate_repo_per_test = False
+
+    def setUp(self):
+        self.pool = CatFilePool(self.repo.path, size=2)
+        self.blob_id = self.repo.get_changeset()._get_id_for_path('foobar')
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_get_object(self):
+        self.assertEqual(self.pool.get_object(self.blob_id),
+            ('blob', 'Foobar I'))
+        self.assertEqual(self.pool.get_info(self.blob_id), ('blob', 8))
+        tree_id = self.repo.get_changeset()._tree_id
+        self.assertEqual(self.pool.get_info(tree_id)[0], 'tree')
+
+    def test_get_missing_object(self):
+        self.assertRaises(KeyError, self.pool.get_object, '0' * 40)
+        self.assertRaises(KeyError, self.pool.get_info, '0' * 40)
+
+    def test_iter_objects_is_pipelined(self):
+        shas = [self.blob_id, '0' * 40] * PIPELINE_DEPTH
+        responses = list(self.pool.iter_objects(shas))
+        self.assertEqual(responses,
+            [('blob', 'Foobar I'), None] * PIPELINE_DEPTH)
+        self.assertEqual(list(self.pool.iter_info(shas))[:2],
+            [('blob', 8), None])
+
+    def test_processes_are_reused_and_bounded(self):
+        self.pool.get_object(self.blob_id)
+        process = self.pool._idle[False][0]
+        self.pool.get_object(self.blob_id)
+        self.assertEqual(self.pool._idle[False], [process])
+        self.pool.get_info(self.blob_id)
+        self.assertEqual(self.pool._count, 2)
+        pool = CatFilePool(self.repo.path, size=1)
+        pool.get_info(self.blob_id)
+        pool.get_object(self.blob_id)
+        self.assertEqual((pool._count, pool._idle[True]), (1, []))
+        pool.close()
+
+    def test_dead_process_is_restarted(self):
+        self.pool.get_object(self.blob_id)
+        process = self.pool._idle[False][0]
+        kill(process.process)
+        process.process.wait()
+        self.assertEqual(self.pool.get_object(self.blob_id),
+            ('blob', 'Foobar I'))
+        self.assertFalse(process in self.pool._idle[False])
+        self.assertEqual(self.pool._count, 1)
+
+    def test_changeset_reads_objects_by_cat_file(self):
+        changeset = self.repo.get_changeset()
+        with mock.patch.object(settings, 'GIT_OBJECT_ENGINE', 'cat-file'):
+            with mock.patch.object(self.repo._repo.__class__, '__getitem__',
+                                   side_effect=AssertionError):
+                self.assertEqual(changeset.get_file_content('foobar'),
+                    'Foobar I')
+                self.assertEqual(changeset.get_file_size('foo/bar/baz'), 9)
+                self.assertTrue(changeset.get_node('foo').is_dir())
+                self.assertTrue(changeset.get_node('foo/bar/baz').is_file())
+
+
+class GitCommandExecutorTest(BackendTestMixin, unittest.TestCase):
+    backend_alias = 'git'
+    recreate_repo_per_test = False
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.start()
+        return thread
+
+    def _wait_for(self, condition):
+        for i in xrange(500):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('Condition has not been met')
+
+    def test_semaphore_is_fair(self):
+        semaphore = FairSemaphore(1)
+        semaphore.acquire()
+        order = []
+
+        def acquire(i):
+            semaphore.acquire()
+            order.append(i)
+            semaphore.release()
+
+        threads = []
+        for i in xrange(5):
+            threads.append(self._start(acquire, i))
+            self._wait_for(lambda: semaphore.waiting == i + 1)
+        semaphore.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, range(5))
+
+    def test_commands_wait_for_free_slot(self):
+        parent = GitCommandExecutor(1)
+        executor = GitCommandExecutor(2, parent=parent)
+        parent.acquire()
+        results = []
+        thread = self._start(lambda: results.append(
+            self.repo.run_git_command('rev-parse HEAD', _executor=executor)))
+        self._wait_for(lambda: parent.queued == 1)
+        self.assertEqual((executor.running, executor.queued), (0, 0))
+        time.sleep(0.05)
+        parent.release()
+        thread.join()
+        self.assertEqual(results[0][0].strip(), self.repo.get_changeset().raw_id)
+        self.assertEqual((parent.running, executor.running), (0, 0))
+        self.assertEqual(executor.commands, 1)
+        self.assertTrue(executor.wait_time >= 0.05)
+
+    def test_streamed_command_keeps_slot(self):
+        executor = GitCommandExecutor(1)
+        chunks, _ = self.repo.run_git_command('log', _stream=True,
+                                              _executor=executor)
+        self.assertEqual(executor.running, 1)
+        self.assertTrue(''.join(chunks).startswith('commit '))
+        self.assertEqual(executor.running, 0)
+        chunks, _ = self.repo.run_git_command('log', _stream=True,
+                                              _executor=executor)
+        chunks.close()
+        self.assertEqual(executor.running, 0)
+
+    def test_semaphore_acquire_times_out(self):
+        semaphore = FairSemaphore(1)
+        self.assertTrue(semaphore.acquire())
+        self.assertFalse(semaphore.acquire(0.01))
+        self.assertEqual(semaphore.waiting, 0)
+        semaphore.release()
+        self.assertTrue(semaphore.acquire(0.01))
+
+    def test_command_waiting_too_long_raises(self):
+        executor = GitCommandExecutor(1)
+        thread = self._start(executor.acquire)
+        thread.join()
+        with mock.patch.object(settings, 'GIT_COMMAND_QUEUE_TIMEOUT', 0.01):
+            self.assertRaises(CommandQueueTimeoutError,
+                self.repo.run_git_command, 'rev-parse HEAD',
+                _executor=executor)
+        self.assertEqual((executor.running, executor.queued), (1, 0))
+
+    def test_thread_reading_stream_reuses_its_slot(self):
+        parent = GitCommandExecutor(1)
+        executor = GitCommandExecutor(1, parent=parent)
+        other = GitCommandExecutor(1, parent=parent)
+        chunks, _ = self.repo.run_git_command('log', _stream=True,
+                                              _executor=executor)
+        for x in xrange(2):
+            out, _ = self.repo.run_git_command('rev-parse HEAD',
+                                               _executor=executor)
+            self.assertEqual(out.strip(), self.repo.get_changeset().raw_id)
+            self.repo.run_git_command('rev-parse HEAD', _executor=other)
+        self.assertEqual((parent.running, executor.running), (1, 1))
+        self.assertEqual(other.running, 0)
+        results = []
+        thread = self._start(lambda: results.append(
+            self.repo.run_git_command('rev-parse HEAD', _executor=other)))
+        self._wait_for(lambda: parent.queued == 1)
+        self.assertTrue(''.join(chunks).startswith('commit '))
+        thread.join()
+        self.assertEqual(len(results), 1)
+        self.assertEqual((parent.running, executor.running), (0, 0))
+
+    def test_stream_closed_by_other_thread_frees_slot(self):
+        executor = GitCommandExecutor(1)
+        chunks, _ = self.repo.run_git_command('log', _stream=True,
+                                              _executor=executor)
+        self._start(chunks.close).join()
+        self.assertEqual(executor.running, 0)
+        thread = self._start(self.repo.run_git_command, 'rev-parse HEAD')
+        thread.join()
+        self.repo.run_git_command('rev-parse HEAD', _executor=executor)
+        self.assertEqual(executor.running, 0)
+
+    def test_environment_is_copied(self):
+        executor = GitCommandExecutor(env={'GIT_AUTHOR_NAME': 'foo'})
+        with mock.patch.dict(os.environ, {'GIT_DIR': '/nonexistent'}):
+            environ = dict(os.environ)
+            out, _ = self.repo.run_git_command('var GIT_AUTHOR_IDENT',
+                _executor=executor, env={'GIT_AUTHOR_EMAIL': 'bar'})
+            self.assertEqual(os.environ, environ)
+        self.assertTrue(out.startswith('foo <bar>'))
+
+    def test_repository_executor_is_shared(self):
+        executor = self.repo._executor
+        self.assertTrue(GitRepository(self.repo.path)._executor is executor)
+        with mock.patch.object(executor, 'acquire') as acquire:
+            with mock.patch.object(executor, 'release') as release:
+                self.repo.run_git_command('rev-parse HEAD')
+        self.assertEqual((acquire.call_count, release.call_count), (1, 1))
+
+    def test_repository_executor_uses_current_global_executor(self):
+        executor = self.repo._executor
+        with mock.patch.object(settings, 'GIT_COMMAND_CONCURRENCY', 3):
+            parent = executor.get_parent()
+            self.assertEqual(parent.limit, 3)
+            with mock.patch.object(parent, 'acquire') as acquire:
+                with mock.patch.object(parent, 'release') as release:
+                    self.repo.run_git_command('rev-parse HEAD')
+        self.assertEqual((acquire.call_count, release.call_count), (1, 1))
+        self.assertTrue(executor.get_parent() is not parent)
+
+
+class GitCommitWalkerTest(BackendTestMixin, unittest.TestCase):
+    backend_alias = 'git'
+
+    @classmethod
+    def _get_commits(cls):
+        start_date = datetime.datetime(2010, 1, 1, 20)
+        for x in xrange(5):
+            yield {
+                'message': 'Commit %d' % x,
+                'author': 'Joe Doe <joe.doe@example.com>',
+                'date': start_date + datetime.timedelta(hours=12 * x),
+                'added': [
+                    FileNode('file_%d.txt' % x, content='Foobar %d' % x),
+                ],
+            }
+
+    def rev_list(self, *args):
+        cmd = 'rev-list %s' % ' '.join(args)
+        return self.repo.run_git_command(cmd)[0].split()
+
+    def test_walk_all(self):
+        tips = self.repo._get_rev_filter_tips()
+        self.assertEqual(list(GitCommitWalker(self.repo, tips)),
+            self.rev_list('--all'))
+        for order in (ORDER_DATE, ORDER_TOPO):
+            self.assertEqual(
+                list(GitCommitWalker(self.repo, tips, order=order)),
+                self.rev_list('--all', '--%s-order' % order))
+
+    def test_walk_reverse(self):
+        walker = GitCommitWalker(self.repo, [self.repo.revisions[-1]],
+                                 reverse=True)
+        self.assertEqual(list(walker), self.repo.revisions)
+
+    def test_walk_excludes_ancestors(self):
+        walker = GitCommitWalker(self.repo, [self.repo.revisions[-1]],
+                                 exclude=[self.repo.revisions[1]])
+        self.assertEqual(list(walker), self.repo.revisions[:1:-1])
+
+    def test_walk_stops_once_only_excluded_commits_are_queued(self):
+        walker = GitCommitWalker(self.repo, [self.repo.revisions[-1]],
+                                 exclude=[self.repo.revisions[3]])
+        with mock.patch('vcs.backends.git.walker.SLOP', 1):
+            with mock.patch.object(walker, '_push',
+                                   wraps=walker._push) as _push:
+                self.assertEqual(list(walker), [self.repo.revisions[4]])
+        pushed = [call[0][2] for call in _push.call_args_list]
+        self.assertNotIn(self.repo.revisions[1], pushed)
+        self.assertNotIn(self.repo.revisions[0], pushed)
+
+    def test_walk_respects_paths(self):
+        walker = GitCommitWalker(self.repo, [self.repo.revisions[-1]],
+                                 paths=['file_2.txt', 'file_4.txt'])
+        self.assertEqual(list(walker),
+            [self.repo.revisions[4], self.repo.revisions[2]])
+
+    def test_walk_respects_dates(self):
+        dates = [self.repo.get_changeset(rev)._commit.commit_time
+                 for rev in self.repo.revisions]
+        walker = GitCommitWalker(self.repo, [self.repo.revisions[-1]],
+                                 since=dates[1], until=dates[3])
+        self.assertEqual(list(walker), self.repo.revisions[3:0:-1])
+
+    def test_walk_respects_max_count(self):
+        walker = GitCommitWalker(self.repo, [self.repo.revisions[-1]],
+                                 max_count=2)
+        self.assertEqual(list(walker), self.repo.revisions[:-3:-1])
+
+    def test_walk_is_lazy(self):
+        walker = GitCommitWalker(self.repo, [self.repo.revisions[-1]])
+        with mock.patch.object(walker, '_limit') as _limit:
+            self.assertEqual(iter(walker).next(), self.repo.revisions[-1])
+            self.assertFalse(_limit.called)
+
+    def test_children(self):
+        cs = self.repo.get_changeset(self.repo.revisions[2])
+        self.assertEqual(cs.children,
+            [self.repo.get_changeset(self.repo.revisions[3])])
+        self.assertEqual(self.repo.get_changeset().children, [])
+
+    def test_file_history_follows_renames(self):
+        self.imc.remove(FileNode('file_2.txt'))
+        self.imc.add(FileNode('renamed.txt', content='Foobar 2'))
+        tip = self.imc.commit(u'Rename', u'joe.doe@example.com')
+        self.assertEqual(list(tip.iter_file_history('renamed.txt')), [tip])
+        self.assertEqual(list(tip.iter_file_history('renamed.txt',
+            follow=True)), [tip, self.repo.get_changeset(2)])
+
+    def test_get_renames(self):
+        self.imc.remove(FileNode('file_2.txt'))
+        self.imc.add(FileNode('renamed.txt', content='Foobar 2'))
+        self.imc.add(FileNode('copied.txt', content='Foobar 3'))
+        tip = self.imc.commit(u'Rename', u'joe.doe@example.com')
+        self.assertEqual(tip.get_renames(), [('file_2.txt', 'renamed.txt')])
+        self.assertEqual(tip.get_renames(copies=True),
+            [('file_3.txt', 'copied.txt'), ('file_2.txt', 'renamed.txt')])
+        self.assertEqual(tip.get_renames(threshold=100),
+            [('file_2.txt', 'renamed.txt')])
+        self.assertEqual([node.path for node in tip.added],
+            ['copied.txt', 'renamed.txt'])
+        self.assertEqual([node.path for node in tip.removed], ['file_2.txt'])
+
+    def test_file_history(self):
+        history = self.repo.get_changeset().get_file_history('file_2.txt')
+        self.assertEqual(history,
+            [self.repo.get_changeset(self.repo.revisions[2])])
+
+
 class GitRegressionTest(BackendTestMixin, unittest.TestCase):
     backend_alias = 'git'
 
@@ -46,6 +46,61 @@ class RepositoryBaseTest(BackendTestMixin):
         self.assertTrue(self.repo != dummy())
 
 
+class RepositoryChangesetsMetadataTest(BackendTestMixin):
+    recreate_repo_per_test = False
+
+    @classmethod
+    def _get_commits(cls):
+        commits = super(RepositoryChangesetsMetadataTest, cls)._get_commits()
+        commits[1]['message'] = u'Changes...\n\nDetails of changes'
+        return commits
+
+    def test_metadata_matches_changesets(self):
+        metadata = self.repo.get_changesets_metadata()
+        self.assertEqual(len(metadata), len(self.repo.revisions))
+        for record, cs in zip(metadata, self.repo):
+            self.assertEqual(record, cs)
+            self.assertEqual(record.raw_id, cs.raw_id)
+            self.assertEqual(record.short_id, cs.short_id)
+            self.assertEqual(record.revision, cs.revision)
+            self.assertEqual(record.author, cs.author)
+            self.assertEqual(record.author_email, cs.author_email)
+            self.assertEqual(record.date, cs.date)
+            self.assertEqual(record.message, cs.message)
+            self.assertEqual(record.summary, cs.message.splitlines()[0])
+
+    def test_metadata_columns(self):
+        metadata = self.repo.get_changesets_metadata()
+        self.assertEqual(metadata.raw_ids, list(self.repo.revisions))
+        self.assertEqual(list(metadata.revisions), [0, 1])
+        self.assertEqual(metadata.authors, [u'Joe Doe <joe.doe@example.com>',
+            u'Jane Doe <jane.doe@example.com>'])
+        self.assertEqual(metadata.summaries, [u'Initial commit',
+            u'Changes...'])
+        self.assertEqual(metadata.messages[1],
+            u'Changes...\n\nDetails of changes')
+        self.assertEqual(metadata.timestamps[1] - metadata.timestamps[0],
+            3600)
+
+    def test_metadata_without_messages(self):
+        metadata = self.repo.get_changesets_metadata(messages=False)
+        self.assertEqual(metadata.messages, None)
+        self.assertEqual(metadata[1].summary, u'Changes...')
+        self.assertEqual(metadata[1].message, None)
+
+    def test_metadata_of_collection(self):
+        changesets = self.repo.get_changesets(reverse=True)
+        metadata = changesets.get_metadata()
+        self.assertEqual(metadata.raw_ids, [cs.raw_id for cs in changesets])
+        self.assertEqual(metadata.raw_ids, self.repo.revisions[::-1])
+        self.assertEqual(changesets[:1].get_metadata().raw_ids,
+            [self.repo.revisions[-1]])
+
+    def test_metadata_of_missing_revision(self):
+        self.assertRaises(ChangesetDoesNotExistError,
+            self.repo.get_changesets_metadata, ['f' * 40])
+
+
 class RepositoryGetDiffTest(BackendTestMixin):
 
     @classmethod
@@ -86,6 +141,36 @@ class RepositoryGetDiffTest(BackendTestMixin):
     def test_raise_for_wrong(self):
         with self.assertRaises(ChangesetDoesNotExistError):
             self.repo.get_diff('a' * 40, 'b' * 40)
+        with self.assertRaises(ChangesetDoesNotExistError):
+            self.repo.iter_diff('a' * 40, 'b' * 40)
+
+    def test_iter_diff(self):
+        revs = self.repo.revisions
+        for rev1, rev2 in ((self.repo.EMPTY_CHANGESET, revs[0]),
+                           (revs[0], revs[1]), (revs[1], revs[2])):
+            diff = self.repo.get_diff(rev1, rev2)
+            patches = list(self.repo.iter_diff(rev1, rev2))
+            self.assertEqual(len(patches), 2)
+            self.assertEqual(''.join(patch for patch, truncated in patches),
+                             diff)
+            self.assertFalse(any(truncated for patch, truncated in patches))
+
+    def test_iter_diff_limits(self):
+        revs = self.repo.revisions
+        patches = [patch for patch, truncated
+                   in self.repo.iter_diff(revs[1], revs[2])]
+        lines = patches[0].splitlines(True)
+
+        limited = list(self.repo.iter_diff(revs[1], revs[2],
+            file_limit=len(''.join(lines[:3])) + 1))
+        self.assertEqual(limited[0], (''.join(lines[:3]), True))
+        self.assertEqual([truncated for patch, truncated in limited],
+                         [True, True])
+
+        limited = list(self.repo.iter_diff(revs[1], revs[2],
+            total_limit=len(patches[0])))
+        self.assertEqual(limited, [(patches[0], False),
+            (patches[1].splitlines(True)[0], True)])
 
 
 class GitRepositoryGetDiffTest(RepositoryGetDiffTest, unittest.TestCase):
@@ -221,9 +306,10 @@ for alias in SCM_TESTS:
     attrs = {
         'backend_alias': alias,
     }
-    cls_name = alias.capitalize() + RepositoryBaseTest.__name__
-    bases = (RepositoryBaseTest, unittest.TestCase)
-    globals()[cls_name] = type(cls_name, bases, attrs)
+    for base in (RepositoryBaseTest, RepositoryChangesetsMetadataTest):
+        cls_name = alias.capitalize() + base.__name__
+        bases = (base, unittest.TestCase)
+        globals()[cls_name] = type(cls_name, bases, attrs)
 
 if __name__ == '__main__':
     unittest.main()
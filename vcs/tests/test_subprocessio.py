@@ -0,0 +1,152 @@
+from __future__ import with_statement
+
+import os
+import time
+import StringIO
+import tempfile
+
+from vcs import subprocessio
+from vcs.utils.compat import unittest
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        # killed process might not have been reaped yet
+        return 'State:\tZ' not in open('/proc/%s/status' % pid).read()
+    except IOError:
+        return True
+
+
+class ChunkerTestMixin(object):
+    """
+    Tests of chunkers' interface; ``chunker`` attribute has to be set at
+    subclass.
+    """
+
+    def run_command(self, cmd, **kwargs):
+        return self.chunker(cmd, **kwargs)
+
+    def test_output(self):
+        chunker = self.run_command('echo foo')
+        self.assertEqual(''.join(chunker), 'foo\n')
+
+    def test_starting_values(self):
+        chunker = self.run_command('echo foo', starting_values=['bar\n'])
+        self.assertEqual(''.join(chunker), 'bar\nfoo\n')
+
+    def test_output_larger_than_buffer_is_streamed(self):
+        chunker = self.run_command('head -c 1000000 /dev/zero',
+                                   buffer_size=65536, chunk_size=4096)
+        sizes = [len(chunk) for chunk in chunker]
+        self.assertEqual(sum(sizes), 1000000)
+        self.assertTrue(max(sizes) <= 4096)
+
+    def test_input_string(self):
+        data = '0123456789\n' * 50000
+        chunker = self.run_command('cat', inputstream=data)
+        self.assertEqual(''.join(chunker), data)
+
+    def test_input_file(self):
+        data = 'foo\n' * 10000
+        chunker = self.run_command('cat',
+                                   inputstream=StringIO.StringIO(data))
+        self.assertEqual(''.join(chunker.output), data)
+        self.assertEqual(''.join(chunker.error), '')
+
+    def test_error(self):
+        with self.assertRaises(EnvironmentError) as cm:
+            self.run_command('echo failed >&2; exit 3')
+        self.assertTrue('failed' in str(cm.exception))
+
+    def test_max_output(self):
+        chunker = self.run_command('head -c 1000 /dev/zero', max_output=1000)
+        self.assertEqual(len(''.join(chunker)), 1000)
+        with self.assertRaises(subprocessio.OutputLimitError):
+            ''.join(self.run_command('head -c 1000000 /dev/zero',
+                                     max_output=100000))
+
+    def test_timeout_kills_process_group(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        start = time.time()
+        with self.assertRaises(subprocessio.SubprocessTimeoutError):
+            ''.join(self.run_command('sleep 30 & echo $! > %s; wait' % path,
+                                     timeout=0.5))
+        self.assertTrue(time.time() - start < 5)
+        pid = int(open(path).read())
+        os.remove(path)
+        for i in xrange(100):
+            if not is_running(pid):
+                break
+            time.sleep(0.01)
+        else:
+            self.fail('Process started by the shell is still running')
+
+    def test_spooled_output(self):
+        data = ''.join('%06d\n' % i for i in xrange(50000))
+        chunker = self.run_command('cat', inputstream=data, buffer_size=8192,
+                                   spool_size=8192)
+        self.assertEqual(''.join(chunker), data)
+
+
+class SpooledBufferTest(unittest.TestCase):
+
+    def test_chunks_beyond_memory_are_spooled(self):
+        buf = subprocessio.SpooledBuffer(10, chunk_size=4,
+                                         starting_values=['ab'])
+        for chunk in ('cdefgh', 'ijk', 'lm'):
+            buf.append(chunk)
+        self.assertEqual(buf._memory, 8)
+        self.assertEqual(buf._write_pos, 5)
+        self.assertEqual(len(buf), 4)
+        self.assertEqual([buf.popleft() for i in xrange(4)],
+            ['ab', 'cdefgh', 'ijkl', 'm'])
+        self.assertRaises(IndexError, buf.popleft)
+        # file is reused once drained
+        self.assertEqual(buf._write_pos, 0)
+        buf.append('n')
+        self.assertEqual((buf.popleft(), len(buf)), ('n', 0))
+        buf.close()
+
+
+class SubprocessIOChunkerTest(ChunkerTestMixin, unittest.TestCase):
+    chunker = subprocessio.SubprocessIOChunker
+
+
+class SelectIOChunkerTest(ChunkerTestMixin, unittest.TestCase):
+    chunker = subprocessio.SelectIOChunker
+
+    def test_output_is_read_on_demand(self):
+        chunker = self.run_command('head -c 1000000 /dev/zero',
+                                   buffer_size=65536, chunk_size=4096)
+        self.assertTrue(chunker._buffered <= 65536)
+        self.assertTrue(chunker.process.poll() is None)
+        self.assertEqual(len(chunker.next()), 4096)
+        chunker.close()
+
+    def test_error_without_message(self):
+        self.assertRaises(EnvironmentError, self.run_command, 'exit 3')
+
+    def test_spooled_output_is_read_entirely(self):
+        chunker = self.run_command('head -c 1000000 /dev/zero',
+                                   buffer_size=65536, spool_size=65536)
+        self.assertTrue(chunker.process.poll() is not None)
+        self.assertEqual(len(''.join(chunker)), 1000000)
+
+    def test_error_output_of_successful_command(self):
+        chunker = self.run_command('echo warning >&2; echo foo')
+        self.assertEqual(''.join(chunker.output), 'foo\n')
+        self.assertEqual(''.join(chunker.error), 'warning\n')
+
+    def test_error_keeps_last_bytes(self):
+        chunker = self.run_command('head -c 40000 /dev/zero >&2; echo foo')
+        self.assertEqual(''.join(chunker.output), 'foo\n')
+        self.assertTrue(16000 <= len(''.join(chunker.error)) < 16000 + 4096)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,8 +14,10 @@ from vcs.utils.helpers import get_scms_for_path
 from vcs.utils.helpers import get_total_seconds
 from vcs.utils.helpers import parse_changesets
 from vcs.utils.helpers import parse_datetime
-from vcs.utils import author_email, author_name
+from vcs.utils import author_email, author_name, iter_lines
 from vcs.utils.paths import get_user_home
+from vcs.utils.lru import LRUCache
+from vcs.utils.revisions import RevisionDates, RevisionList
 from vcs.exceptions import VCSError
 
 from vcs.tests.conf import TEST_HG_REPO, TEST_GIT_REPO, TEST_TMP_PATH
@@ -219,6 +221,18 @@ class TestAuthorExtractors(unittest.TestCase):
             self.assertEqual(result[0], author_name(test_str))
 
 
+class TestIterLines(unittest.TestCase):
+
+    def test_lines_span_chunks(self):
+        chunks = ['fo', 'o\nbar\n', '\nba', 'z']
+        self.assertEqual(list(iter_lines(chunks)),
+            ['foo\n', 'bar\n', '\n', 'baz'])
+
+    def test_trailing_newline(self):
+        self.assertEqual(list(iter_lines(['foo\n', ''])), ['foo\n'])
+        self.assertEqual(list(iter_lines([])), [])
+
+
 class TestGetDictForAttrs(unittest.TestCase):
 
     def test_returned_dict_has_expected_attrs(self):
@@ -275,5 +289,107 @@ class TestGetUserHome(unittest.TestCase):
         self.assertEqual(get_user_home(), '/home/foobar')
 
 
+
+class TestRevisionList(unittest.TestCase):
+
+    def setUp(self):
+        self.ids = ['%040x' % x for x in (0xabc1, 0xabc2, 0x1234, 0xfff)]
+        self.revisions = RevisionList(self.ids)
+
+    def test_index_and_contains(self):
+        for pos, rev in enumerate(self.ids):
+            self.assertEqual(self.revisions.index(rev), pos)
+            self.assertTrue(rev in self.revisions)
+        self.assertFalse('f' * 40 in self.revisions)
+        self.assertRaises(ValueError, self.revisions.index, 'f' * 40)
+
+    def test_append_updates_lookups(self):
+        self.revisions.get_by_prefix('0')
+        new_id = 'e' * 40
+        self.revisions.append(new_id)
+        self.assertEqual(self.revisions.index(new_id), 4)
+        self.assertEqual(self.revisions.get_by_prefix('eee'), [new_id])
+
+    def test_modification_drops_lookups(self):
+        rev = self.revisions.pop(0)
+        self.assertFalse(rev in self.revisions)
+        self.assertEqual(self.revisions.index(self.ids[1]), 0)
+
+    def test_get_by_prefix(self):
+        prefix = '0' * 36
+        self.assertEqual(self.revisions.get_by_prefix(prefix + 'abc'),
+            self.ids[:2])
+        self.assertEqual(self.revisions.get_by_prefix(prefix + 'abc2'),
+            [self.ids[1]])
+        self.assertEqual(self.revisions.get_by_prefix('1'), [])
+        self.assertEqual(self.revisions.get_by_prefix('xyz'), [])
+
+    def test_slices_are_plain_lists(self):
+        self.assertEqual(self.revisions[1:3], self.ids[1:3])
+
+
+class TestRevisionDates(unittest.TestCase):
+
+    def setUp(self):
+        self.dates = RevisionDates()
+        for timestamp in (10, 30, 20, 40, 50):
+            self.dates.append(timestamp)
+
+    def test_get_positions_without_bounds(self):
+        self.assertEqual(self.dates.get_positions(), range(5))
+        self.assertEqual(self.dates.get_positions(start=1, end=3), [1, 2, 3])
+
+    def test_get_positions_by_date(self):
+        self.assertEqual(self.dates.get_positions(since=20, until=40),
+            [1, 2, 3])
+        self.assertEqual(self.dates.get_positions(since=25), [1, 3, 4])
+        self.assertEqual(self.dates.get_positions(until=15), [0])
+        self.assertEqual(self.dates.get_positions(since=60), [])
+
+    def test_get_positions_by_date_and_position(self):
+        self.assertEqual(self.dates.get_positions(since=20, start=2), [2, 3, 4])
+        self.assertEqual(self.dates.get_positions(until=30, end=1), [0, 1])
+
+    def test_appended_timestamps_are_found(self):
+        self.dates.get_positions(since=20)
+        self.dates.append(15)
+        self.assertEqual(self.dates.get_positions(since=15, until=20), [2, 5])
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_least_recently_used_items_are_dropped(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_size_is_bounded_by_weight(self):
+        cache = LRUCache(5, weight=len)
+        cache.set('a', 'xxx')
+        cache.set('b', 'xx')
+        self.assertTrue('a' in cache)
+        cache.set('c', 'x')
+        self.assertFalse('a' in cache)
+        cache.set('d', 'xxxxxx')
+        self.assertFalse('d' in cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_evicted_values_are_passed_to_callback(self):
+        evicted = []
+        cache = LRUCache(2, evicted=evicted.append)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('b', 3)
+        self.assertEqual(evicted, [])
+        cache.set('c', 4)
+        self.assertEqual(evicted, [1])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -37,6 +37,21 @@ def aslist(obj, sep=None, strip=True):
         return [obj]
 
 
+def iter_lines(chunks):
+    """
+    Yields lines (keeping line endings) from given iterable of ``chunks`` of
+    any size, e.g. output of a command as it is being produced.
+    """
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
 def date_fromtimestamp(unixts, tzoffset=0):
     """
     Makes a local datetime object out of unix timestamp
@@ -0,0 +1,184 @@
+"""
+On-disk cache of archives.
+
+Archive of given changeset (with given kind, prefix and options) never
+changes, so archives are stored at files named after sha1 of their keys and
+built only if there is no such file yet. Files are written under temporary
+names and renamed into place, so readers never see partially written
+archives. Modification time of a file is updated whenever it is served and
+least recently used archives are removed once total size of cached archives
+exceeds the budget. Total size is counted once (by listing the directory) and
+then kept up to date as archives are built; the directory is listed again
+only when the budget is exceeded, so archives built by other processes are
+accounted for then.
+"""
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from hashlib import sha1
+
+from vcs.conf import settings
+
+TEMP_PREFIX = '.tmp-'
+
+
+class ArchiveCache(object):
+    """
+    Cache of archives stored at the directory at given ``path``.
+
+    :param size: maximal total size (in bytes) of cached archives
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        # locks of archives being opened (with number of threads using
+        # them), removed once no thread uses them
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        # total size of cached archives, ``None`` until it is counted
+        self._total = None
+        self._total_lock = threading.Lock()
+
+    @staticmethod
+    def get_key(*parts):
+        """
+        Returns key of the archive identified by given ``parts``.
+        """
+        return sha1('\0'.join(map(str, parts))).hexdigest()
+
+    @contextmanager
+    def _lock(self, key):
+        with self._locks_lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def open(self, key, fill):
+        """
+        Returns file object (opened for reading) of the archive with given
+        ``key``. If it has not been cached yet, it is built by calling
+        ``fill`` with file object the archive should be written to.
+        Concurrent requests for the same archive within the process build it
+        once.
+        """
+        path = os.path.join(self.path, key)
+        with self._lock(key):
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                pass
+            else:
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+                return f
+            f = self._build(path, fill)
+        self._add(os.fstat(f.fileno()).st_size)
+        return f
+
+    def _build(self, path, fill):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                fill(f)
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, path)
+            # opened at its final path, which is file's ``name``
+            f = open(path, 'rb')
+        except:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        return f
+
+    def _add(self, size):
+        """
+        Adds ``size`` of newly built archive to the total size of cached
+        archives and evicts archives if it exceeds the budget.
+        """
+        with self._total_lock:
+            if self._total is None or self._total + size > self.size:
+                self._total = self._evict()
+            else:
+                self._total += size
+
+    def _evict(self):
+        """
+        Removes least recently used archives until their total size fits the
+        budget. Returns total size of remaining archives.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.startswith(TEMP_PREFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+            total += stat.st_size
+        entries.sort()
+        for mtime, path, size in entries:
+            if total <= self.size:
+                break
+            try:
+                # files being served remain readable
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+    def clear(self):
+        """
+        Removes all cached archives.
+        """
+        with self._total_lock:
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            self._total = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_archive_cache():
+    """
+    Returns ``ArchiveCache`` at ``ARCHIVE_CACHE_DIR`` (shared by all callers)
+    or ``None`` if cache is disabled.
+    """
+    path = settings.ARCHIVE_CACHE_DIR
+    if not path:
+        return None
+    key = (path, settings.ARCHIVE_CACHE_SIZE)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ArchiveCache(*key)
+        return cache
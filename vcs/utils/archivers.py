@@ -1,58 +1,561 @@
 # -*- coding: utf-8 -*-
+"""
+Archive writers.
 
+Archivers write entries given by the backend straight into the output stream
+(nothing is buffered apart from blocks being compressed). Compression is
+done by a pool of threads shared by all archives (``zlib`` and ``bz2``
+release the GIL while compressing), so archives are compressed on multiple
+cores:
 
-class BaseArchiver(object):
+* ``tgz`` archives split the tar stream into blocks which are deflated
+  independently (each one flushed at byte boundary) and concatenated into a
+  single gzip member, the same way ``pigz`` does it
+* ``zip`` archives deflate every entry independently, splitting big entries
+  into blocks the same way; entries are followed by data descriptors, so
+  they are written as soon as their blocks are compressed
+* ``tbz2`` archives are written as a single bzip2 stream (as not every reader
+  supports concatenated streams), compressed sequentially
+
+Results are always written in order, at most few blocks per thread are kept
+in memory.
+"""
+from __future__ import with_statement
+
+import bz2
+import sys
+import time
+import zlib
+import struct
+import tarfile
+import zipfile
+import threading
+import Queue
+from collections import deque
+from stat import S_ISDIR
+from StringIO import StringIO
+
+from vcs.conf import settings
+from vcs.exceptions import ImproperArchiveTypeError
+
+# size of blocks of the tar stream (and of zip entries) compressed by single
+# thread
+BLOCK_SIZE = 128 * 1024
+
+# sizes and offsets above that limit need zip64 extensions (the same limit
+# as the one used by ``zipfile``)
+ZIP64_LIMIT = (1 << 31) - 1
+
+
+def get_threads_count():
+    """
+    Returns number of compressing threads set at ``ARCHIVE_THREADS`` setting
+    or, if it is not set, number of CPUs.
+    """
+    if settings.ARCHIVE_THREADS:
+        return settings.ARCHIVE_THREADS
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+class _Job(object):
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.cancelled = False
+        self.result = self.error = None
+
+    def run(self):
+        if not self.cancelled:
+            try:
+                self.result = self.func(*self.args)
+            except Exception:
+                self.error = sys.exc_info()
+        self.done.set()
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+class WorkerPool(object):
+    """
+    Fixed set of daemon threads running jobs put into the pool.
+    """
+
+    def __init__(self, threads):
+        self.threads = threads
+        self._queue = Queue.Queue()
+        for i in xrange(threads):
+            worker = threading.Thread(target=self._work,
+                                      name='archiver-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+
+    def _work(self):
+        while True:
+            self._queue.get().run()
+
+    def put(self, job):
+        self._queue.put(job)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """
+    Returns global ``WorkerPool`` with as many threads as returned by
+    ``get_threads_count``, shared by all archives being written.
+    """
+    threads = get_threads_count()
+    with _pools_lock:
+        pool = _pools.get(threads)
+        if pool is None:
+            pool = _pools[threads] = WorkerPool(threads)
+        return pool
+
+
+class OrderedPool(object):
+    """
+    Runs submitted jobs on the shared ``WorkerPool`` and hands their results
+    to the ``output`` callable in the order jobs have been submitted. At most
+    ``2 * threads`` jobs are pending at once. If ``threads`` is 1, jobs are
+    run immediately by the submitting thread.
+    """
+
+    def __init__(self, output, threads=1):
+        self.output = output
+        self.threads = threads
+        self._pending = deque()
+        self._workers = threads > 1 and get_worker_pool() or None
+
+    def submit(self, func, *args):
+        """
+        Runs ``func`` with given ``args``, blocking until there is room for
+        its result.
+        """
+        job = _Job(func, args)
+        if self._workers is None:
+            job.run()
+            self.output(job.get())
+            return
+        self._workers.put(job)
+        self._pending.append(job)
+        self._output(2 * self.threads)
+
+    def _output(self, limit):
+        try:
+            while len(self._pending) > limit:
+                self.output(self._pending.popleft().get())
+        except Exception:
+            self.stop()
+            raise
 
-    def __init__(self):
-        self.archive_file = self._get_archive_file()
+    def join(self):
+        """
+        Waits for all submitted jobs and outputs their results.
+        """
+        self._output(0)
 
-    def addfile(self):
+    def stop(self):
         """
-        Adds a file to archive container
+        Drops results of jobs not output yet (jobs not started yet are
+        skipped).
         """
+        for job in self._pending:
+            job.cancelled = True
+        self._pending.clear()
+
+
+def _deflate(data, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class GzipWriter(object):
+    """
+    File like object writing data compressed (in parallel) in gzip format
+    into given ``stream``.
+    """
+
+    def __init__(self, stream, level, threads=1, mtime=0):
+        self.stream = stream
+        self.level = level
+        self._pool = OrderedPool(stream.write, threads)
+        self._chunks = []
+        self._buffered = 0
+        self._crc = zlib.crc32('')
+        self._size = 0
+        stream.write('\x1f\x8b\x08\x00' + struct.pack('<I', int(mtime)) +
+                     '\x00\xff')
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= BLOCK_SIZE:
+            self._flush_block(False)
+
+    def _flush_block(self, last):
+        data = ''.join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+        self._pool.submit(_deflate, data, self.level, last)
+
+    def close(self):
+        self._flush_block(True)
+        self._pool.join()
+        self.stream.write(struct.pack('<II', self._crc & 0xffffffff,
+                                      self._size & 0xffffffff))
+
+    def abort(self):
+        self._pool.stop()
+
+
+class Bz2Writer(object):
+    """
+    File like object writing data compressed in bzip2 format into given
+    ``stream``.
+    """
+
+    def __init__(self, stream, level):
+        self.stream = stream
+        self._compressor = bz2.BZ2Compressor(max(level, 1))
+
+    def write(self, data):
+        self.stream.write(self._compressor.compress(data))
+
+    def close(self):
+        self.stream.write(self._compressor.flush())
+
+    def abort(self):
         pass
 
+
+class _CountingStream(object):
+    """
+    Wraps given ``stream`` counting bytes written, so that zip archives can
+    be written into streams which cannot tell their position.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+
+class BaseArchiver(object):
+    """
+    Writes archive into given ``stream``. All entries are stored within
+    ``prefix`` directory and have ``mtime`` set as modification time.
+
+    :param level: compression level (0-9); ``ARCHIVE_COMPRESSION_LEVEL``
+      setting by default
+    :param threads: number of compressing threads; see ``get_threads_count``
+    :param comment: comment stored within the archive (i.e. changeset's id)
+    """
+
+    def __init__(self, stream, prefix, mtime, level=None, threads=None,
+                 comment=None):
+        self.stream = stream
+        self.prefix = prefix.rstrip('/')
+        self.mtime = int(mtime)
+        if level is None:
+            level = settings.ARCHIVE_COMPRESSION_LEVEL
+        self.level = level
+        self.threads = threads or get_threads_count()
+        self.comment = comment
+
+    def _get_name(self, path):
+        return '/'.join((self.prefix, path.strip('/'))).rstrip('/')
+
+    def add_dir(self, path):
+        """
+        Adds a directory (empty ``path`` stands for the prefix directory).
+        """
+        raise NotImplementedError
+
+    def add_file(self, path, content, executable=False):
+        """
+        Adds a file with given ``content``.
+        """
+        raise NotImplementedError
+
+    def add_symlink(self, path, target):
+        """
+        Adds a symbolic link pointing at ``target``.
+        """
+        raise NotImplementedError
+
     def close(self):
         """
-        Closes and finalizes operation of archive container object
+        Finalizes the archive (given ``stream`` is not closed).
         """
-        self.archive_file.close()
+        raise NotImplementedError
 
-    def _get_archive_file(self):
+    def abort(self):
         """
-        Returns container for specific archive
+        Stops writing the archive after an error, without finalizing it.
         """
-        raise NotImplementedError()
+        raise NotImplementedError
 
 
 class TarArchiver(BaseArchiver):
-    pass
+    """
+    Writes uncompressed tar archive.
+    """
 
+    def __init__(self, *args, **kwargs):
+        super(TarArchiver, self).__init__(*args, **kwargs)
+        self.output = self._get_output()
+        kwargs = {}
+        if hasattr(tarfile, 'PAX_FORMAT'):
+            # Python 2.5 writes GNU format only (without comment)
+            kwargs['format'] = tarfile.PAX_FORMAT
+            kwargs['pax_headers'] = self.comment and \
+                {'comment': self.comment} or {}
+        self.tar = tarfile.open(mode='w|', fileobj=self.output, **kwargs)
 
-class Tbz2Archiver(BaseArchiver):
-    pass
+    def _get_output(self):
+        return self.stream
 
+    def _get_info(self, path, type, mode, size=0):
+        info = tarfile.TarInfo(self._get_name(path))
+        info.type = type
+        info.mode = mode
+        info.size = size
+        info.mtime = self.mtime
+        info.uname = info.gname = 'root'
+        return info
 
-class TgzArchiver(BaseArchiver):
-    pass
+    def add_dir(self, path):
+        self.tar.addfile(self._get_info(path, tarfile.DIRTYPE, 0755))
 
+    def add_file(self, path, content, executable=False):
+        info = self._get_info(path, tarfile.REGTYPE,
+                              executable and 0755 or 0644, len(content))
+        self.tar.addfile(info, StringIO(content))
 
-class ZipArchiver(BaseArchiver):
-    pass
+    def add_symlink(self, path, target):
+        info = self._get_info(path, tarfile.SYMTYPE, 0777)
+        info.linkname = target
+        self.tar.addfile(info)
+
+    def close(self):
+        self.tar.close()
+        if self.output is not self.stream:
+            self.output.close()
+
+    def abort(self):
+        if self.output is not self.stream:
+            self.output.abort()
 
 
-def get_archiver(self, kind):
+class TgzArchiver(TarArchiver):
+    """
+    Writes tar archive compressed (in parallel) with gzip.
     """
-    Returns instance of archiver class specific to given kind
 
-    :param kind: archive kind
+    def _get_output(self):
+        return GzipWriter(self.stream, self.level, self.threads, self.mtime)
+
+
+class Tbz2Archiver(TarArchiver):
+    """
+    Writes tar archive compressed with bzip2.
+    """
+
+    def _get_output(self):
+        return Bz2Writer(self.stream, self.level)
+
+
+def _compress_zip_block(entry, block, level, first, last):
+    return entry, block, _deflate(block, level, last), first, last
+
+
+class _ZipEntry(object):
+
+    def __init__(self, name, mode, size):
+        self.name = name
+        self.mode = mode
+        self.size = size
+        # sizes of entries which could grow above the limit are stored at
+        # zip64 extra field (as ``zipfile`` does)
+        self.zip64 = size * 1.05 > ZIP64_LIMIT
+        self.flags = 0x08
+        try:
+            name.decode('ascii')
+        except UnicodeDecodeError:
+            try:
+                name.decode('utf-8')
+                self.flags |= 0x800
+            except UnicodeDecodeError:
+                pass
+        self.offset = self.crc = self.compressed_size = 0
+
+
+class ZipArchiver(BaseArchiver):
     """
+    Writes zip archive with entries deflated in parallel.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ZipArchiver, self).__init__(*args, **kwargs)
+        self.output = _CountingStream(self.stream)
+        # zip archives cannot store dates before 1980
+        date_time = max(time.localtime(self.mtime)[:6], (1980, 1, 1, 0, 0, 0))
+        self._dos_time = (date_time[3] << 11 | date_time[4] << 5
+                          | date_time[5] // 2)
+        self._dos_date = ((date_time[0] - 1980) << 9 | date_time[1] << 5
+                          | date_time[2])
+        self._entries = []
+        self._pool = OrderedPool(self._write_block, self.threads)
+
+    def _add(self, name, mode, content):
+        entry = _ZipEntry(name, mode, len(content))
+        self._entries.append(entry)
+        # blocks refer to the content, they are not copied
+        offset = 0
+        while True:
+            block = buffer(content, offset, BLOCK_SIZE)
+            last = offset + BLOCK_SIZE >= entry.size
+            self._pool.submit(_compress_zip_block, entry, block, self.level,
+                              not offset, last)
+            if last:
+                break
+            offset += BLOCK_SIZE
+
+    def _write_block(self, result):
+        entry, block, data, first, last = result
+        if first:
+            entry.offset = self.output.tell()
+            self.output.write(self._get_local_header(entry))
+        entry.crc = zlib.crc32(block, entry.crc)
+        entry.compressed_size += len(data)
+        self.output.write(data)
+        if last:
+            entry.crc &= 0xffffffff
+            if entry.zip64:
+                self.output.write(struct.pack('<4sIQQ', 'PK\x07\x08',
+                    entry.crc, entry.compressed_size, entry.size))
+            elif entry.compressed_size > ZIP64_LIMIT:
+                raise zipfile.LargeZipFile('Compressed size of %s would '
+                    'require zip64 extensions' % entry.name)
+            else:
+                self.output.write(struct.pack('<4sIII', 'PK\x07\x08',
+                    entry.crc, entry.compressed_size, entry.size))
 
-    archivers = {
-        'tar': TarArchiver,
-        'tbz2': Tbz2Archiver,
-        'tgz': TgzArchiver,
-        'zip': ZipArchiver,
-    }
+    def _get_local_header(self, entry):
+        # CRC and sizes follow compressed data (at data descriptor)
+        if entry.zip64:
+            version, size = 45, 0xffffffff
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        else:
+            version, size, extra = 20, 0, ''
+        return struct.pack('<4sHHHHHIIIHH', 'PK\x03\x04', version,
+            entry.flags, zipfile.ZIP_DEFLATED, self._dos_time,
+            self._dos_date, 0, size, size, len(entry.name),
+            len(extra)) + entry.name + extra
 
-    return archivers[kind]()
+    def _get_central_header(self, entry):
+        values = []
+        size, compressed_size, offset = (entry.size, entry.compressed_size,
+                                         entry.offset)
+        if size > ZIP64_LIMIT:
+            values.append(size)
+            size = 0xffffffff
+        if compressed_size > ZIP64_LIMIT:
+            values.append(compressed_size)
+            compressed_size = 0xffffffff
+        if offset > ZIP64_LIMIT:
+            values.append(offset)
+            offset = 0xffffffff
+        extra = ''
+        if values:
+            extra = struct.pack('<HH' + 'Q' * len(values), 1,
+                                8 * len(values), *values)
+        version = (entry.zip64 or values) and 45 or 20
+        external_attr = entry.mode << 16
+        if S_ISDIR(entry.mode):
+            external_attr |= 0x10
+        return struct.pack('<4sBBHHHHHIIIHHHHHII', 'PK\x01\x02', version,
+            3, version, entry.flags, zipfile.ZIP_DEFLATED, self._dos_time,
+            self._dos_date, entry.crc, compressed_size, size,
+            len(entry.name), len(extra), 0, 0, 0, external_attr,
+            offset) + entry.name + extra
+
+    def _write_directory(self):
+        start = self.output.tell()
+        for entry in self._entries:
+            self.output.write(self._get_central_header(entry))
+        end = self.output.tell()
+        count, size, offset = len(self._entries), end - start, start
+        if count >= 0xffff or size > ZIP64_LIMIT or offset > ZIP64_LIMIT:
+            self.output.write(struct.pack('<4sQHHIIQQQQ', 'PK\x06\x06', 44,
+                45, 45, 0, 0, count, count, size, offset))
+            self.output.write(struct.pack('<4sIQI', 'PK\x06\x07', 0, end,
+                                          1))
+            count = min(count, 0xffff)
+            size = min(size, 0xffffffff)
+            offset = min(offset, 0xffffffff)
+        comment = (self.comment or '')[:0xffff]
+        self.output.write(struct.pack('<4sHHHHIIH', 'PK\x05\x06', 0, 0,
+            count, count, size, offset, len(comment)) + comment)
+
+    def add_dir(self, path):
+        self._add(self._get_name(path) + '/', 040755, '')
+
+    def add_file(self, path, content, executable=False):
+        mode = executable and 0100755 or 0100644
+        self._add(self._get_name(path), mode, content)
+
+    def add_symlink(self, path, target):
+        self._add(self._get_name(path), 0120777, target)
+
+    def close(self):
+        self._pool.join()
+        self._write_directory()
+
+    def abort(self):
+        self._pool.stop()
+
+
+ARCHIVERS = {
+    'tar': TarArchiver,
+    'tbz2': Tbz2Archiver,
+    'tgz': TgzArchiver,
+    'zip': ZipArchiver,
+}
+
+
+def get_archiver(kind, stream, prefix, mtime, **kwargs):
+    """
+    Returns instance of archiver class specific to given kind (other
+    arguments are passed to the ``BaseArchiver``)
+
+    :param kind: archive kind
+    :raises ImproperArchiveTypeError: if there is no archiver for ``kind``
+    """
+    try:
+        cls = ARCHIVERS[kind]
+    except KeyError:
+        raise ImproperArchiveTypeError('Archive kind not supported use one'
+            'of %s' % ARCHIVERS.keys())
+    return cls(stream, prefix, mtime, **kwargs)
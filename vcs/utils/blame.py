@@ -0,0 +1,225 @@
+"""
+Backend independent part of files' annotation (blame).
+
+Backends produce annotation as an iterable of ``(sha, line)`` records (one
+per line of the file, in order) and pass it through ``iter_annotate``, which
+streams records to the caller as soon as backend yields them, gives every
+distinct commit a single changeset loader and, once all records have been
+read, caches complete annotation. Annotation of a file at given commit never
+changes, so cache is keyed by file's content id and commit id and never needs
+to be invalidated.
+
+Before backend is asked to compute annotation, first parents of the
+changeset are checked for cached annotation of the same path (cache keeps
+ids of changesets annotations of every path have been cached for, so paths
+without any are not walked at all). If one is found, annotations of all
+changesets between it and the asked one are derived from it, one by one:
+lines kept unchanged retain their records, other lines are annotated with the
+changeset which introduced them. Annotation is derived only if changed lines
+can be aligned in one way only (otherwise git and mercurial diff algorithms
+might align them differently), so derived annotations are always the same as
+computed ones. Stepping through history of a file with annotation therefore
+does not need to compute it from scratch at every step.
+"""
+import re
+
+from vcs.exceptions import VCSError
+from vcs.utils.lru import LRUCache
+
+# maximal number of first parents checked for cached annotation
+MAX_DERIVE_DEPTH = 50
+
+
+class AnnotateCache(LRUCache):
+    """
+    Least recently used cache of complete annotations. Cache is thread safe.
+
+    :param size: maximal number of lines (of all cached annotations together)
+      kept at the cache; longer annotations are never cached
+    """
+
+    def __init__(self, size):
+        super(AnnotateCache, self).__init__(size, weight=len)
+        # ids of changesets annotations of paths have been cached for; they
+        # are hints only (annotations might have been dropped since)
+        self._revisions = LRUCache(size, weight=len)
+
+    def add_annotation(self, path, key, records):
+        """
+        Caches ``records`` of the file at given ``path`` under given ``key``
+        (tuple of content id and changeset id).
+        """
+        self.set(key, records)
+        revisions = self._revisions.get(path, frozenset())
+        self._revisions.set(path, revisions.union([key[1]]))
+
+    def get_revisions(self, path):
+        """
+        Returns set of ids of changesets whose annotations of the file at
+        given ``path`` might be cached.
+        """
+        return self._revisions.get(path, frozenset())
+
+    def clear(self):
+        super(AnnotateCache, self).clear()
+        self._revisions.clear()
+
+
+class ChangesetLoader(object):
+    """
+    Callable returning changeset with given ``revision``. Changeset is
+    retrieved from the ``repository`` once and then shared by all lines
+    annotated with it.
+    """
+
+    def __init__(self, repository, revision):
+        self.repository = repository
+        self.revision = revision
+        self._changeset = None
+
+    def __call__(self):
+        if self._changeset is None:
+            self._changeset = self.repository.get_changeset(self.revision)
+        return self._changeset
+
+    def __repr__(self):
+        return '<%s at %s>' % (self.__class__.__name__, self.revision)
+
+
+def split_lines(content):
+    """
+    Splits given ``content`` into lines (keeping line endings) at ``'\\n'``
+    characters only, as both git and mercurial do.
+    """
+    return re.findall(r'[^\n]*\n|[^\n]+$', content)
+
+
+def _can_shift(lines, start, end):
+    """
+    Returns ``True`` if block of ``lines`` from ``start`` to ``end`` could be
+    shifted by a line up or down leaving the same lines around it.
+    """
+    if start == end:
+        return False
+    return (start > 0 and lines[start - 1] == lines[end - 1]
+            or end < len(lines) and lines[start] == lines[end])
+
+
+def derive_annotation(records, lines, sha):
+    """
+    Returns tuple of records of the file with given ``lines``, derived from
+    ``records`` of its previous version, or ``None`` if changed lines could
+    be aligned in more than one way. Only single block of changed lines,
+    which shares no line with the other version and cannot be shifted, is
+    derived; its lines are annotated with given ``sha``.
+    """
+    old = [line for _, line in records]
+    start = 0
+    end = min(len(old), len(lines))
+    while start < end and old[start] == lines[start]:
+        start += 1
+    old_end, new_end = len(old), len(lines)
+    while (old_end > start and new_end > start
+           and old[old_end - 1] == lines[new_end - 1]):
+        old_end -= 1
+        new_end -= 1
+    # changed lines must not be found anywhere at the other version, so that
+    # no diff algorithm could align them with anything
+    if set(old[start:old_end]).intersection(lines) or \
+            set(lines[start:new_end]).intersection(old):
+        return None
+    if _can_shift(old, start, old_end) or _can_shift(lines, start, new_end):
+        return None
+    return (tuple(records[:start])
+            + tuple((sha, line) for line in lines[start:new_end])
+            + tuple(records[old_end:]))
+
+
+def get_derived_annotation(changeset, path, key, cache):
+    """
+    Returns records of the file at given ``path`` derived from annotation
+    cached for one of first parents of the ``changeset`` (caching all
+    annotations derived on the way) or ``None`` if there is no such
+    annotation or it cannot be derived. Only changesets with single parent
+    are followed.
+    """
+    revisions = cache.get_revisions(path)
+    if not revisions:
+        return None
+    steps = [changeset]
+    current = changeset
+    for i in xrange(MAX_DERIVE_DEPTH):
+        parents = current.parents
+        if len(parents) != 1:
+            return None
+        current = parents[0]
+        if current.raw_id in revisions:
+            break
+        steps.append(current)
+    else:
+        return None
+    try:
+        parent_key = current._get_annotate_key(path)
+        records = cache.get(parent_key)
+        for step in reversed(steps):
+            if records is None:
+                return None
+            if step is changeset:
+                step_key = key
+            else:
+                step_key = step._get_annotate_key(path)
+            if step_key[0] != parent_key[0]:
+                lines = split_lines(step.get_file_content(path))
+                records = derive_annotation(records, lines, step.raw_id)
+                if records is None:
+                    return None
+            cache.add_annotation(path, step_key, records)
+            parent_key = step_key
+    except VCSError:
+        return None
+    return records
+
+
+def iter_annotate(changeset, path, get_records):
+    """
+    Returns generator of four element tuples with lineno, sha, changeset lazy
+    loader and line of the file at given ``path`` (as returned by the
+    ``get_file_annotate`` method of changesets).
+
+    :param changeset: changeset implementing ``_get_annotate_key`` method,
+      which returns tuple of content id of the file at given path and
+      changeset's id (raising ``VCSError`` if there is no such file)
+    :param path: path of the file
+    :param get_records: callable returning iterable of ``(sha, line)``
+      records; called only if annotation can be neither found at repository's
+      ``_annotate_cache`` nor derived from a cached one
+    """
+    repository = changeset.repository
+    cache = repository._annotate_cache
+    key = changeset._get_annotate_key(path)
+    return _iter_annotate(repository, changeset, path, key, cache,
+                          get_records)
+
+
+def _iter_annotate(repository, changeset, path, key, cache, get_records):
+    records = cache.get(key)
+    if records is None:
+        records = get_derived_annotation(changeset, path, key, cache)
+    if records is not None:
+        stream = iter(records)
+    else:
+        stream = _iter_caching(cache, path, key, get_records())
+    loaders = {}
+    for lineno, (sha, line) in enumerate(stream):
+        loader = loaders.get(sha)
+        if loader is None:
+            loader = loaders[sha] = ChangesetLoader(repository, sha)
+        yield lineno + 1, sha, loader, line
+
+
+def _iter_caching(cache, path, key, records):
+    done = []
+    for record in records:
+        done.append(record)
+        yield record
+    cache.add_annotation(path, key, tuple(done))
@@ -4,7 +4,9 @@ Various utilities to work with Python < 2.7.
 Those utilities may be deleted once ``vcs`` stops support for older Python
 versions.
 """
+import os
 import sys
+import signal
 import array
 
 if sys.version_info >= (2, 7):
@@ -316,3 +318,37 @@ else:
                     self.__cond.wait(timeout)
             finally:
                 self.__cond.release()
+
+
+#==============================================================================
+# bin, int.bit_length, Popen.kill
+#==============================================================================
+
+if sys.version_info >= (2, 6):
+    bin = bin
+else:
+    _HEX_BITS = dict((digit, ''.join(str(int(digit, 16) >> i & 1)
+                                     for i in (3, 2, 1, 0)))
+                     for digit in '0123456789abcdef')
+
+    def bin(number):
+        if number < 0:
+            return '-' + bin(-number)
+        digits = ''.join(_HEX_BITS[d] for d in '%x' % number).lstrip('0')
+        return '0b' + (digits or '0')
+
+if sys.version_info >= (2, 7):
+    def bit_length(number):
+        return number.bit_length()
+else:
+    def bit_length(number):
+        if not number:
+            return 0
+        return len(bin(abs(number))) - 2
+
+if sys.version_info >= (2, 6):
+    def kill(process):
+        process.kill()
+else:
+    def kill(process):
+        os.kill(process.pid, signal.SIGKILL)
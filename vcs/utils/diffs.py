@@ -10,7 +10,7 @@ from difflib import unified_diff
 
 from vcs.exceptions import VCSError
 from vcs.nodes import FileNode, NodeError
-from vcs.utils import safe_unicode
+from vcs.utils import iter_lines, safe_unicode
 
 
 def get_udiff(filenode_old, filenode_new, show_whitespace=True):
@@ -68,6 +68,46 @@ def get_gitdiff(filenode_old, filenode_new, ignore_whitespace=True):
     return vcs_gitdiff
 
 
+def iter_file_diffs(chunks, file_limit=None, total_limit=None):
+    """
+    Splits git style diff, given as iterable of ``chunks`` of any size, into
+    patches of single files. Returns generator of tuples ``(patch,
+    truncated)``, yielded as soon as patch of the file has been read
+    (anything before the first ``diff --git`` line is skipped).
+
+    :param file_limit: if given, patches of files are cut (at line boundary)
+      to at most that many bytes
+    :param total_limit: if given, patches are cut once that many bytes has
+      been yielded in total; patches of files following the cut one consist
+      of their ``diff --git`` line only
+    :returns: patches with ``truncated`` flag set to ``True`` if they have
+      been cut
+    """
+    lines = None
+    size, truncated = 0, False
+    left = total_limit
+    for line in iter_lines(chunks):
+        if line.startswith('diff --git '):
+            if lines is not None:
+                yield ''.join(lines), truncated
+                if left is not None:
+                    left -= size
+            lines, size, truncated = [line], len(line), False
+            continue
+        if lines is None or truncated:
+            continue
+        limit = file_limit
+        if left is not None and (limit is None or left < limit):
+            limit = left
+        if limit is not None and size + len(line) > limit:
+            truncated = True
+            continue
+        lines.append(line)
+        size += len(line)
+    if lines is not None:
+        yield ''.join(lines), truncated
+
+
 class DiffProcessor(object):
     """
     Give it a unified diff and it returns a list of the files that were
@@ -0,0 +1,76 @@
+"""
+Size bounded, least recently used caches.
+"""
+from __future__ import with_statement
+
+import threading
+
+from vcs.utils.ordered_dict import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping which drops least recently used items once total
+    weight of kept items exceeds ``size``.
+
+    :param size: maximal total weight of items kept at the cache
+    :param weight: callable returning weight of the given value; each item
+      weights 1 if not given. Items heavier than ``size`` are never cached.
+    :param evicted: callable called with every value dropped to make room
+      for others (i.e. to release resources held by the value)
+    """
+
+    def __init__(self, size, weight=None, evicted=None):
+        self.size = size
+        self.weight = weight or (lambda value: 1)
+        self.evicted = evicted
+        self._items = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """
+        Returns value cached for the given ``key`` (marking it as the most
+        recently used one) or ``default``.
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        """
+        Caches ``value`` for the given ``key``, dropping least recently used
+        items if needed.
+        """
+        weight = self.weight(value)
+        dropped = []
+        with self._lock:
+            if key in self._items:
+                self._total -= self.weight(self._items.pop(key))
+            if weight > self.size:
+                return
+            self._items[key] = value
+            self._total += weight
+            while self._total > self.size:
+                dropped.append(self._items.popitem(last=False)[1])
+                self._total -= self.weight(dropped[-1])
+        if self.evicted is not None:
+            for value in dropped:
+                self.evicted(value)
+
+    def clear(self):
+        """
+        Removes all items from the cache.
+        """
+        with self._lock:
+            self._items.clear()
+            self._total = 0
@@ -0,0 +1,106 @@
+"""
+Compact containers of changesets' metadata.
+
+Pages listing history (and exports of it) need only few attributes of every
+changeset, so backends read them in a single pass over commits, without
+building changeset objects, into ``ChangesetsMetadata``: parallel columns
+with timestamps and revisions kept at arrays. Rows are returned as
+``ChangesetMetadata`` records (with ``__slots__``) built on demand.
+"""
+from array import array
+
+from vcs.utils import author_name, author_email, date_fromtimestamp
+
+
+def get_summary(message):
+    """
+    Returns first line of given commit ``message``.
+    """
+    return message.split('\n', 1)[0].rstrip('\r')
+
+
+class ChangesetMetadata(object):
+    """
+    Metadata of single changeset. ``message`` is ``None`` if full messages
+    have not been read.
+    """
+    __slots__ = ('raw_id', 'revision', 'author', 'timestamp', 'summary',
+                 'message')
+
+    def __init__(self, raw_id, revision, author, timestamp, summary,
+                 message=None):
+        self.raw_id = raw_id
+        self.revision = revision
+        self.author = author
+        self.timestamp = timestamp
+        self.summary = summary
+        self.message = message
+
+    @property
+    def short_id(self):
+        return self.raw_id[:12]
+
+    @property
+    def date(self):
+        return date_fromtimestamp(self.timestamp)
+
+    @property
+    def author_name(self):
+        return author_name(self.author)
+
+    @property
+    def author_email(self):
+        return author_email(self.author)
+
+    def __eq__(self, other):
+        return self.raw_id == getattr(other, 'raw_id', None)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%s at %s:%s>' % (self.__class__.__name__, self.revision,
+            self.short_id)
+
+
+class ChangesetsMetadata(object):
+    """
+    Metadata of many changesets kept at parallel columns: ``raw_ids``,
+    ``revisions`` (array), ``authors``, ``timestamps`` (array), ``summaries``
+    and ``messages`` (``None`` unless ``messages`` is set).
+    """
+
+    def __init__(self, messages=True):
+        self.raw_ids = []
+        self.revisions = array('i')
+        self.authors = []
+        self.timestamps = array('l')
+        self.summaries = []
+        self.messages = [] if messages else None
+
+    def append(self, raw_id, revision, author, timestamp, summary,
+               message=None):
+        self.raw_ids.append(raw_id)
+        self.revisions.append(revision)
+        self.authors.append(author)
+        self.timestamps.append(int(timestamp))
+        self.summaries.append(summary)
+        if self.messages is not None:
+            self.messages.append(message)
+
+    def __len__(self):
+        return len(self.raw_ids)
+
+    def __getitem__(self, index):
+        messages = self.messages
+        return ChangesetMetadata(self.raw_ids[index], self.revisions[index],
+            self.authors[index], self.timestamps[index],
+            self.summaries[index],
+            messages[index] if messages is not None else None)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return '<%s of %d changesets>' % (self.__class__.__name__, len(self))
@@ -0,0 +1,254 @@
+"""
+Containers used by backends to keep track of repository's revisions.
+"""
+import bisect
+from array import array
+from binascii import hexlify, unhexlify
+
+from vcs.utils.compat import bin, bit_length
+
+
+class RevisionList(list):
+    """
+    List of revisions' ids, in ascending order, which keeps mapping of ids to
+    their positions so that ``index`` and ``in`` do not have to scan whole
+    history. Additionally sorted list of binary ids is kept (lazily) in order
+    to resolve abbreviated ids.
+
+    Appending and extending updates lookup tables incrementally, any other
+    modification of the list drops them (and they would be rebuilt on next
+    lookup).
+    """
+
+    def __init__(self, revisions=()):
+        super(RevisionList, self).__init__(revisions)
+        self._positions = None
+        self._binary_ids = None
+
+    def _invalidate(self):
+        self._positions = None
+        self._binary_ids = None
+
+    @property
+    def positions(self):
+        """
+        Returns dictionary mapping revisions' ids to their positions.
+        """
+        if self._positions is None:
+            positions = {}
+            for pos in xrange(len(self) - 1, -1, -1):
+                positions[self[pos]] = pos
+            self._positions = positions
+        return self._positions
+
+    def __contains__(self, revision):
+        try:
+            return revision in self.positions
+        except TypeError:
+            # unhashable objects cannot be stored here anyway
+            return False
+
+    def index(self, revision, *args):
+        if args:
+            return super(RevisionList, self).index(revision, *args)
+        try:
+            return self.positions[revision]
+        except (KeyError, TypeError):
+            raise ValueError('%r is not in list' % (revision,))
+
+    def get(self, revision, default=None):
+        """
+        Returns position of the given ``revision`` or ``default`` if it is
+        not present at this list.
+        """
+        try:
+            return self.positions.get(revision, default)
+        except TypeError:
+            return default
+
+    def get_by_prefix(self, prefix):
+        """
+        Returns sorted list of ids starting with given hexadecimal ``prefix``.
+        """
+        prefix = prefix.lower()
+        try:
+            low = unhexlify(prefix + '0' * (len(prefix) % 2))
+        except TypeError:
+            return []
+        if self._binary_ids is None:
+            self._binary_ids = sorted(unhexlify(rev) for rev in self)
+        ids = self._binary_ids
+        matches = []
+        for pos in xrange(bisect.bisect_left(ids, low), len(ids)):
+            rev = hexlify(ids[pos])
+            if not rev.startswith(prefix):
+                break
+            matches.append(rev)
+        return matches
+
+    def append(self, revision):
+        super(RevisionList, self).append(revision)
+        if self._positions is not None:
+            self._positions.setdefault(revision, len(self) - 1)
+        if self._binary_ids is not None:
+            bisect.insort(self._binary_ids, unhexlify(revision))
+
+    def extend(self, revisions):
+        for revision in revisions:
+            self.append(revision)
+
+    def __iadd__(self, revisions):
+        self.extend(revisions)
+        return self
+
+    def __setitem__(self, *args):
+        self._invalidate()
+        return super(RevisionList, self).__setitem__(*args)
+
+    def __delitem__(self, *args):
+        self._invalidate()
+        return super(RevisionList, self).__delitem__(*args)
+
+    def __setslice__(self, *args):
+        self._invalidate()
+        return super(RevisionList, self).__setslice__(*args)
+
+    def __delslice__(self, *args):
+        self._invalidate()
+        return super(RevisionList, self).__delslice__(*args)
+
+    def __imul__(self, *args):
+        self._invalidate()
+        return super(RevisionList, self).__imul__(*args)
+
+    def insert(self, *args):
+        self._invalidate()
+        return super(RevisionList, self).insert(*args)
+
+    def pop(self, *args):
+        self._invalidate()
+        return super(RevisionList, self).pop(*args)
+
+    def remove(self, *args):
+        self._invalidate()
+        return super(RevisionList, self).remove(*args)
+
+    def reverse(self):
+        self._invalidate()
+        return super(RevisionList, self).reverse()
+
+    def sort(self, *args, **kwargs):
+        self._invalidate()
+        return super(RevisionList, self).sort(*args, **kwargs)
+
+
+class RevisionDates(object):
+    """
+    Commit timestamps aligned with revisions' positions. Positions sorted by
+    timestamp are kept as well, so revisions committed within given time
+    window are found with binary search.
+
+    Given ``timestamps`` array is not copied, so it may be shared with other
+    structure which appends to it - sorted positions catch up with appended
+    timestamps on next lookup.
+    """
+
+    def __init__(self, timestamps=None):
+        if timestamps is None:
+            timestamps = array('l')
+        self.timestamps = timestamps
+        self._sorted = array('l')
+        self._order = array('i')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp):
+        self.timestamps.append(int(timestamp))
+
+    def _update(self):
+        timestamps = self.timestamps
+        if not self._order and timestamps:
+            order = sorted(xrange(len(timestamps)),
+                           key=timestamps.__getitem__)
+            self._order = array('i', order)
+            self._sorted = array('l', (timestamps[pos] for pos in order))
+            return
+        for pos in xrange(len(self._order), len(timestamps)):
+            i = bisect.bisect_right(self._sorted, timestamps[pos])
+            self._sorted.insert(i, timestamps[pos])
+            self._order.insert(i, pos)
+
+    def get_positions(self, since=None, until=None, start=0, end=None):
+        """
+        Returns sorted list of positions of revisions committed between
+        ``since`` and ``until`` timestamps. Only positions from ``start`` to
+        ``end`` are considered. All bounds are inclusive, ``None`` stands for
+        no bound.
+        """
+        if end is None:
+            end = len(self.timestamps) - 1
+        if since is None and until is None:
+            return range(start, end + 1)
+        self._update()
+        low = 0
+        if since is not None:
+            low = bisect.bisect_left(self._sorted, since)
+        high = len(self._sorted)
+        if until is not None:
+            high = bisect.bisect_right(self._sorted, until)
+        if high - low > end - start:
+            # cheaper to check timestamps of all positions within bounds
+            timestamps = self.timestamps
+            return [pos for pos in xrange(start, end + 1)
+                    if (since is None or timestamps[pos] >= since)
+                    and (until is None or timestamps[pos] <= until)]
+        positions = [pos for pos in self._order[low:high]
+                     if start <= pos <= end]
+        positions.sort()
+        return positions
+
+
+def make_bitset(positions):
+    """
+    Returns bitset (``long`` with bits set at given ``positions``).
+    """
+    positions = list(positions)
+    if not positions:
+        return 0L
+    flags = array('c', '0') * (max(positions) + 1)
+    for pos in positions:
+        flags[pos] = '1'
+    flags.reverse()
+    return long(flags.tostring(), 2)
+
+
+def filter_positions(bits, positions):
+    """
+    Returns list of those of given ``positions`` which are set at ``bits``.
+    """
+    flags = bin(bits)[:1:-1]
+    size = len(flags)
+    return [pos for pos in positions if pos < size and flags[pos] == '1']
+
+
+def get_next_position(bits, pos):
+    """
+    Returns lowest position greater than ``pos`` set at ``bits`` or ``None``
+    if there is no such position.
+    """
+    rest = bits >> (pos + 1)
+    if not rest:
+        return None
+    return pos + bit_length(rest & -rest)
+
+
+def get_prev_position(bits, pos):
+    """
+    Returns highest position lower than ``pos`` set at ``bits`` or ``None``
+    if there is no such position.
+    """
+    rest = bits & ((1 << pos) - 1)
+    if not rest:
+        return None
+    return bit_length(rest) - 1